@@ -0,0 +1,496 @@
+"""
+Микробенчмарки Database и обработчиков FSM
+
+Каждый метод Database замеряется отдельно на базе реалистичного размера
+(по умолчанию 100k пользователей и 1M строк state_log), обработчики
+StateHandlers — целиком, через AsyncDatabase, с заглушками Update/Context.
+Память на пользователя (кэш записей users, user_data и диалоги PTB до и
+после выгрузки простаивающих) считается tracemalloc в МБ на 100k пользователей.
+Результаты сохраняются в JSON; с --baseline текущий прогон сравнивается
+с сохранённым и регрессии по p50 и памяти сверх --threshold выделяются
+(код возврата 1), чтобы изменения хранилища оценивались цифрами.
+
+Примеры:
+    python benchmarks.py --output baseline.json
+    python benchmarks.py --baseline baseline.json
+    python benchmarks.py --fixture /tmp/bench.db --only get_analytics,get_user_stats
+    python benchmarks.py --skip-database --skip-handlers   # только память
+    python benchmarks.py --compare old.json new.json
+"""
+
+import argparse
+import asyncio
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+import tracemalloc
+from collections import defaultdict
+from datetime import datetime
+from types import SimpleNamespace
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from bot import (
+    DB_PROFILE,
+    STATES,
+    AsyncDatabase,
+    Database,
+    IdleUserEvictor,
+    JobScheduler,
+    PersistentConversationHandler,
+    SQLitePersistence,
+    ScheduledJob,
+    StateHandlers,
+    TransitionDispatcher
+)
+
+FEEDBACK_TYPES = ("Комфортно", "Нейтрально", "Дискомфорт")
+ALL_STATES = tuple(STATES.values())
+
+
+# ==================== ДАННЫЕ ====================
+
+def build_fixture(path: str, users: int, state_log_rows: int, seed: int = 1):
+    """Создать базу с пользователями и логами заданного размера"""
+    rng = random.Random(seed)
+    db = Database(path, readers=0, cache_size=0)
+    conn = db.conn
+
+    with conn:
+        conn.executemany(
+            "INSERT INTO users (telegram_user_id, current_state, session_count, pause_flag) "
+            "VALUES (?, ?, ?, ?)",
+            ((user_id, rng.choice(ALL_STATES), rng.randint(0, 20), int(rng.random() < 0.1))
+             for user_id in range(1, users + 1))
+        )
+        conn.executemany(
+            Database.SQL_INSERT_STATE_LOG,
+            ((rng.randint(1, users), rng.choice(ALL_STATES)) for _ in range(state_log_rows))
+        )
+        # Фидбэк и сеансы — в пропорции к state_log, как в живом сценарии
+        conn.executemany(
+            Database.SQL_INSERT_FEEDBACK,
+            ((rng.randint(1, users), rng.choice(FEEDBACK_TYPES), None, rng.randint(1, 20))
+             for _ in range(state_log_rows // 10))
+        )
+        conn.executemany(
+            Database.SQL_INSERT_SESSION,
+            ((rng.randint(1, users), rng.randint(1, 20), 300) for _ in range(state_log_rows // 10))
+        )
+
+    db.rebuild_analytics()
+    db.close()
+
+
+def prepare_database(fixture: Optional[str], workdir: str, users: int, state_log_rows: int) -> str:
+    """Рабочая копия базы: бенчмарки пишут в неё, фикстура остаётся нетронутой"""
+    if fixture is None:
+        fixture = os.path.join(workdir, 'fixture.db')
+    if not os.path.exists(fixture):
+        print(f"Создание фикстуры: {users} пользователей, {state_log_rows} строк state_log...",
+              file=sys.stderr)
+        started = time.perf_counter()
+        build_fixture(fixture, users, state_log_rows)
+        print(f"Фикстура готова за {time.perf_counter() - started:.1f} сек.", file=sys.stderr)
+
+    work = os.path.join(workdir, 'work.db')
+    shutil.copyfile(fixture, work)
+    return work
+
+
+def fixture_size(path: str) -> Tuple[int, int]:
+    """Фактическое число пользователей и строк state_log"""
+    conn = sqlite3.connect(path)
+    try:
+        users = conn.execute("SELECT COUNT(*) FROM users").fetchone()[0]
+        rows = conn.execute("SELECT COUNT(*) FROM state_log").fetchone()[0]
+    finally:
+        conn.close()
+    return users, rows
+
+
+# ==================== ЗАМЕРЫ ====================
+
+def summarize(samples_ns: List[int]) -> Dict[str, float]:
+    """Сводка по замерам одного бенчмарка (в микросекундах)"""
+    samples_ns.sort()
+    count = len(samples_ns)
+    total = sum(samples_ns)
+    return {
+        'iterations': count,
+        'mean_us': round(total / count / 1000, 2),
+        'p50_us': round(samples_ns[count // 2] / 1000, 2),
+        'p99_us': round(samples_ns[min(int(count * 0.99), count - 1)] / 1000, 2),
+        'ops_per_s': round(count / (total / 1e9), 1) if total else 0.0
+    }
+
+
+def bench_sync(func: Callable[[int], Any], iterations: int, warmup: int) -> Dict[str, float]:
+    """Замер синхронного вызова; аргумент — номер итерации"""
+    for i in range(warmup):
+        func(i)
+    samples = []
+    for i in range(warmup, warmup + iterations):
+        started = time.perf_counter_ns()
+        func(i)
+        samples.append(time.perf_counter_ns() - started)
+    return summarize(samples)
+
+
+async def bench_async(setup: Callable[[int], Any], func: Callable[[int, Any], Awaitable[Any]],
+                      iterations: int, warmup: int) -> Dict[str, float]:
+    """Замер корутины; setup готовит состояние вне замера"""
+    samples = []
+    for i in range(warmup + iterations):
+        prepared = setup(i)
+        started = time.perf_counter_ns()
+        await func(i, prepared)
+        if i >= warmup:
+            samples.append(time.perf_counter_ns() - started)
+    return summarize(samples)
+
+
+def database_benchmarks(db_path: str, users: int, iterations: int, warmup: int,
+                        selected: Optional[set]) -> Dict[str, Dict[str, float]]:
+    """Методы Database по отдельности (без кэша, кроме вариантов [cached])"""
+    rng = random.Random(2)
+    user_ids = [rng.randint(1, users) for _ in range(iterations + warmup)]
+    new_user_base = users + 1_000_000
+
+    db = Database(db_path, cache_size=0)
+    cached = Database(db_path, cache_size=users)
+    for user_id in user_ids:
+        cached.get_or_create_user(user_id)
+
+    cases: Dict[str, Callable[[int], Any]] = {
+        'get_or_create_user': lambda i: db.get_or_create_user(user_ids[i]),
+        'get_or_create_user[new]': lambda i: db.get_or_create_user(new_user_base + i),
+        'get_or_create_user[cached]': lambda i: cached.get_or_create_user(user_ids[i]),
+        'get_user': lambda i: db.get_user(user_ids[i]),
+        'get_user[cached]': lambda i: cached.get_user(user_ids[i]),
+        'update_user_state': lambda i: db.update_user_state(user_ids[i], ALL_STATES[i % len(ALL_STATES)]),
+        'transition[session+feedback]': lambda i: db.transition(
+            user_ids[i], STATES['S5_POST_SESSION'], session=300, feedback=("Комфортно", None)
+        ),
+        'increment_session_count': lambda i: db.increment_session_count(user_ids[i]),
+        'set_pause_flag': lambda i: db.set_pause_flag(user_ids[i], i % 2),
+        'add_feedback': lambda i: db.add_feedback(user_ids[i], FEEDBACK_TYPES[i % 3], None, 1),
+        'add_session': lambda i: db.add_session(user_ids[i], 1, 300),
+        'log_state': lambda i: db.log_state(user_ids[i], STATES['S3_READY_FOR_SESSION']),
+        'get_user_stats': lambda i: db.get_user_stats(user_ids[i]),
+        'get_analytics': lambda i: db.get_analytics(),
+    }
+
+    results = {}
+    try:
+        for name, func in cases.items():
+            if selected and name not in selected:
+                continue
+            results[name] = bench_sync(func, iterations, warmup)
+            print(f"  {name}: p50 {results[name]['p50_us']} мкс", file=sys.stderr)
+    finally:
+        cached.close()
+        db.close()
+    return results
+
+
+class FakeMessage:
+    """Входящее сообщение: текст и reply_text без сети"""
+    __slots__ = ('text',)
+
+    def __init__(self, text: str):
+        self.text = text
+
+    async def reply_text(self, text: str, **kwargs):
+        return None
+
+
+class FakeBot:
+    """Бот без сети"""
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        return None
+
+
+def fake_update(user_id: int, text: str) -> SimpleNamespace:
+    return SimpleNamespace(
+        effective_user=SimpleNamespace(id=user_id),
+        effective_chat=SimpleNamespace(id=user_id),
+        message=FakeMessage(text)
+    )
+
+
+async def handler_benchmarks(db_path: str, users: int, iterations: int, warmup: int,
+                             selected: Optional[set]) -> Dict[str, Dict[str, float]]:
+    """Обработчики StateHandlers целиком: AsyncDatabase, транзакции, планировщик, ответ"""
+    db = AsyncDatabase(db_path)
+    scheduler = JobScheduler(db)
+    handlers = StateHandlers(db, scheduler)
+    dispatcher = TransitionDispatcher(handlers)
+    bot = FakeBot()
+    context = SimpleNamespace(user_data={}, bot=bot)
+
+    # Каждая итерация берёт своего пользователя и переводит его в нужное состояние вне замера
+    rng = random.Random(3)
+    user_ids = rng.sample(range(1, users + 1), min(users, iterations + warmup))
+
+    def user_in(state: str, **options) -> Callable[[int], int]:
+        def setup(i: int) -> int:
+            user_id = user_ids[i % len(user_ids)]
+            db.call('transition', user_id, state, pause=0, **options)
+            return user_id
+        return setup
+
+    def session_timer(i: int) -> ScheduledJob:
+        user_id = user_ids[i % len(user_ids)]
+        job = ScheduledJob(f"session_end:{user_id}", user_id, 'session_end', time.time(), {})
+        db.call('transition', user_id, STATES['S4_SESSION_ACTIVE'], pause=0, schedule=job)
+        return job
+
+    def on_message(state, text):
+        # Нажатие кнопки через таблицу переходов: обработчик и ответ с клавиатурой
+        return lambda i, user_id: dispatcher.dispatch(state, fake_update(user_id, text), context)
+
+    cases = {
+        'handle_s0_init': (user_in(STATES['S0_INIT']),
+                           on_message(STATES['S0_INIT'], "Начать")),
+        'handle_s1_confirm': (user_in(STATES['S1_CONFIRM_CONDITIONS']),
+                              on_message(STATES['S1_CONFIRM_CONDITIONS'], "Подтверждаю")),
+        'handle_s2_check': (user_in(STATES['S2_CHECK_CONTRAINDICATIONS']),
+                            on_message(STATES['S2_CHECK_CONTRAINDICATIONS'], "Нет")),
+        'handle_s3_ready': (user_in(STATES['S3_READY_FOR_SESSION']),
+                            on_message(STATES['S3_READY_FOR_SESSION'], "Начать сеанс")),
+        'complete_session': (session_timer,
+                             lambda i, job: handlers.complete_session(job, bot)),
+        'handle_s5_post_session': (user_in(STATES['S5_POST_SESSION']),
+                                   on_message(STATES['S5_POST_SESSION'], "Продолжить")),
+        'handle_s6_feedback': (user_in(STATES['S6_FEEDBACK']),
+                               on_message(STATES['S6_FEEDBACK'], "Комфортно")),
+        'handle_s6_feedback[discomfort]': (user_in(STATES['S6_FEEDBACK']),
+                                           on_message(STATES['S6_FEEDBACK'], "Дискомфорт")),
+        'handle_s6_discomfort_detail': (user_in(STATES['S6_FEEDBACK']),
+                                        on_message(STATES['S6_FEEDBACK'], "Нет")),
+    }
+
+    results = {}
+    try:
+        for name, (setup, func) in cases.items():
+            if selected and name not in selected:
+                continue
+            results[name] = await bench_async(setup, func, iterations, warmup)
+            print(f"  {name}: p50 {results[name]['p50_us']} мкс", file=sys.stderr)
+    finally:
+        db.close()
+    return results
+
+
+async def measure_memory(users: int, fill: Callable[[], Awaitable[Any]]) -> Dict[str, float]:
+    """Память, оставшаяся занятой после fill(), в пересчёте на 100k пользователей"""
+    gc.collect()
+    before = tracemalloc.get_traced_memory()[0]
+    await fill()
+    gc.collect()
+    retained = tracemalloc.get_traced_memory()[0] - before
+    return {
+        'users': users,
+        'bytes_per_user': round(retained / users, 1),
+        'mb_per_100k_users': round(retained * 100_000 / users / 2**20, 2)
+    }
+
+
+async def memory_benchmarks(db_path: str, users: int,
+                            selected: Optional[set]) -> Dict[str, Dict[str, float]]:
+    """Память на пользователя: кэш записей users и данные PTB в памяти до и после выгрузки"""
+    user_ids = list(range(1, users + 1))
+    async_db = AsyncDatabase(db_path, readers=0, cache_size=0)
+    # Созданное в замере удерживается до его конца
+    kept: List[Any] = []
+
+    async def fill_user_cache():
+        db = Database(db_path, readers=0, cache_size=users)
+        kept.append(db)
+        for user_id in user_ids:
+            db.get_or_create_user(user_id)
+
+    async def fill_resident(evict: bool):
+        # Контейнеры PTB: Application._user_data и TrackingDict диалогов после инициализации
+        persistence = SQLitePersistence(async_db)
+        conversation = PersistentConversationHandler(
+            entry_points=[], states={}, fallbacks=[], name='fsm', persistent=True
+        )
+        application = SimpleNamespace(persistence=persistence, _user_data=defaultdict(dict),
+                                      update_persistence=persistence.flush)
+        context = SimpleNamespace(application=application)
+        await conversation._initialize_persistence(application)
+        kept.append(application)
+        kept.append(conversation)
+
+        # Как первое обновление каждого пользователя; в S2 — ещё и ход анкеты
+        for user_id in user_ids:
+            await persistence.refresh_user_data(user_id, application._user_data[user_id])
+            await conversation.rehydrate_conversation(fake_update(user_id, "Нет"), context)
+            if conversation._conversations.get((user_id, user_id)) == STATES['S2_CHECK_CONTRAINDICATIONS']:
+                application._user_data[user_id]['question'] = 1
+        if evict:
+            await IdleUserEvictor(persistence, conversation, idle_seconds=0).run_once(application)
+
+    cases = {
+        'user_cache': fill_user_cache,
+        'resident_users': lambda: fill_resident(evict=False),
+        'resident_users[evicted]': lambda: fill_resident(evict=True),
+    }
+
+    results = {}
+    tracemalloc.start()
+    try:
+        for name, fill in cases.items():
+            if selected and name not in selected:
+                continue
+            results[name] = await measure_memory(users, fill)
+            for item in kept:
+                if isinstance(item, Database):
+                    item.close()
+            kept.clear()
+            print(f"  {name}: {results[name]['mb_per_100k_users']} МБ на 100k", file=sys.stderr)
+    finally:
+        tracemalloc.stop()
+        async_db.close()
+    return results
+
+
+# ==================== СРАВНЕНИЕ ====================
+
+def compare(baseline: Dict[str, Any], current: Dict[str, Any], threshold: float,
+            min_delta_us: float = 2.0) -> List[str]:
+    """Напечатать сравнение и вернуть имена бенчмарков с регрессией по p50.
+
+    Регрессия — замедление больше threshold и больше min_delta_us,
+    чтобы шум микросекундных замеров не считался регрессией.
+    """
+    regressions = []
+    print(f"{'бенчмарк':<36} {'было p50':>12} {'стало p50':>12} {'изменение':>10}")
+    for group in ('database', 'handlers', 'memory'):
+        # Для памяти сравнивается объём на 100k пользователей, порог по абсолюту — 0.1 МБ
+        field, min_delta = ('mb_per_100k_users', 0.1) if group == 'memory' else ('p50_us', min_delta_us)
+        for name, result in current.get(group, {}).items():
+            old = baseline.get(group, {}).get(name)
+            if old is None:
+                print(f"{name:<36} {'—':>12} {result[field]:>12} {'новый':>10}")
+                continue
+            change = (result[field] - old[field]) / old[field] if old[field] else 0.0
+            flag = ''
+            if change > threshold and result[field] - old[field] > min_delta:
+                regressions.append(name)
+                flag = '  РЕГРЕССИЯ'
+            print(f"{name:<36} {old[field]:>12} {result[field]:>12} {change:>+10.1%}{flag}")
+    return regressions
+
+
+def print_results(results: Dict[str, Any]):
+    print(f"{'бенчмарк':<36} {'mean':>10} {'p50':>10} {'p99':>10} {'оп/с':>12}  (мкс)")
+    for group in ('database', 'handlers'):
+        for name, result in results.get(group, {}).items():
+            print(f"{name:<36} {result['mean_us']:>10} {result['p50_us']:>10} "
+                  f"{result['p99_us']:>10} {result['ops_per_s']:>12}")
+    if results.get('memory'):
+        print(f"\n{'память':<36} {'МБ/100k':>10} {'байт/польз.':>12} {'польз.':>10}")
+        for name, result in results['memory'].items():
+            print(f"{name:<36} {result['mb_per_100k_users']:>10} {result['bytes_per_user']:>12} "
+                  f"{result['users']:>10}")
+
+
+def run(args) -> Dict[str, Any]:
+    selected = set(args.only.split(',')) if args.only else None
+    with tempfile.TemporaryDirectory() as workdir:
+        db_path = prepare_database(args.fixture, workdir, args.users, args.state_log_rows)
+        users, rows = fixture_size(db_path)
+
+        results: Dict[str, Any] = {
+            'meta': {
+                'date': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'sqlite': sqlite3.sqlite_version,
+                'platform': platform.platform(),
+                'profile': DB_PROFILE,
+                'users': users,
+                'state_log_rows': rows,
+                'iterations': args.iterations,
+                'handler_iterations': args.handler_iterations
+            }
+        }
+        if not args.skip_database:
+            print("Database:", file=sys.stderr)
+            results['database'] = database_benchmarks(
+                db_path, users, args.iterations, args.warmup, selected
+            )
+        if not args.skip_handlers:
+            print("StateHandlers:", file=sys.stderr)
+            results['handlers'] = asyncio.run(handler_benchmarks(
+                db_path, users, args.handler_iterations, args.warmup, selected
+            ))
+        if not args.skip_memory:
+            print("Память:", file=sys.stderr)
+            results['memory'] = asyncio.run(memory_benchmarks(
+                db_path, min(users, args.memory_users), selected
+            ))
+    return results
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Микробенчмарки Database и обработчиков FSM")
+    parser.add_argument('--users', type=int, default=100_000, help="пользователей в фикстуре")
+    parser.add_argument('--state-log-rows', type=int, default=1_000_000, help="строк state_log в фикстуре")
+    parser.add_argument('--fixture', help="файл фикстуры: создаётся при отсутствии и переиспользуется")
+    parser.add_argument('--iterations', type=int, default=2000, help="итераций на метод Database")
+    parser.add_argument('--handler-iterations', type=int, default=500, help="итераций на обработчик")
+    parser.add_argument('--warmup', type=int, default=50, help="прогревочных итераций")
+    parser.add_argument('--only', help="только перечисленные бенчмарки (через запятую)")
+    parser.add_argument('--skip-database', action='store_true', help="без методов Database")
+    parser.add_argument('--skip-handlers', action='store_true', help="без обработчиков")
+    parser.add_argument('--skip-memory', action='store_true', help="без замеров памяти")
+    parser.add_argument('--memory-users', type=int, default=100_000,
+                        help="пользователей в замерах памяти (не больше, чем в фикстуре)")
+    parser.add_argument('--output', help="сохранить результаты как JSON-базу для сравнения")
+    parser.add_argument('--baseline', help="сравнить прогон с сохранённой базой")
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help="сравнить два сохранённых прогона без запуска")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="допустимое замедление p50 (доля, по умолчанию 0.2)")
+    parser.add_argument('--min-delta-us', type=float, default=2.0,
+                        help="минимальное абсолютное замедление p50 для регрессии (мкс)")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        with open(args.compare[0], encoding='utf-8') as f:
+            baseline = json.load(f)
+        with open(args.compare[1], encoding='utf-8') as f:
+            current = json.load(f)
+        return 1 if compare(baseline, current, args.threshold, args.min_delta_us) else 0
+
+    results = run(args)
+    print_results(results)
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены: {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        print()
+        regressions = compare(baseline, results, args.threshold, args.min_delta_us)
+        if regressions:
+            print(f"Регрессии (> {args.threshold:.0%}): {', '.join(regressions)}")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
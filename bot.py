@@ -8,28 +8,72 @@ Telegram-бот "Продукт → Режим → Результат"
 - Хранит только данные об использовании и субъективных ощущениях
 """
 
+import time
 import os
 import sqlite3
 import asyncio
+import contextvars
 import logging
-from datetime import datetime
-from typing import Dict, List, Optional, Tuple, Any
+import functools
+import hmac
+import heapq
+import json
+import pickle
+import queue
+import random
+import secrets
+import signal
+import socket
+import sys
+import threading
+from bisect import bisect_left
+from collections import Counter, OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import Future, ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import (
+    TYPE_CHECKING, Awaitable, Callable, ContextManager, Dict, Iterable, Iterator, List, NamedTuple, Optional, Protocol,
+    Set, Tuple, Union, Any, runtime_checkable
+)
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: замок приёма (PIDFILE) не поддерживается
+    fcntl = None
 
+import httpx
 from telegram import (
     Update,
-    KeyboardButton,
     ReplyKeyboardMarkup,
     ReplyKeyboardRemove
 )
+from telegram.error import RetryAfter, TelegramError
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseRateLimiter,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     ConversationHandler,
     ContextTypes,
+    PersistenceInput,
+    TypeHandler,
     filters
 )
 
+# Нужны только профилировщику, кластеру и разбору аргументов;
+# импортируются при первом использовании, чтобы не замедлять запуск
+if TYPE_CHECKING:
+    import cProfile
+    import multiprocessing
+
+# Время фаз запуска, сек (--startup-report). Фаза imports — процессорное время
+# с запуска интерпретатора до этой строки: почти целиком импорт модулей
+# (замер без кода перед импортами, ожидание диска в него не входит)
+STARTUP_TIMINGS: Dict[str, float] = {'imports': time.process_time()}
+
 # ==================== КОНФИГУРАЦИЯ ====================
 
 # Токен бота (заменить на свой)
@@ -50,7 +94,167 @@ STATES = {
 
 # Длительность сеанса (в секундах)
 # Для теста: 10 секунд, для продакшена: 300 (5 минут)
-SESSION_DURATION = 10
+SESSION_DURATION = int(os.getenv("SESSION_DURATION", "10"))
+
+# Пауза перед предложением следующего сеанса после фидбэка (в секундах)
+FOLLOW_UP_DELAY = float(os.getenv("FOLLOW_UP_DELAY", "2"))
+
+# Файл базы данных SQLite
+DB_NAME = os.getenv("DB_NAME", "product_bot.db")
+
+# Адрес Bot API (пусто — api.telegram.org); для нагрузочного теста — локальная заглушка
+BOT_API_URL = os.getenv("BOT_API_URL", "")
+
+# Персистентность диалогов и user_data в SQLite: интервал пакетной записи (в секундах)
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", "5"))
+
+# Выгрузка простаивающих пользователей из памяти: user_data и состояние диалога
+# освобождаются после USER_IDLE_EVICT сек без обновлений (0 — не выгружать)
+# и при следующем обновлении читаются из БД; проверка раз в USER_EVICT_INTERVAL сек
+USER_IDLE_EVICT = float(os.getenv("USER_IDLE_EVICT", "1800"))
+USER_EVICT_INTERVAL = float(os.getenv("USER_EVICT_INTERVAL", "300"))
+
+# Режим приёма обновлений: polling (getUpdates) или webhook (встроенный HTTP-сервер)
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")  # публичный URL; пусто — setWebhook не вызывается
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram")
+
+# Конкурентная обработка: обновления одного пользователя идут строго по очереди,
+# разных пользователей — параллельно, не более MAX_CONCURRENT_UPDATES одновременно
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", "64"))
+# Верхняя граница обновлений в обработке и ожидании (память при всплесках)
+MAX_PENDING_UPDATES = int(os.getenv("MAX_PENDING_UPDATES", "4096"))
+
+# Кластер: входной процесс распределяет обновления между WORKERS процессами-обработчиками
+# по telegram_user_id (шард = id % WORKERS); обработчик i слушает 127.0.0.1:CLUSTER_BASE_PORT + i
+WORKERS = int(os.getenv("WORKERS", "0"))  # 0 — один процесс без кластера
+CLUSTER_BASE_PORT = int(os.getenv("CLUSTER_BASE_PORT", "8600"))
+CLUSTER_RESTART_MAX_DELAY = 30.0  # предел паузы перед перезапуском упавшего обработчика, сек
+
+# Завершение по SIGTERM: приём останавливается, начатые обновления и задачи дорабатывают
+# не дольше DRAIN_TIMEOUT сек, оставшиеся прерываются (таймеры и сообщения уже в БД)
+DRAIN_TIMEOUT = float(os.getenv("DRAIN_TIMEOUT", "10"))
+# Замок процесса, принимающего обновления (pid-файл под flock): второй экземпляр
+# не стартует, а с --handoff сменяет работающий, не теряя обновлений; замок
+# освобождается после доработки и записи состояния в БД, поэтому HANDOFF_TIMEOUT > DRAIN_TIMEOUT
+PIDFILE = os.getenv("PIDFILE", "bot.pid")
+HANDOFF_TIMEOUT = float(os.getenv("HANDOFF_TIMEOUT", "30"))  # ожидание освобождения приёма, сек
+
+# Исходящие сообщения: лимиты Telegram (сообщений в секунду) и повторы при RetryAfter
+SEND_GLOBAL_RATE = float(os.getenv("SEND_GLOBAL_RATE", "30"))
+SEND_CHAT_RATE = float(os.getenv("SEND_CHAT_RATE", "1"))
+SEND_CHAT_BURST = int(os.getenv("SEND_CHAT_BURST", "3"))
+SEND_MAX_RETRIES = int(os.getenv("SEND_MAX_RETRIES", "3"))
+
+# Приоритеты исходящих сообщений (меньше — важнее). Нумерация с 1:
+# ExtBot отбрасывает ложный rate_limit_args, и 0 дошёл бы до очереди как None
+PRIORITY_CRITICAL = 1  # завершение сеанса и пауза
+PRIORITY_NORMAL = 2    # ответы по ходу сценария
+PRIORITY_LOW = 3       # справка, статус, напоминания
+
+# Метрики Prometheus: GET /metrics на отдельном порту (0 — выключены)
+METRICS_LISTEN = os.getenv("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+# Как часто пересчитывать число пользователей по состояниям (в секундах)
+METRICS_STATE_TTL = float(os.getenv("METRICS_STATE_TTL", "30"))
+
+# Профилирование: администраторы (id через запятую) могут включать его командой /profile
+ADMIN_IDS = {int(user_id) for user_id in os.getenv("ADMIN_IDS", "").split(",") if user_id.strip()}
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+# Профилирование с запуска: "sample:60" или "cprofile:60:0.1" (режим:секунды[:доля обновлений])
+PROFILE_ON_START = os.getenv("PROFILE", "")
+PROFILE_MAX_WINDOW = 600
+# Обновления дольше порога (мс) пишутся в лог с разбивкой по шагам (0 — выключено)
+SLOW_UPDATE_MS = float(os.getenv("SLOW_UPDATE_MS", "500"))
+
+# Отложенная групповая запись логов (state_log, feedback_log, sessions)
+# Строки копятся в памяти и пишутся пакетами: раз в INTERVAL_MS или по BATCH_SIZE строк
+WRITE_BEHIND = os.getenv("WRITE_BEHIND", "0") == "1"
+WRITE_BEHIND_INTERVAL_MS = int(os.getenv("WRITE_BEHIND_INTERVAL_MS", "50"))
+WRITE_BEHIND_BATCH_SIZE = int(os.getenv("WRITE_BEHIND_BATCH_SIZE", "500"))
+WRITE_BEHIND_MAX_QUEUE = int(os.getenv("WRITE_BEHIND_MAX_QUEUE", "10000"))
+# Повторы пакета при временной ошибке SQLite (занята, нет места, ввод-вывод)
+# с паузой 50 мс, растущей вдвое до 2 сек; затем пакет теряется (dropped_rows)
+WRITE_BEHIND_RETRIES = int(os.getenv("WRITE_BEHIND_RETRIES", "10"))
+
+# Профили хранилища (PRAGMA соединений SQLite)
+# cache_size в КиБ со знаком минус, mmap_size в байтах, busy_timeout в мс
+STORAGE_PROFILES = {
+    'durable': {
+        'journal_mode': 'WAL',
+        'synchronous': 'FULL',
+        'cache_size': -16000,
+        'mmap_size': 0,
+        'busy_timeout': 5000
+    },
+    'balanced': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'cache_size': -64000,
+        'mmap_size': 256 * 1024 * 1024,
+        'busy_timeout': 5000
+    },
+    'fast': {
+        'journal_mode': 'WAL',
+        'synchronous': 'OFF',
+        'cache_size': -256000,
+        'mmap_size': 1024 * 1024 * 1024,
+        'busy_timeout': 10000
+    },
+    # Поведение до перехода на WAL: журнал отката и синхронная запись
+    'legacy': {
+        'journal_mode': 'DELETE',
+        'synchronous': 'FULL',
+        'cache_size': -2000,
+        'mmap_size': 0,
+        'busy_timeout': 5000
+    }
+}
+DB_PROFILE = os.getenv("DB_PROFILE", "balanced")
+
+# Бэкенд хранилища: sqlite — файл DB_NAME, memory — в памяти процесса (тесты, нагрузочные прогоны)
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "sqlite")
+
+# Размер пула соединений только для чтения (статистика, аналитика, /status)
+DB_READERS = int(os.getenv("DB_READERS", "4"))
+
+# Кэш записей пользователей: максимум записей (0 — выключен) и TTL в секундах (0 — без TTL)
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "100000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "0"))
+
+# Выгрузка логов: размер порции строк (память экспорта от размера таблицы не зависит)
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+
+# Таблицы логов, доступные для выгрузки, и их столбцы (id — ключ инкрементальной выгрузки)
+EXPORT_TABLES = {
+    'feedback_log': ('id', 'telegram_user_id', 'feedback_type', 'discomfort_detail',
+                     'session_number', 'created_at'),
+    'sessions': ('id', 'telegram_user_id', 'session_number', 'start_time', 'end_time',
+                 'duration_seconds', 'created_at'),
+    'state_log': ('id', 'telegram_user_id', 'state', 'created_at')
+}
+
+# Хранение логов: строки state_log и feedback_log старше RETENTION_DAYS суток
+# сворачиваются в дневные сводки, переносятся в архивные базы ARCHIVE_DIR
+# (по файлу на таблицу и месяц) и удаляются пакетами по RETENTION_BATCH_SIZE строк
+RETENTION_DAYS = int(os.getenv("RETENTION_DAYS", "0"))  # 0 — хранить всё (по умолчанию), например 90
+RETENTION_TABLES = ('state_log', 'feedback_log')
+# По умолчанию рядом с файлом БД, а не в текущем каталоге процесса
+ARCHIVE_DIR = os.getenv("ARCHIVE_DIR", os.path.join(os.path.dirname(os.path.abspath(DB_NAME)), "archive"))
+RETENTION_BATCH_SIZE = int(os.getenv("RETENTION_BATCH_SIZE", "2000"))
+RETENTION_INTERVAL = float(os.getenv("RETENTION_INTERVAL", "3600"))  # период проверки, сек
+RETENTION_PAUSE = float(os.getenv("RETENTION_PAUSE", "0.05"))  # пауза между пакетами, сек
+
+# Напоминания: пользователям в S3/S7 без нового сеанса дольше REMINDER_IDLE_HOURS часов
+# раз в сутки (кампания idle-YYYY-MM-DD) отправляется одно напоминание за период простоя;
+# пользователи выбираются порциями по REMINDER_BATCH_SIZE, кампания проверяется раз в REMINDER_INTERVAL сек
+REMINDER_IDLE_HOURS = float(os.getenv("REMINDER_IDLE_HOURS", "0"))  # 0 — выключены (по умолчанию), например 48
+REMINDER_STATES = (STATES['S3_READY_FOR_SESSION'], STATES['S7_REGULAR_USE'])
+REMINDER_BATCH_SIZE = int(os.getenv("REMINDER_BATCH_SIZE", "200"))
+REMINDER_INTERVAL = float(os.getenv("REMINDER_INTERVAL", "3600"))
 
 # Тексты сообщений (нейтральный тон, без медицинских формулировок)
 MESSAGES = {
@@ -83,286 +287,3597 @@ MESSAGES = {
     ),
     'ALREADY_STARTED': "Система уже запущена. Используйте /status для проверки состояния.",
     'NO_PAUSE': "Пауза не активна. Используйте /status для проверки состояния.",
-    'READY_FOR_NEXT': "Готовы к следующему сеансу?"
+    'READY_FOR_NEXT': "Готовы к следующему сеансу?",
+    'REMINDER': "Напоминание: регулярность важнее единичных сеансов. Готовы к следующему сеансу?"
 }
 
+# Читаемые названия состояний для /status
+STATE_NAMES = {
+    STATES['S0_INIT']: "🔄 Инициализация",
+    STATES['S1_CONFIRM_CONDITIONS']: "✅ Подтверждение условий",
+    STATES['S2_CHECK_CONTRAINDICATIONS']: "⚠️ Проверка противопоказаний",
+    STATES['S3_READY_FOR_SESSION']: "🎯 Готов к сеансу",
+    STATES['S4_SESSION_ACTIVE']: "⏳ Сеанс активен",
+    STATES['S5_POST_SESSION']: "📊 После сеанса",
+    STATES['S6_FEEDBACK']: "💭 Обратная связь",
+    STATES['S7_REGULAR_USE']: "📈 Регулярное использование",
+    STATES['S8_PAUSE']: "⏸️ Пауза"
+}
+
+# ==================== ВРЕМЯ ЗАПУСКА ====================
+
+# Накопленное время вложенных фаз для каждой открытой фазы
+_startup_nested: List[float] = []
+
+
+@contextmanager
+def startup_phase(name: str):
+    """Учесть время фазы запуска в STARTUP_TIMINGS (без вложенных фаз)"""
+    started = time.perf_counter()
+    _startup_nested.append(0.0)
+    try:
+        yield
+    finally:
+        nested = _startup_nested.pop()
+        elapsed = time.perf_counter() - started
+        STARTUP_TIMINGS[name] = STARTUP_TIMINGS.get(name, 0.0) + elapsed - nested
+        if _startup_nested:
+            _startup_nested[-1] += elapsed
+
+
+def startup_report() -> str:
+    """Таблица фаз запуска в миллисекундах"""
+    lines = [f"{name:<20}{seconds * 1000:9.1f} мс" for name, seconds in STARTUP_TIMINGS.items()]
+    lines.append(f"{'итого':<20}{sum(STARTUP_TIMINGS.values()) * 1000:9.1f} мс")
+    return '\n'.join(lines)
+
+# ==================== ХРАНИЛИЩЕ ====================
+
+def shard_for(user_id: int, shards: int) -> int:
+    """Шард пользователя в кластере; тот же остаток считается в SQL (load_jobs)"""
+    return user_id % shards
+
+
+class UserRecord(NamedTuple):
+    """Запись users, которую видят обработчики.
+
+    Неизменяемая: кэш и MemoryStorage отдают один и тот же объект без копий,
+    изменения создают новую запись через _replace.
+    """
+    telegram_user_id: int
+    current_state: str
+    session_count: int = 0
+    pause_flag: int = 0
+
+    @classmethod
+    def from_row(cls, row: Tuple) -> 'UserRecord':
+        """Запись из строки (telegram_user_id, current_state, session_count, pause_flag)"""
+        # Имена состояний из SQLite — новые строки на каждую выборку; храним общие
+        return cls(row[0], sys.intern(row[1]), row[2], row[3])
+
+
+@runtime_checkable
+class Storage(Protocol):
+    """Операции хранилища, нужные обработчикам, планировщику и персистентности.
+
+    Методы синхронные: AsyncDatabase вызывает их в выделенном потоке.
+    Бэкенд регистрируется в STORAGE_BACKENDS и выбирается STORAGE_BACKEND;
+    поведение проверяется общим набором storage_conformance.py.
+    concurrent_reads — читающие методы можно вызывать из других потоков
+    параллельно с записью (иначе AsyncDatabase выполняет всё в потоке записи).
+    """
+
+    db_name: str
+    concurrent_reads: bool
+
+    # Пользователи и переходы FSM
+    def get_or_create_user(self, user_id: int) -> UserRecord: ...
+    def get_user(self, user_id: int) -> Optional[UserRecord]: ...
+    def update_user_state(self, user_id: int, state: str): ...
+    def transition(self, user_id: int, new_state: str,
+                   pause: Optional[int] = None,
+                   feedback: Optional[Tuple[str, Optional[str]]] = None,
+                   session: Optional[int] = None,
+                   schedule: Optional['ScheduledJob'] = None,
+                   cancel_jobs: bool = False,
+                   claim: Optional[str] = None,
+                   active: bool = False) -> Optional[UserRecord]: ...
+    def increment_session_count(self, user_id: int) -> int: ...
+    def set_pause_flag(self, user_id: int, pause_value: int) -> int: ...
+
+    # Логи и аналитика
+    def add_feedback(self, user_id: int, feedback_type: str,
+                     discomfort_detail: Optional[str] = None,
+                     session_number: Optional[int] = None): ...
+    def add_session(self, user_id: int, session_number: int, duration: int): ...
+    def log_state(self, user_id: int, state: str): ...
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]: ...
+    def get_analytics(self) -> Dict[str, Any]: ...
+    def count_users_by_state(self) -> Dict[str, int]: ...
+    def rebuild_analytics(self): ...
+    def flush_logs(self): ...
+
+    # Кампании напоминаний
+    def campaign_cursor(self, campaign: str, state: str, cutoff: str) -> Tuple[str, str, int, bool]: ...
+    def idle_users_page(self, state: str, cutoff: str, after_updated_at: str, after_user_id: int,
+                        limit: int) -> List[Tuple[int, str]]: ...
+    def claim_reminders(self, campaign: str, state: str, user_ids: List[int],
+                        after_updated_at: str, after_user_id: int,
+                        last_updated_at: str, last_user_id: int) -> bool: ...
+    def finish_campaign(self, campaign: str, state: str): ...
+
+    # Отложенные задачи
+    def load_jobs(self, shard: Optional[Tuple[int, int]] = None) -> List['ScheduledJob']: ...
+    def claim_job(self, job_key: str) -> bool: ...
+    def recover_active_sessions(self, due_at: float) -> int: ...
+
+    # Персистентность диалогов и user_data
+    def save_persistence(self, user_data: Dict[int, Optional[bytes]],
+                         conversations: Dict[Tuple[str, str], Optional[str]]): ...
+    def load_user_data(self, user_id: int) -> Optional[bytes]: ...
+    def load_conversation(self, name: str, key: str,
+                          user_id: int) -> Tuple[Optional[str], Optional[str]]: ...
+
+    # Служебные счётчики
+    def write_behind_stats(self) -> Optional[Dict[str, Any]]: ...
+    def user_cache_stats(self) -> Optional[Dict[str, Any]]: ...
+    def commit_stats(self) -> Dict[str, int]: ...
+    def close(self): ...
+
+
+@runtime_checkable
+class MaintenanceStorage(Protocol):
+    """Обслуживание схемы и логов: фоновые миграции и очистка по сроку хранения.
+
+    Необязательная часть Storage: бэкенд без схемы и архивов (MemoryStorage)
+    её не реализует, и бот не запускает для него миграции и RetentionWorker.
+    """
+
+    def migrate(self, online: bool = False) -> List[int]: ...
+    def retention_bound(self, table: str, cutoff: str) -> int: ...
+    def read_log_rows(self, table: str, since_id: int, until_id: int, limit: int) -> List[Tuple]: ...
+    def archive_rows(self, table: str, rows: List[Tuple], archive_dir: str = ARCHIVE_DIR) -> List[str]: ...
+    def purge_log_rows(self, table: str, rows: List[Tuple]) -> int: ...
+
 # ==================== БАЗА ДАННЫХ ====================
 
-class Database:
-    """Класс для работы с базой данных SQLite"""
+def apply_pragmas(conn: sqlite3.Connection, profile: str, read_only: bool = False):
+    """Применить PRAGMA профиля хранилища к соединению"""
+    if profile not in STORAGE_PROFILES:
+        raise ValueError(f"Неизвестный профиль хранилища: {profile}")
+    pragmas = STORAGE_PROFILES[profile]
+
+    conn.execute(f"PRAGMA busy_timeout = {int(pragmas['busy_timeout'])}")
+    conn.execute(f"PRAGMA cache_size = {int(pragmas['cache_size'])}")
+    conn.execute(f"PRAGMA mmap_size = {int(pragmas['mmap_size'])}")
+
+    if read_only:
+        conn.execute("PRAGMA query_only = ON")
+    else:
+        # journal_mode хранится в файле БД, поэтому меняется только писателем
+        conn.execute(f"PRAGMA journal_mode = {pragmas['journal_mode']}")
+        conn.execute(f"PRAGMA synchronous = {pragmas['synchronous']}")
+
+
+class UserCache:
+    """Write-through кэш записей users (state, session_count, pause_flag).
+
+    Ограничен по размеру с LRU-вытеснением, опционально с TTL.
+    Согласованность обеспечивают мутаторы Database, которые обновляют кэш
+    после каждой записи. Записи неизменяемы и отдаются без копирования.
+    Потокобезопасен: читается и из пула читателей.
+    """
+
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        # Сроки записей ведутся, только если задан TTL
+        self._expires: Dict[int, float] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        """Получить запись или None при промахе"""
+        with self._lock:
+            record = self._entries.get(user_id)
+            if record is None:
+                self.misses += 1
+                return None
+
+            if self.ttl and self._expires[user_id] < time.monotonic():
+                del self._entries[user_id]
+                del self._expires[user_id]
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(user_id)
+            self.hits += 1
+            return record
+
+    def put(self, user_id: int, record: UserRecord):
+        """Сохранить полную запись пользователя"""
+        with self._lock:
+            self._entries[user_id] = record
+            self._entries.move_to_end(user_id)
+            if self.ttl:
+                self._expires[user_id] = time.monotonic() + self.ttl
+            while len(self._entries) > self.max_size:
+                evicted, _ = self._entries.popitem(last=False)
+                self._expires.pop(evicted, None)
+                self.evictions += 1
+
+    def update(self, user_id: int, **fields):
+        """Обновить поля записи, если она есть в кэше"""
+        with self._lock:
+            record = self._entries.get(user_id)
+            if record is not None:
+                self._entries[user_id] = record._replace(**fields)
+
+    def invalidate(self, user_id: int):
+        """Удалить запись из кэша"""
+        with self._lock:
+            self._entries.pop(user_id, None)
+            self._expires.pop(user_id, None)
+
+    def stats(self) -> Dict[str, Any]:
+        """Статистика попаданий кэша"""
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / total, 4) if total else 0.0
+            }
+
+
+class ReaderPool:
+    """Пул соединений только для чтения.
+
+    В режиме WAL читатели не ждут писателя, поэтому статистика и аналитика
+    выполняются параллельно с записью. Каждое соединение в каждый момент
+    используется одним потоком.
+    """
+
+    def __init__(self, db_name: str, size: int = DB_READERS, profile: str = DB_PROFILE):
+        self.db_name = db_name
+        self._pool: queue.Queue = queue.Queue()
+        self._connections: List[sqlite3.Connection] = []
+
+        uri = f"file:{os.path.abspath(db_name)}?mode=ro"
+        for _ in range(size):
+            conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+            apply_pragmas(conn, profile, read_only=True)
+            self._connections.append(conn)
+            self._pool.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Взять свободное соединение из пула на время блока"""
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            # Завершаем неявную транзакцию чтения, чтобы не удерживать снимок WAL
+            conn.rollback()
+            self._pool.put(conn)
+
+    def close(self):
+        """Закрыть все соединения пула"""
+        for conn in self._connections:
+            conn.close()
+
+
+class LogReader:
+    """Постраничное чтение таблиц лога для выгрузки.
+
+    connection — контекстный менеджер, выдающий соединение для чтения:
+    у Database это его пул читателей, export.py передаёт собственный
+    ReaderPool и не открывает ни пишущего соединения, ни миграций.
+    """
+
+    def __init__(self, connection: Callable[[], ContextManager[sqlite3.Connection]]):
+        self._read = connection
+
+    def max_log_id(self, table: str) -> int:
+        """Последний id таблицы лога (граница выгрузки)"""
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Таблица недоступна для выгрузки: {table}")
+        with self._read() as conn:
+            return conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    def export_rows(self, table: str, since_id: int = 0, until_id: Optional[int] = None,
+                    chunk_size: int = EXPORT_CHUNK_SIZE) -> Iterator[List[Tuple]]:
+        """Строки таблицы лога с since_id < id <= until_id порциями по chunk_size.
+
+        Keyset-пагинация по первичному ключу: каждая порция — отдельное короткое
+        чтение через пул читателей, снимок WAL не удерживается между порциями,
+        и писатель бота не ждёт выгрузку.
+        """
+        if until_id is None:
+            until_id = self.max_log_id(table)
+
+        last_id = since_id
+        while last_id < until_id:
+            rows = self.read_log_rows(table, last_id, until_id, chunk_size)
+            if not rows:
+                break
+            yield rows
+            last_id = rows[-1][0]
+
+    def read_log_rows(self, table: str, since_id: int, until_id: int, limit: int) -> List[Tuple]:
+        """Одна порция строк таблицы лога с since_id < id <= until_id по возрастанию id"""
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"Таблица недоступна для выгрузки: {table}")
+        with self._read() as conn:
+            return conn.execute(
+                f"SELECT {', '.join(EXPORT_TABLES[table])} FROM {table} "
+                f"WHERE id > ? AND id <= ? ORDER BY id LIMIT ?",
+                (since_id, until_id, limit)
+            ).fetchall()
+
+
+class WriteBehindQueue:
+    """Очередь отложенной записи append-only таблиц.
+
+    Строки пишутся отдельным потоком с собственным соединением пакетами
+    executemany в одной транзакции: каждые interval_ms или по batch_size строк,
+    смотря что наступит раньше. Очередь ограничена max_queue строками,
+    при переполнении put блокирует вызывающего (backpressure).
+
+    Пакет, не записанный из-за временной ошибки, повторяется с растущей
+    паузой до retries раз; при ошибке в данных строки пишутся по одной,
+    и теряются только негодные. Каждая ошибка учитывается в flush_errors,
+    потерянные строки — в dropped_rows.
+    """
+
+    RETRY_DELAY = 0.05
+    RETRY_MAX_DELAY = 2.0
+
+    def __init__(self, db_name: str,
+                 interval_ms: int = WRITE_BEHIND_INTERVAL_MS,
+                 batch_size: int = WRITE_BEHIND_BATCH_SIZE,
+                 max_queue: int = WRITE_BEHIND_MAX_QUEUE,
+                 profile: str = DB_PROFILE,
+                 retries: int = WRITE_BEHIND_RETRIES):
+        self.db_name = db_name
+        self.profile = profile
+        self.interval = interval_ms / 1000
+        self.batch_size = batch_size
+        self.retries = retries
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._stopped = threading.Event()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            'enqueued_rows': 0,
+            'flushed_rows': 0,
+            'flushes': 0,
+            'flush_errors': 0,
+            'dropped_rows': 0,
+            'backpressure_waits': 0,
+            'last_flush_ms': 0.0,
+            'max_flush_ms': 0.0,
+            'total_flush_ms': 0.0
+        }
+        self._thread = threading.Thread(target=self._run, name='db-write-behind', daemon=True)
+        self._thread.start()
+
+    def put(self, sql: str, params: Tuple):
+        """Поставить строку в очередь (блокирует при переполнении)"""
+        if self._stopped.is_set():
+            raise RuntimeError("Очередь отложенной записи остановлена")
+        try:
+            self._queue.put_nowait((sql, params))
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['backpressure_waits'] += 1
+            self._queue.put((sql, params))
+        with self._stats_lock:
+            self._stats['enqueued_rows'] += 1
+
+    def flush(self):
+        """Дождаться записи всех строк, поставленных в очередь"""
+        self._queue.join()
+
+    def stats(self) -> Dict[str, Any]:
+        """Счётчики очереди: глубина, число строк и латентность сбросов"""
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['queue_depth'] = self._queue.qsize()
+        return stats
+
+    def close(self):
+        """Сбросить очередь и остановить поток записи"""
+        if self._stopped.is_set():
+            return
+        self.flush()
+        self._stopped.set()
+        self._thread.join()
+
+    def _take_batch(self) -> List[Tuple[str, Tuple]]:
+        """Собрать пакет: ждём первую строку, затем добираем до дедлайна или batch_size"""
+        try:
+            batch = [self._queue.get(timeout=self.interval)]
+        except queue.Empty:
+            return []
+
+        deadline = time.monotonic() + self.interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _write(self, conn: sqlite3.Connection, batch: List[Tuple[str, Tuple]]):
+        """Записать пакет одной транзакцией, группируя строки по запросу"""
+        grouped: Dict[str, List[Tuple]] = {}
+        for sql, params in batch:
+            grouped.setdefault(sql, []).append(params)
+
+        try:
+            self._write_grouped(conn, grouped, len(batch))
+        finally:
+            for _ in batch:
+                self._queue.task_done()
+
+    def _write_grouped(self, conn: sqlite3.Connection, grouped: Dict[str, List[Tuple]], size: int):
+        delay = self.RETRY_DELAY
+        attempt = 0
+        while True:
+            started = time.perf_counter()
+            try:
+                with conn:
+                    for sql, rows in grouped.items():
+                        conn.executemany(sql, rows)
+                break
+            except sqlite3.OperationalError as e:
+                self._count_error(f"Ошибка групповой записи логов ({size} строк, попытка {attempt + 1}): {e}")
+                attempt += 1
+                if attempt > self.retries:
+                    logging.error(f"Пакет логов потерян после {attempt} попыток: {size} строк")
+                    with self._stats_lock:
+                        self._stats['dropped_rows'] += size
+                    return
+                time.sleep(delay)
+                delay = min(delay * 2, self.RETRY_MAX_DELAY)
+            except sqlite3.Error as e:
+                # Повтор не поможет: пишем по строке, чтобы не потерять весь пакет
+                self._count_error(f"Ошибка групповой записи логов ({size} строк), запись по строкам: {e}")
+                self._write_rows(conn, grouped)
+                return
+
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._stats_lock:
+            self._stats['flushed_rows'] += size
+            self._stats['flushes'] += 1
+            self._stats['last_flush_ms'] = elapsed_ms
+            self._stats['max_flush_ms'] = max(self._stats['max_flush_ms'], elapsed_ms)
+            self._stats['total_flush_ms'] += elapsed_ms
+
+    def _write_rows(self, conn: sqlite3.Connection, grouped: Dict[str, List[Tuple]]):
+        """Записать строки по одной; негодные пропускаются и учитываются в dropped_rows"""
+        written = dropped = 0
+        for sql, rows in grouped.items():
+            for params in rows:
+                try:
+                    with conn:
+                        conn.execute(sql, params)
+                    written += 1
+                except sqlite3.Error as e:
+                    logging.error(f"Строка лога не записана: {e}; {params!r}")
+                    dropped += 1
+        with self._stats_lock:
+            self._stats['flushed_rows'] += written
+            self._stats['dropped_rows'] += dropped
+
+    def _count_error(self, message: str):
+        logging.error(message)
+        with self._stats_lock:
+            self._stats['flush_errors'] += 1
+
+    def _run(self):
+        """Цикл потока записи"""
+        conn = sqlite3.connect(self.db_name)
+        apply_pragmas(conn, self.profile)
+        try:
+            while not (self._stopped.is_set() and self._queue.empty()):
+                batch = self._take_batch()
+                if not batch:
+                    continue
+                try:
+                    self._write(conn, batch)
+                except Exception as e:
+                    # Поток записи не должен завершаться: иначе очередь больше не разберётся
+                    self._count_error(f"Сбой записи пакета логов ({len(batch)} строк): {e}")
+                    with self._stats_lock:
+                        self._stats['dropped_rows'] += len(batch)
+        finally:
+            conn.close()
+
+
+class Migration(NamedTuple):
+    """Шаг схемы БД; номер применённого шага хранится в PRAGMA user_version.
+
+    statements выполняются одной транзакцией вместе с записью версии и должны
+    быть идемпотентными (IF NOT EXISTS): база, созданная до появления версий,
+    проходит все шаги. method — метод Database для переноса данных, выполняется
+    своими транзакциями перед записью версии и тоже должен быть идемпотентным.
+    online — сборка индекса на большой таблице: при старте шаг пропускается
+    и выполняется в фоне после запуска. Версия схемы — один номер, поэтому
+    откладываются только фоновые шаги в конце списка; фоновый шаг, за которым
+    есть обычные, выполняется при старте вместе с ними. Индексы, без которых
+    запросы обработчиков просматривают таблицу целиком, фоновыми не делаются.
+    """
+    version: int
+    description: str
+    statements: Tuple[str, ...] = ()
+    method: Optional[str] = None
+    online: bool = False
+
+
+# Шаги только добавляются в конец; применённый шаг не меняется
+SCHEMA_MIGRATIONS: Tuple[Migration, ...] = (
+    Migration(1, "базовая схема", (
+        # Пользователи
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_user_id INTEGER PRIMARY KEY,
+            current_state TEXT DEFAULT 'S0',
+            session_count INTEGER DEFAULT 0,
+            pause_flag INTEGER DEFAULT 0,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # Фидбэки
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER,
+            feedback_type TEXT,
+            discomfort_detail TEXT,
+            session_number INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        )
+        ''',
+        # Сессии
+        '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER,
+            session_number INTEGER,
+            start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            end_time TIMESTAMP,
+            duration_seconds INTEGER,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        )
+        ''',
+        # Лог состояний
+        '''
+        CREATE TABLE IF NOT EXISTS state_log (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            telegram_user_id INTEGER,
+            state TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        )
+        ''',
+        # Отложенные задачи (таймеры сеансов и т.п.), due_at — unix-время
+        '''
+        CREATE TABLE IF NOT EXISTS scheduled_jobs (
+            job_key TEXT PRIMARY KEY,
+            telegram_user_id INTEGER,
+            kind TEXT,
+            due_at REAL,
+            payload TEXT,
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        )
+        ''',
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_jobs_user ON scheduled_jobs(telegram_user_id)",
+        # Персистентность ConversationHandler: ключ и состояние в JSON
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT,
+            conversation_key TEXT,
+            state TEXT,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (name, conversation_key)
+        )
+        ''',
+        # Счётчики аналитики, обновляемые в тех же транзакциях, что и записи
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_counts (
+            telegram_user_id INTEGER,
+            feedback_type TEXT,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (telegram_user_id, feedback_type)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_totals (
+            feedback_type TEXT PRIMARY KEY,
+            count INTEGER DEFAULT 0
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS analytics_totals (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            total_users INTEGER DEFAULT 0,
+            active_users INTEGER DEFAULT 0,
+            session_sum INTEGER DEFAULT 0
+        )
+        ''',
+        # Дневные сводки удалённых по сроку хранения строк state_log и feedback_log;
+        # счётчики аналитики пересчитываются как сырые строки + сводки
+        '''
+        CREATE TABLE IF NOT EXISTS state_daily (
+            day TEXT,
+            state TEXT,
+            transitions INTEGER DEFAULT 0,
+            PRIMARY KEY (day, state)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_daily (
+            day TEXT,
+            feedback_type TEXT,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (day, feedback_type)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS feedback_archived_counts (
+            telegram_user_id INTEGER,
+            feedback_type TEXT,
+            count INTEGER DEFAULT 0,
+            PRIMARY KEY (telegram_user_id, feedback_type)
+        )
+        ''',
+        # Последнее напоминание пользователю и курсор кампании по каждому состоянию
+        '''
+        CREATE TABLE IF NOT EXISTS reminders (
+            telegram_user_id INTEGER PRIMARY KEY,
+            campaign TEXT,
+            sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            count INTEGER DEFAULT 1
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS campaign_progress (
+            campaign TEXT,
+            state TEXT,
+            cutoff TEXT,
+            last_updated_at TEXT DEFAULT '',
+            last_user_id INTEGER DEFAULT 0,
+            claimed INTEGER DEFAULT 0,
+            finished INTEGER DEFAULT 0,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (campaign, state)
+        )
+        ''',
+        # Персистентность context.user_data (pickle, как в PicklePersistence)
+        '''
+        CREATE TABLE IF NOT EXISTS user_data (
+            telegram_user_id INTEGER PRIMARY KEY,
+            data BLOB,
+            updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    )),
+    # Для базы, созданной до появления счётчиков, считаем их по сырым данным
+    Migration(2, "счётчики аналитики по сырым логам", method='_backfill_analytics'),
+    # Не фоновый: по нему /status и статистика читают фидбэки пользователя
+    Migration(3, "индекс feedback_log по пользователю", (
+        "CREATE INDEX IF NOT EXISTS idx_feedback_log_user ON feedback_log(telegram_user_id)",
+    )),
+    # Выборка неактивных для напоминаний: (состояние, пауза, время изменения)
+    Migration(4, "индекс неактивных пользователей", (
+        "CREATE INDEX IF NOT EXISTS idx_users_idle ON users(current_state, pause_flag, updated_at)",
+    ), online=True),
+)
+SCHEMA_VERSION = SCHEMA_MIGRATIONS[-1].version
 
-    def __init__(self, db_name: str = 'product_bot.db'):
+
+class _Rollback(Exception):
+    """Откатить транзакцию Database._transaction без ошибки (коммит не считается)"""
+
+
+class Database:
+    """Класс для работы с базой данных SQLite (бэкенд хранилища sqlite)"""
+
+    # Постоянные тексты запросов: sqlite3 кэширует подготовленные выражения по тексту
+    SQL_TRANSITION = (
+        "UPDATE users SET current_state = ?, pause_flag = COALESCE(?, pause_flag), "
+        "session_count = session_count + ?, updated_at = CURRENT_TIMESTAMP "
+        "WHERE telegram_user_id = ? AND (? = 0 OR pause_flag = 0)"
+    )
+    SQL_SELECT_USER = (
+        "SELECT telegram_user_id, current_state, session_count, pause_flag "
+        "FROM users WHERE telegram_user_id = ?"
+    )
+    SQL_SELECT_COUNTERS = "SELECT session_count, pause_flag FROM users WHERE telegram_user_id = ?"
+    SQL_INSERT_STATE_LOG = "INSERT INTO state_log (telegram_user_id, state) VALUES (?, ?)"
+    SQL_INSERT_FEEDBACK = (
+        "INSERT INTO feedback_log "
+        "(telegram_user_id, feedback_type, discomfort_detail, session_number) "
+        "VALUES (?, ?, ?, ?)"
+    )
+    SQL_INSERT_SESSION = (
+        "INSERT INTO sessions (telegram_user_id, session_number, duration_seconds) "
+        "VALUES (?, ?, ?)"
+    )
+    SQL_SCHEDULE_JOB = (
+        "INSERT OR REPLACE INTO scheduled_jobs "
+        "(job_key, telegram_user_id, kind, due_at, payload) VALUES (?, ?, ?, ?, ?)"
+    )
+    SQL_COUNT_USER = "UPDATE analytics_totals SET total_users = total_users + 1 WHERE id = 1"
+    SQL_COUNT_SESSION = (
+        "UPDATE analytics_totals SET session_sum = session_sum + 1, "
+        "active_users = active_users + ? WHERE id = 1"
+    )
+    SQL_COUNT_USER_FEEDBACK = (
+        "INSERT INTO feedback_counts (telegram_user_id, feedback_type, count) VALUES (?, ?, 1) "
+        "ON CONFLICT (telegram_user_id, feedback_type) DO UPDATE SET count = count + 1"
+    )
+    SQL_COUNT_FEEDBACK = (
+        "INSERT INTO feedback_totals (feedback_type, count) VALUES (?, 1) "
+        "ON CONFLICT (feedback_type) DO UPDATE SET count = count + 1"
+    )
+    SQL_ROLLUP_STATE = (
+        "INSERT INTO state_daily (day, state, transitions) VALUES (?, ?, ?) "
+        "ON CONFLICT (day, state) DO UPDATE SET transitions = transitions + excluded.transitions"
+    )
+    SQL_ROLLUP_FEEDBACK = (
+        "INSERT INTO feedback_daily (day, feedback_type, count) VALUES (?, ?, ?) "
+        "ON CONFLICT (day, feedback_type) DO UPDATE SET count = count + excluded.count"
+    )
+    SQL_ROLLUP_USER_FEEDBACK = (
+        "INSERT INTO feedback_archived_counts (telegram_user_id, feedback_type, count) VALUES (?, ?, ?) "
+        "ON CONFLICT (telegram_user_id, feedback_type) DO UPDATE SET count = count + excluded.count"
+    )
+    # Keyset по (updated_at, id) в порядке индекса idx_users_idle; пропускаются
+    # пользователи, которым уже напоминали после их последнего действия
+    SQL_IDLE_USERS = (
+        "SELECT u.telegram_user_id, u.updated_at FROM users AS u "
+        "LEFT JOIN reminders AS r ON r.telegram_user_id = u.telegram_user_id "
+        "WHERE u.current_state = ? AND u.pause_flag = 0 AND u.updated_at < ? "
+        "AND (u.updated_at, u.telegram_user_id) > (?, ?) "
+        "AND (r.sent_at IS NULL OR r.sent_at < u.updated_at) "
+        "ORDER BY u.updated_at, u.telegram_user_id LIMIT ?"
+    )
+    SQL_CLAIM_REMINDER = (
+        "INSERT INTO reminders (telegram_user_id, campaign) VALUES (?, ?) "
+        "ON CONFLICT (telegram_user_id) DO UPDATE SET campaign = excluded.campaign, "
+        "sent_at = CURRENT_TIMESTAMP, count = count + 1"
+    )
+    SQL_CLAIM_JOB = "DELETE FROM scheduled_jobs WHERE job_key = ?"
+    SQL_CANCEL_USER_JOBS = "DELETE FROM scheduled_jobs WHERE telegram_user_id = ?"
+
+    def __init__(self, db_name: str = DB_NAME,
+                 write_behind: bool = WRITE_BEHIND,
+                 profile: str = DB_PROFILE,
+                 readers: int = DB_READERS,
+                 cache_size: int = USER_CACHE_SIZE,
+                 migrate: bool = True):
         self.db_name = db_name
+        self.profile = profile
         self.conn = None
-        self.cursor = None
-        self.init_database()
-
-    def init_database(self):
-        """Инициализация базы данных и создание таблиц"""
-        self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
-        self.cursor = self.conn.cursor()
-        self._create_tables()
-
-    def _create_tables(self):
-        """Создание необходимых таблиц"""
-
-        # Таблица пользователей
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_user_id INTEGER PRIMARY KEY,
-                current_state TEXT DEFAULT 'S0',
-                session_count INTEGER DEFAULT 0,
-                pause_flag INTEGER DEFAULT 0,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        self.readers: Optional[ReaderPool] = None
+        self.log_writer: Optional[WriteBehindQueue] = None
+        self.users_cache: Optional[UserCache] = UserCache(cache_size) if cache_size > 0 else None
+        self.commits = 0
+        self.init_database(migrate)
+
+        # Читатели и очередь логов подключаются только после создания таблиц
+        if readers > 0 and db_name != ':memory:':
+            self.readers = ReaderPool(db_name, readers, profile)
+        # Параллельно с записью читать можно только через пул: без него _read
+        # отдаёт пишущее соединение, которое нельзя делить между потоками
+        self.concurrent_reads = self.readers is not None
+        if write_behind:
+            self.log_writer = WriteBehindQueue(db_name, profile=profile)
+        self.log_reader = LogReader(self._read)
+
+    def init_database(self, migrate: bool = True):
+        """Открытие базы данных и миграция схемы (кроме фоновых шагов).
+
+        Без migrate схема не меняется: служебные команды работают только
+        с базой, которую уже перевёл на актуальную схему бот или --migrate.
+        """
+        with startup_phase('db_open'):
+            # Единственное пишущее соединение; используется только потоком БД
+            self.conn = sqlite3.connect(self.db_name, check_same_thread=False)
+            apply_pragmas(self.conn, self.profile)
+        if not migrate:
+            missing = [migration.version for migration in self.pending_migrations() if not migration.online]
+            if missing:
+                version = self.schema_version()
+                self.conn.close()
+                raise RuntimeError(f"Схема БД v{version} устарела (нет шагов {missing}): "
+                                   f"запустите бота или bot.py --migrate")
+            return
+        with startup_phase('migrations'):
+            self.migrate()
+
+    @contextmanager
+    def _transaction(self):
+        """Транзакция на пишущем соединении (с подсчётом коммитов).
+
+        raise _Rollback внутри блока откатывает транзакцию и выходит из него.
+        """
+        try:
+            with self.conn:
+                yield
+        except _Rollback:
+            return
+        self.commits += 1
+
+    @contextmanager
+    def _read(self):
+        """Соединение для чтения: из пула читателей или пишущее, если пула нет"""
+        if self.readers:
+            with self.readers.connection() as conn:
+                yield conn
+        else:
+            yield self.conn
+
+    def schema_version(self) -> int:
+        """Номер последней применённой миграции"""
+        return self.conn.execute("PRAGMA user_version").fetchone()[0]
+
+    def pending_migrations(self) -> List[Migration]:
+        """Миграции новее текущей версии схемы"""
+        version = self.schema_version()
+        return [migration for migration in SCHEMA_MIGRATIONS if migration.version > version]
+
+    def migrate(self, online: bool = False) -> List[int]:
+        """Применить недостающие миграции по порядку; возвращает применённые версии.
+
+        Для актуальной схемы это одно чтение PRAGMA user_version.
+        Без online не применяются только фоновые шаги в конце списка:
+        фоновый шаг перед обычным выполняется сразу, иначе задержал бы его.
+        """
+        pending = self.pending_migrations()
+        deferred = 0
+        if not online:
+            while deferred < len(pending) and pending[-1 - deferred].online:
+                deferred += 1
+
+        applied = []
+        for migration in pending[:len(pending) - deferred]:
+            if self._apply_migration(migration):
+                applied.append(migration.version)
+        return applied
+
+    def _apply_migration(self, migration: Migration) -> bool:
+        started = time.perf_counter()
+        if migration.method:
+            getattr(self, migration.method)()
+
+        # BEGIN IMMEDIATE: шаг мог применить другой процесс (обработчик кластера)
+        self.conn.execute("BEGIN IMMEDIATE")
+        try:
+            if self.schema_version() >= migration.version:
+                self.conn.rollback()
+                return False
+            for statement in migration.statements:
+                self.conn.execute(statement)
+            self.conn.execute(f"PRAGMA user_version = {migration.version}")
+            self.conn.commit()
+        except BaseException:
+            self.conn.rollback()
+            raise
+        self.commits += 1
+        logging.info(f"Схема БД v{migration.version} ({migration.description}): "
+                     f"{(time.perf_counter() - started) * 1000:.0f} мс")
+        return True
+
+    def _backfill_analytics(self):
+        """Пересчитать счётчики, если их ещё нет"""
+        if self.conn.execute("SELECT 1 FROM analytics_totals").fetchone() is None:
+            self.rebuild_analytics()
+
+    def get_or_create_user(self, user_id: int) -> UserRecord:
+        """Получить пользователя или создать нового"""
+        if self.users_cache:
+            cached = self.users_cache.get(user_id)
+            if cached is not None:
+                return cached
+
+        user = self.conn.execute(self.SQL_SELECT_USER, (user_id,)).fetchone()
+
+        if not user:
+            # Создаем нового пользователя и логируем начальное состояние
+            with self._transaction():
+                self.conn.execute(
+                    "INSERT INTO users (telegram_user_id) VALUES (?)",
+                    (user_id,)
+                )
+                self.conn.execute(self.SQL_COUNT_USER)
+                self._append(self.SQL_INSERT_STATE_LOG, (user_id, STATES['S0_INIT']))
+
+            record = UserRecord(user_id, STATES['S0_INIT'])
+        else:
+            record = UserRecord.from_row(user)
+
+        if self.users_cache:
+            self.users_cache.put(user_id, record)
+        return record
+
+    def update_user_state(self, user_id: int, state: str):
+        """Обновить состояние пользователя"""
+        self.transition(user_id, state)
+
+    def transition(self, user_id: int, new_state: str,
+                   pause: Optional[int] = None,
+                   feedback: Optional[Tuple[str, Optional[str]]] = None,
+                   session: Optional[int] = None,
+                   schedule: Optional['ScheduledJob'] = None,
+                   cancel_jobs: bool = False,
+                   claim: Optional[str] = None,
+                   active: bool = False) -> Optional[UserRecord]:
+        """Атомарный переход FSM одной транзакцией.
+
+        Обновляет users, пишет state_log и побочные записи:
+        pause — новое значение pause_flag (None — не менять);
+        feedback — (feedback_type, discomfort_detail), номер сессии берётся из users;
+        session — длительность завершённого сеанса: +1 к session_count и запись в sessions;
+        schedule — отложенная задача, сохраняемая вместе с переходом;
+        cancel_jobs — удалить все отложенные задачи пользователя;
+        claim — ключ задачи, которая должна существовать: переход выполняется
+        только если задачу удалось забрать (иначе возвращается None);
+        active — переход только для пользователя не на паузе.
+        Возвращает актуальную запись пользователя; для несуществующего
+        пользователя (и пользователя на паузе при active) — None, и ничего,
+        кроме забранной задачи, не пишется.
+        """
+        with self._transaction():
+            if claim is not None:
+                if self.conn.execute(self.SQL_CLAIM_JOB, (claim,)).rowcount == 0:
+                    return None
+
+            updated = self.conn.execute(
+                self.SQL_TRANSITION,
+                (new_state, pause, 1 if session is not None else 0, user_id, int(active))
+            ).rowcount
+            if updated == 0:
+                return None
+
+            if cancel_jobs:
+                self.conn.execute(self.SQL_CANCEL_USER_JOBS, (user_id,))
+
+            if schedule is not None:
+                self.conn.execute(self.SQL_SCHEDULE_JOB, (
+                    schedule.key, user_id, schedule.kind, schedule.due_at,
+                    json.dumps(schedule.payload, ensure_ascii=False)
+                ))
+
+            session_count, pause_flag = self.conn.execute(self.SQL_SELECT_COUNTERS, (user_id,)).fetchone()
+
+            if session is not None:
+                self._count_session(session_count)
+                self._append(self.SQL_INSERT_SESSION, (user_id, session_count, session))
+
+            if feedback is not None:
+                feedback_type, discomfort_detail = feedback
+                self._count_feedback(user_id, feedback_type)
+                self._append(
+                    self.SQL_INSERT_FEEDBACK,
+                    (user_id, feedback_type, discomfort_detail, session_count)
+                )
+
+            self._append(self.SQL_INSERT_STATE_LOG, (user_id, new_state))
+
+        record = UserRecord(user_id, new_state, session_count, pause_flag)
+        if self.users_cache:
+            self.users_cache.put(user_id, record)
+        return record
+
+    def increment_session_count(self, user_id: int) -> int:
+        """Увеличить счетчик сессий пользователя"""
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE users SET session_count = session_count + 1 WHERE telegram_user_id = ?",
+                (user_id,)
+            )
+            session_count = self.conn.execute(
+                "SELECT session_count FROM users WHERE telegram_user_id = ?",
+                (user_id,)
+            ).fetchone()[0]
+            self._count_session(session_count)
+        if self.users_cache:
+            self.users_cache.update(user_id, session_count=session_count)
+        return session_count
+
+    def set_pause_flag(self, user_id: int, pause_value: int) -> int:
+        """Установить флаг паузы"""
+        self.conn.execute(
+            "UPDATE users SET pause_flag = ? WHERE telegram_user_id = ?",
+            (pause_value, user_id)
+        )
+        self.conn.commit()
+        self.commits += 1
+        if self.users_cache:
+            self.users_cache.update(user_id, pause_flag=pause_value)
+        return pause_value
+
+    def load_jobs(self, shard: Optional[Tuple[int, int]] = None) -> List['ScheduledJob']:
+        """Загрузить отложенные задачи (для восстановления после рестарта)
+
+        shard — (номер, число шардов): только задачи пользователей этого шарда.
+        """
+        sql = "SELECT job_key, telegram_user_id, kind, due_at, payload FROM scheduled_jobs"
+        if shard is None:
+            rows = self.conn.execute(sql).fetchall()
+        else:
+            index, shards = shard
+            rows = self.conn.execute(
+                f"{sql} WHERE telegram_user_id % ? = ?", (shards, index)
+            ).fetchall()
+        return [
+            ScheduledJob(key, user_id, kind, due_at, json.loads(payload or '{}'))
+            for key, user_id, kind, due_at, payload in rows
+        ]
+
+    def claim_job(self, job_key: str) -> bool:
+        """Забрать задачу (удалить из БД); False, если её уже отменили или выполнили"""
+        with self._transaction():
+            return self.conn.execute(self.SQL_CLAIM_JOB, (job_key,)).rowcount > 0
+
+    def recover_active_sessions(self, due_at: float) -> int:
+        """Поставить таймеры пользователям, застрявшим в S4 без задачи
+
+        Нужно для сеансов, начатых до появления персистентного планировщика.
+        Возвращает число восстановленных таймеров.
+        """
+        with self._transaction():
+            cursor = self.conn.execute(
+                """INSERT OR IGNORE INTO scheduled_jobs
+                   (job_key, telegram_user_id, kind, due_at, payload)
+                   SELECT 'session_end:' || telegram_user_id, telegram_user_id,
+                          'session_end', ?, '{}'
+                   FROM users
+                   WHERE current_state = ? AND pause_flag = 0""",
+                (due_at, STATES['S4_SESSION_ACTIVE'])
             )
-        ''')
-
-        # Таблица фидбэков
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS feedback_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER,
-                feedback_type TEXT,
-                discomfort_detail TEXT,
-                session_number INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+        return cursor.rowcount
+
+    def save_persistence(self, user_data: Dict[int, Optional[bytes]],
+                         conversations: Dict[Tuple[str, str], Optional[str]]):
+        """Записать накопленные изменения user_data и диалогов одной транзакцией
+
+        Значение None означает удаление записи.
+        """
+        with self._transaction():
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO user_data (telegram_user_id, data, updated_at) "
+                "VALUES (?, ?, CURRENT_TIMESTAMP)",
+                [(user_id, data) for user_id, data in user_data.items() if data is not None]
             )
-        ''')
-
-        # Таблица сессий
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS sessions (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER,
-                session_number INTEGER,
-                start_time TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                end_time TIMESTAMP,
-                duration_seconds INTEGER,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+            self.conn.executemany(
+                "DELETE FROM user_data WHERE telegram_user_id = ?",
+                [(user_id,) for user_id, data in user_data.items() if data is None]
             )
-        ''')
-
-        # Таблица лога состояний
-        self.cursor.execute('''
-            CREATE TABLE IF NOT EXISTS state_log (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                telegram_user_id INTEGER,
-                state TEXT,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (telegram_user_id) REFERENCES users(telegram_user_id)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO conversations (name, conversation_key, state, updated_at) "
+                "VALUES (?, ?, ?, CURRENT_TIMESTAMP)",
+                [(name, key, state) for (name, key), state in conversations.items()
+                 if state is not None]
+            )
+            self.conn.executemany(
+                "DELETE FROM conversations WHERE name = ? AND conversation_key = ?",
+                [(name, key) for (name, key), state in conversations.items() if state is None]
             )
-        ''')
 
-        self.conn.commit()
+    def load_user_data(self, user_id: int) -> Optional[bytes]:
+        """Прочитать сохранённые user_data пользователя"""
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT data FROM user_data WHERE telegram_user_id = ?",
+                (user_id,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def load_conversation(self, name: str, key: str, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        """Прочитать сохранённое состояние диалога и users.current_state
+
+        Возвращает (состояние диалога в JSON или None, current_state или None).
+        """
+        with self._read() as conn:
+            row = conn.execute(
+                "SELECT state FROM conversations WHERE name = ? AND conversation_key = ?",
+                (name, key)
+            ).fetchone()
+            if row:
+                return row[0], None
+
+            user = conn.execute(
+                "SELECT current_state FROM users WHERE telegram_user_id = ?",
+                (user_id,)
+            ).fetchone()
+        return None, user[0] if user else None
+
+    def _count_session(self, session_count: int):
+        """Учесть завершённый сеанс в счётчиках (внутри транзакции вызывающего)"""
+        self.conn.execute(self.SQL_COUNT_SESSION, (1 if session_count == 1 else 0,))
+
+    def _count_feedback(self, user_id: int, feedback_type: str):
+        """Учесть фидбэк в счётчиках (внутри транзакции вызывающего)"""
+        self.conn.execute(self.SQL_COUNT_USER_FEEDBACK, (user_id, feedback_type))
+        self.conn.execute(self.SQL_COUNT_FEEDBACK, (feedback_type,))
+
+    def rebuild_analytics(self):
+        """Пересчитать счётчики аналитики по сырым таблицам и сводкам удалённых строк"""
+        # Отложенные строки логов должны попасть в таблицы до пересчёта
+        self.flush_logs()
+
+        with self._transaction():
+            self.conn.execute("DELETE FROM analytics_totals")
+            self.conn.execute("DELETE FROM feedback_counts")
+            self.conn.execute("DELETE FROM feedback_totals")
+
+            self.conn.execute(
+                """INSERT INTO analytics_totals (id, total_users, active_users, session_sum)
+                   SELECT 1, COUNT(*),
+                          COALESCE(SUM(CASE WHEN session_count > 0 THEN 1 ELSE 0 END), 0),
+                          COALESCE(SUM(session_count), 0)
+                   FROM users"""
+            )
+            self.conn.execute(
+                """INSERT INTO feedback_counts (telegram_user_id, feedback_type, count)
+                   SELECT telegram_user_id, feedback_type, SUM(count)
+                   FROM (
+                       SELECT telegram_user_id, feedback_type, COUNT(*) AS count
+                       FROM feedback_log
+                       GROUP BY telegram_user_id, feedback_type
+                       UNION ALL
+                       SELECT telegram_user_id, feedback_type, count
+                       FROM feedback_archived_counts
+                   )
+                   GROUP BY telegram_user_id, feedback_type"""
+            )
+            self.conn.execute(
+                """INSERT INTO feedback_totals (feedback_type, count)
+                   SELECT feedback_type, SUM(count)
+                   FROM (
+                       SELECT feedback_type, COUNT(*) AS count
+                       FROM feedback_log
+                       GROUP BY feedback_type
+                       UNION ALL
+                       SELECT feedback_type, count
+                       FROM feedback_daily
+                   )
+                   GROUP BY feedback_type"""
+            )
+
+    def _append(self, sql: str, params: Tuple):
+        """Добавить строку в append-only таблицу.
+
+        В режиме отложенной записи строка уходит в очередь и пишется пакетом,
+        иначе выполняется в текущей транзакции соединения.
+        """
+        if self.log_writer:
+            self.log_writer.put(sql, params)
+        else:
+            self.conn.execute(sql, params)
+
+    def add_feedback(self, user_id: int, feedback_type: str,
+                    discomfort_detail: Optional[str] = None,
+                    session_number: Optional[int] = None):
+        """Добавить запись фидбэка"""
+        with self._transaction():
+            self._count_feedback(user_id, feedback_type)
+            self._append(
+                self.SQL_INSERT_FEEDBACK,
+                (user_id, feedback_type, discomfort_detail, session_number)
+            )
+
+    def add_session(self, user_id: int, session_number: int, duration: int):
+        """Добавить запись о сессии"""
+        with self._transaction():
+            self._append(
+                self.SQL_INSERT_SESSION,
+                (user_id, session_number, duration)
+            )
+
+    def log_state(self, user_id: int, state: str):
+        """Записать состояние в лог"""
+        with self._transaction():
+            self._append(
+                self.SQL_INSERT_STATE_LOG,
+                (user_id, state)
+            )
+
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        """Прочитать пользователя без создания (кэш, затем пул читателей)"""
+        if self.users_cache:
+            cached = self.users_cache.get(user_id)
+            if cached is not None:
+                return cached
+
+        with self._read() as conn:
+            user = conn.execute(self.SQL_SELECT_USER, (user_id,)).fetchone()
+
+        return UserRecord.from_row(user) if user else None
+
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получить статистику пользователя"""
+        with self._read() as conn:
+            stats = conn.execute(
+                "SELECT session_count, pause_flag FROM users WHERE telegram_user_id = ?",
+                (user_id,)
+            ).fetchone()
+
+            feedback_dist = dict(conn.execute(
+                "SELECT feedback_type, count FROM feedback_counts WHERE telegram_user_id = ?",
+                (user_id,)
+            ).fetchall())
+
+        return {
+            'session_count': stats[0] if stats else 0,
+            'pause_flag': stats[1] if stats else 0,
+            'feedback_distribution': feedback_dist
+        }
+
+    def get_analytics(self) -> Dict[str, Any]:
+        """Получить аналитику по всей системе (по счётчикам, без сканирования логов)"""
+        with self._read() as conn:
+            totals = conn.execute(
+                "SELECT total_users, active_users, session_sum FROM analytics_totals WHERE id = 1"
+            ).fetchone()
+            feedback_dist = dict(conn.execute(
+                "SELECT feedback_type, count FROM feedback_totals"
+            ).fetchall())
+
+        total_users, active_users, session_sum = totals or (0, 0, 0)
+        avg_sessions = session_sum / active_users if active_users else 0
+
+        return {
+            'total_users': total_users,
+            'average_sessions': round(avg_sessions, 2),
+            'feedback_distribution': feedback_dist
+        }
+
+    def read_log_rows(self, table: str, since_id: int, until_id: int, limit: int) -> List[Tuple]:
+        """Одна порция строк таблицы лога (см. LogReader.read_log_rows)"""
+        return self.log_reader.read_log_rows(table, since_id, until_id, limit)
+
+    def retention_bound(self, table: str, cutoff: str) -> int:
+        """Граница очистки: id перед первой (по id) строкой не раньше cutoff
+        (UTC, 'YYYY-MM-DD HH:MM:SS').
+
+        Все строки с id не больше границы записаны раньше cutoff при любом
+        порядке created_at, поэтому свежая строка не удаляется. created_at
+        назначается SQLite при вставке и почти всегда растёт вместе с id;
+        если нет (перевод часов, пакеты отложенной записи разных процессов
+        кластера), устаревшие строки после первой свежей остаются до одного
+        из следующих проходов. Просматриваются только устаревшие строки,
+        индекс по created_at не нужен.
+        """
+        if table not in RETENTION_TABLES:
+            raise ValueError(f"Для таблицы не задано хранение: {table}")
+        with self._read() as conn:
+            row = conn.execute(
+                f"SELECT id FROM {table} WHERE created_at >= ? ORDER BY id LIMIT 1",
+                (cutoff,)
+            ).fetchone()
+            if row:
+                return row[0] - 1
+            return conn.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+
+    def archive_rows(self, table: str, rows: List[Tuple], archive_dir: str = ARCHIVE_DIR) -> List[str]:
+        """Скопировать строки лога в архивные базы {table}-YYYY-MM.db по месяцу created_at.
+
+        Пишет в отдельные файлы, а не в рабочую базу, поэтому не занимает писателя.
+        INSERT OR IGNORE по id: повтор после сбоя не создаёт дублей.
+        """
+        columns = EXPORT_TABLES[table]
+        by_month: Dict[str, List[Tuple]] = {}
+        for row in rows:
+            by_month.setdefault(str(row[-1])[:7], []).append(row)
+
+        os.makedirs(archive_dir, exist_ok=True)
+        paths = []
+        for month, month_rows in by_month.items():
+            path = os.path.join(archive_dir, f"{table}-{month}.db")
+            conn = sqlite3.connect(path)
+            try:
+                with conn:
+                    conn.execute(
+                        f"CREATE TABLE IF NOT EXISTS {table} "
+                        f"(id INTEGER PRIMARY KEY, {', '.join(columns[1:])})"
+                    )
+                    conn.executemany(
+                        f"INSERT OR IGNORE INTO {table} ({', '.join(columns)}) "
+                        f"VALUES ({', '.join('?' * len(columns))})",
+                        month_rows
+                    )
+            finally:
+                conn.close()
+            paths.append(path)
+        return paths
+
+    def purge_log_rows(self, table: str, rows: List[Tuple]) -> int:
+        """Свернуть строки лога в дневные сводки и удалить их одной короткой транзакцией.
+
+        rows — порция из read_log_rows (непрерывный диапазон id), уже перенесённая
+        в архив. Сводки и удаление в одной транзакции: строка либо учтена
+        в сводке и удалена, либо осталась в логе.
+        """
+        if table not in RETENTION_TABLES:
+            raise ValueError(f"Для таблицы не задано хранение: {table}")
+        if not rows:
+            return 0
+
+        with self._transaction():
+            deleted = self.conn.execute(
+                f"DELETE FROM {table} WHERE id >= ? AND id <= ?",
+                (rows[0][0], rows[-1][0])
+            ).rowcount
+            if deleted != len(rows):
+                # Порцию уже свернул другой процесс (перекрытие при передаче приёма)
+                deleted = 0
+                raise _Rollback
+
+            if table == 'state_log':
+                per_day = Counter((str(row[3])[:10], row[2]) for row in rows)
+                self.conn.executemany(
+                    self.SQL_ROLLUP_STATE,
+                    [(day, state, count) for (day, state), count in per_day.items()]
+                )
+            else:
+                per_day = Counter((str(row[5])[:10], row[2]) for row in rows)
+                per_user = Counter((row[1], row[2]) for row in rows)
+                self.conn.executemany(
+                    self.SQL_ROLLUP_FEEDBACK,
+                    [(day, feedback_type, count) for (day, feedback_type), count in per_day.items()]
+                )
+                self.conn.executemany(
+                    self.SQL_ROLLUP_USER_FEEDBACK,
+                    [(user_id, feedback_type, count) for (user_id, feedback_type), count in per_user.items()]
+                )
+        return deleted
+
+    def count_users_by_state(self) -> Dict[str, int]:
+        """Число пользователей в каждом состоянии (для метрик)"""
+        with self._read() as conn:
+            return dict(conn.execute(
+                "SELECT current_state, COUNT(*) FROM users GROUP BY current_state"
+            ).fetchall())
+
+    def campaign_cursor(self, campaign: str, state: str, cutoff: str) -> Tuple[str, str, int, bool]:
+        """Курсор кампании по состоянию: (cutoff, last_updated_at, last_user_id, finished).
+
+        При первом обращении кампания создаётся с переданной границей простоя,
+        при возобновлении возвращаются сохранённые граница и позиция.
+        """
+        with self._transaction():
+            self.conn.execute(
+                "INSERT OR IGNORE INTO campaign_progress (campaign, state, cutoff) VALUES (?, ?, ?)",
+                (campaign, state, cutoff)
+            )
+            row = self.conn.execute(
+                "SELECT cutoff, last_updated_at, last_user_id, finished FROM campaign_progress "
+                "WHERE campaign = ? AND state = ?",
+                (campaign, state)
+            ).fetchone()
+        return row[0], row[1], row[2], bool(row[3])
+
+    def idle_users_page(self, state: str, cutoff: str, after_updated_at: str, after_user_id: int,
+                        limit: int) -> List[Tuple[int, str]]:
+        """Порция неактивных пользователей состояния после курсора: [(id, updated_at)]
+
+        Только не на паузе, без изменений с cutoff и без напоминания
+        после последнего изменения.
+        """
+        with self._read() as conn:
+            return conn.execute(
+                self.SQL_IDLE_USERS,
+                (state, cutoff, after_updated_at, after_user_id, limit)
+            ).fetchall()
+
+    def claim_reminders(self, campaign: str, state: str, user_ids: List[int],
+                        after_updated_at: str, after_user_id: int,
+                        last_updated_at: str, last_user_id: int) -> bool:
+        """Отметить напоминания порции и сдвинуть курсор одной транзакцией.
+
+        Вызывается до отправки: после сбоя порция не отправляется повторно
+        (пропущенное напоминание лучше дубля). Курсор сдвигается, только если
+        он всё ещё (after_updated_at, after_user_id); иначе порцию уже забрал
+        другой процесс — ничего не отмечается, результат False.
+        """
+        with self._transaction():
+            moved = self.conn.execute(
+                "UPDATE campaign_progress SET last_updated_at = ?, last_user_id = ?, "
+                "claimed = claimed + ?, updated_at = CURRENT_TIMESTAMP "
+                "WHERE campaign = ? AND state = ? AND last_updated_at = ? AND last_user_id = ?",
+                (last_updated_at, last_user_id, len(user_ids), campaign, state,
+                 after_updated_at, after_user_id)
+            ).rowcount
+            if moved:
+                self.conn.executemany(self.SQL_CLAIM_REMINDER, [(user_id, campaign) for user_id in user_ids])
+        return bool(moved)
+
+    def finish_campaign(self, campaign: str, state: str):
+        """Отметить состояние кампании пройденным"""
+        with self._transaction():
+            self.conn.execute(
+                "UPDATE campaign_progress SET finished = 1, updated_at = CURRENT_TIMESTAMP "
+                "WHERE campaign = ? AND state = ?",
+                (campaign, state)
+            )
+
+    def flush_logs(self):
+        """Дождаться записи отложенных строк логов"""
+        if self.log_writer:
+            self.log_writer.flush()
+
+    def write_behind_stats(self) -> Optional[Dict[str, Any]]:
+        """Счётчики очереди отложенной записи (None, если режим выключен)"""
+        return self.log_writer.stats() if self.log_writer else None
 
-    def get_or_create_user(self, user_id: int) -> Dict[str, Any]:
+    def user_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Статистика кэша пользователей (None, если кэш выключен)"""
+        return self.users_cache.stats() if self.users_cache else None
+
+    def commit_stats(self) -> Dict[str, int]:
+        """Число коммитов: пишущее соединение и пакеты отложенной записи"""
+        return {
+            'commits': self.commits,
+            'log_flushes': self.log_writer.stats()['flushes'] if self.log_writer else 0
+        }
+
+    def close(self):
+        """Закрыть соединение с базой данных"""
+        if self.log_writer:
+            self.log_writer.close()
+        if self.readers:
+            self.readers.close()
+        if self.conn:
+            self.conn.close()
+
+
+class MemoryStorage:
+    """Хранилище в памяти процесса (бэкенд memory) для тестов и нагрузочных прогонов.
+
+    Повторяет семантику Database, включая счётчики аналитики и логи
+    (строки в формате EXPORT_TABLES), но ничего не пишет на диск и не
+    переживает рестарт. Не потокобезопасно: AsyncDatabase выполняет
+    все вызовы в одном потоке.
+    """
+
+    concurrent_reads = False
+
+    def __init__(self, db_name: str = ':memory:', **options):
+        # Параметры SQLite (профиль, читатели, кэш, отложенная запись) не нужны
+        self.db_name = db_name
+        self.users: Dict[int, UserRecord] = {}
+        self.logs: Dict[str, List[Tuple]] = {table: [] for table in EXPORT_TABLES}
+        self.jobs: Dict[str, 'ScheduledJob'] = {}
+        self.conversations: Dict[Tuple[str, str], str] = {}
+        self.user_data: Dict[int, bytes] = {}
+        self.feedback_counts: Counter = Counter()
+        self.feedback_totals: Counter = Counter()
+        self.totals = {'total_users': 0, 'active_users': 0, 'session_sum': 0}
+        self.updated_at: Dict[int, str] = {}
+        self.reminders: Dict[int, str] = {}
+        self.campaigns: Dict[Tuple[str, str], Dict[str, Any]] = {}
+        self.commits = 0
+
+    @staticmethod
+    def _now() -> str:
+        """Время в формате CURRENT_TIMESTAMP SQLite"""
+        return datetime.now(timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+
+    def _log(self, table: str, *values):
+        rows = self.logs[table]
+        rows.append((len(rows) + 1, *values))
+
+    def _log_state(self, user_id: int, state: str):
+        self._log('state_log', user_id, state, self._now())
+
+    def _log_feedback(self, user_id: int, feedback_type: str,
+                      discomfort_detail: Optional[str], session_number: Optional[int]):
+        self.feedback_counts[(user_id, feedback_type)] += 1
+        self.feedback_totals[feedback_type] += 1
+        self._log('feedback_log', user_id, feedback_type, discomfort_detail, session_number, self._now())
+
+    def _count_session(self, session_count: int):
+        self.totals['session_sum'] += 1
+        if session_count == 1:
+            self.totals['active_users'] += 1
+
+    def get_or_create_user(self, user_id: int) -> UserRecord:
         """Получить пользователя или создать нового"""
-        self.cursor.execute(
-            "SELECT * FROM users WHERE telegram_user_id = ?",
-            (user_id,)
+        user = self.users.get(user_id)
+        if user is None:
+            user = self.users[user_id] = UserRecord(user_id, STATES['S0_INIT'])
+            self.updated_at[user_id] = self._now()
+            self.totals['total_users'] += 1
+            self._log_state(user_id, STATES['S0_INIT'])
+            self.commits += 1
+        return user
+
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        """Прочитать пользователя без создания"""
+        return self.users.get(user_id)
+
+    def update_user_state(self, user_id: int, state: str):
+        """Обновить состояние пользователя"""
+        self.transition(user_id, state)
+
+    def transition(self, user_id: int, new_state: str,
+                   pause: Optional[int] = None,
+                   feedback: Optional[Tuple[str, Optional[str]]] = None,
+                   session: Optional[int] = None,
+                   schedule: Optional['ScheduledJob'] = None,
+                   cancel_jobs: bool = False,
+                   claim: Optional[str] = None,
+                   active: bool = False) -> Optional[UserRecord]:
+        """Переход FSM с побочными записями (см. Database.transition)"""
+        if claim is not None and self.jobs.pop(claim, None) is None:
+            return None
+        user = self.users.get(user_id)
+        if user is None or (active and user.pause_flag):
+            return None
+        if cancel_jobs:
+            self._cancel_user_jobs(user_id)
+        if schedule is not None:
+            self.jobs[schedule.key] = schedule._replace(user_id=user_id, payload=dict(schedule.payload))
+
+        user = self.users[user_id] = user._replace(
+            current_state=new_state,
+            pause_flag=user.pause_flag if pause is None else pause,
+            session_count=user.session_count + (session is not None)
+        )
+        self.updated_at[user_id] = self._now()
+        session_count, pause_flag = user.session_count, user.pause_flag
+
+        if session is not None:
+            self._count_session(session_count)
+            self._log('sessions', user_id, session_count, self._now(), None, session, self._now())
+        if feedback is not None:
+            feedback_type, discomfort_detail = feedback
+            self._log_feedback(user_id, feedback_type, discomfort_detail, session_count)
+        self._log_state(user_id, new_state)
+        self.commits += 1
+
+        return UserRecord(user_id, new_state, session_count, pause_flag)
+
+    def _cancel_user_jobs(self, user_id: int):
+        for key in [key for key, job in self.jobs.items() if job.user_id == user_id]:
+            del self.jobs[key]
+
+    def increment_session_count(self, user_id: int) -> int:
+        """Увеличить счетчик сессий пользователя"""
+        user = self.users[user_id]
+        user = self.users[user_id] = user._replace(session_count=user.session_count + 1)
+        self._count_session(user.session_count)
+        self.commits += 1
+        return user.session_count
+
+    def set_pause_flag(self, user_id: int, pause_value: int) -> int:
+        """Установить флаг паузы"""
+        if user_id in self.users:
+            self.users[user_id] = self.users[user_id]._replace(pause_flag=pause_value)
+        self.commits += 1
+        return pause_value
+
+    def add_feedback(self, user_id: int, feedback_type: str,
+                     discomfort_detail: Optional[str] = None,
+                     session_number: Optional[int] = None):
+        """Добавить запись фидбэка"""
+        self._log_feedback(user_id, feedback_type, discomfort_detail, session_number)
+        self.commits += 1
+
+    def add_session(self, user_id: int, session_number: int, duration: int):
+        """Добавить запись о сессии"""
+        self._log('sessions', user_id, session_number, self._now(), None, duration, self._now())
+        self.commits += 1
+
+    def log_state(self, user_id: int, state: str):
+        """Записать состояние в лог"""
+        self._log_state(user_id, state)
+        self.commits += 1
+
+    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        """Получить статистику пользователя"""
+        user = self.users.get(user_id)
+        return {
+            'session_count': user.session_count if user else 0,
+            'pause_flag': user.pause_flag if user else 0,
+            'feedback_distribution': {
+                feedback_type: count
+                for (owner, feedback_type), count in self.feedback_counts.items()
+                if owner == user_id
+            }
+        }
+
+    def get_analytics(self) -> Dict[str, Any]:
+        """Получить аналитику по всей системе"""
+        active_users = self.totals['active_users']
+        avg_sessions = self.totals['session_sum'] / active_users if active_users else 0
+        return {
+            'total_users': self.totals['total_users'],
+            'average_sessions': round(avg_sessions, 2),
+            'feedback_distribution': dict(self.feedback_totals)
+        }
+
+    def count_users_by_state(self) -> Dict[str, int]:
+        """Число пользователей в каждом состоянии"""
+        return dict(Counter(user.current_state for user in self.users.values()))
+
+    def campaign_cursor(self, campaign: str, state: str, cutoff: str) -> Tuple[str, str, int, bool]:
+        """Курсор кампании по состоянию (создаётся при первом обращении)"""
+        progress = self.campaigns.setdefault((campaign, state), {
+            'cutoff': cutoff, 'last_updated_at': '', 'last_user_id': 0, 'claimed': 0, 'finished': False
+        })
+        return progress['cutoff'], progress['last_updated_at'], progress['last_user_id'], progress['finished']
+
+    def idle_users_page(self, state: str, cutoff: str, after_updated_at: str, after_user_id: int,
+                        limit: int) -> List[Tuple[int, str]]:
+        """Порция неактивных пользователей состояния после курсора"""
+        page = sorted(
+            (self.updated_at[user_id], user_id)
+            for user_id, user in self.users.items()
+            if user.current_state == state and not user.pause_flag
+            and self.updated_at[user_id] < cutoff
+            and (self.updated_at[user_id], user_id) > (after_updated_at, after_user_id)
+            and self.reminders.get(user_id, '') < self.updated_at[user_id]
+        )[:limit]
+        return [(user_id, updated_at) for updated_at, user_id in page]
+
+    def claim_reminders(self, campaign: str, state: str, user_ids: List[int],
+                        after_updated_at: str, after_user_id: int,
+                        last_updated_at: str, last_user_id: int) -> bool:
+        """Отметить напоминания порции и сдвинуть курсор, если он не сдвинут другим"""
+        progress = self.campaigns[(campaign, state)]
+        if (progress['last_updated_at'], progress['last_user_id']) != (after_updated_at, after_user_id):
+            return False
+        now = self._now()
+        for user_id in user_ids:
+            self.reminders[user_id] = now
+        progress.update(last_updated_at=last_updated_at, last_user_id=last_user_id)
+        progress['claimed'] += len(user_ids)
+        self.commits += 1
+        return True
+
+    def finish_campaign(self, campaign: str, state: str):
+        """Отметить состояние кампании пройденным"""
+        self.campaigns[(campaign, state)]['finished'] = True
+        self.commits += 1
+
+    def rebuild_analytics(self):
+        """Пересчитать счётчики аналитики по пользователям и логу фидбэков"""
+        session_counts = [user.session_count for user in self.users.values()]
+        self.totals = {
+            'total_users': len(session_counts),
+            'active_users': sum(1 for count in session_counts if count > 0),
+            'session_sum': sum(session_counts)
+        }
+        self.feedback_counts = Counter((row[1], row[2]) for row in self.logs['feedback_log'])
+        self.feedback_totals = Counter(row[2] for row in self.logs['feedback_log'])
+        self.commits += 1
+
+    def flush_logs(self):
+        """Логи пишутся сразу, ждать нечего"""
+
+    def load_jobs(self, shard: Optional[Tuple[int, int]] = None) -> List['ScheduledJob']:
+        """Отложенные задачи (все или одного шарда)"""
+        if shard is None:
+            return list(self.jobs.values())
+        index, shards = shard
+        return [job for job in self.jobs.values() if shard_for(job.user_id, shards) == index]
+
+    def claim_job(self, job_key: str) -> bool:
+        """Забрать задачу; False, если её уже отменили или выполнили"""
+        return self.jobs.pop(job_key, None) is not None
+
+    def recover_active_sessions(self, due_at: float) -> int:
+        """Поставить таймеры пользователям в S4 без задачи"""
+        recovered = 0
+        for user_id, user in self.users.items():
+            key = f"session_end:{user_id}"
+            if user.current_state == STATES['S4_SESSION_ACTIVE'] and not user.pause_flag \
+                    and key not in self.jobs:
+                self.jobs[key] = ScheduledJob(key, user_id, 'session_end', due_at, {})
+                recovered += 1
+        return recovered
+
+    def save_persistence(self, user_data: Dict[int, Optional[bytes]],
+                         conversations: Dict[Tuple[str, str], Optional[str]]):
+        """Применить изменения user_data и диалогов (None — удаление)"""
+        for user_id, data in user_data.items():
+            if data is None:
+                self.user_data.pop(user_id, None)
+            else:
+                self.user_data[user_id] = data
+        for key, state in conversations.items():
+            if state is None:
+                self.conversations.pop(key, None)
+            else:
+                self.conversations[key] = state
+        self.commits += 1
+
+    def load_user_data(self, user_id: int) -> Optional[bytes]:
+        """Сохранённые user_data пользователя"""
+        return self.user_data.get(user_id)
+
+    def load_conversation(self, name: str, key: str, user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        """Состояние диалога или, если его нет, users.current_state"""
+        state = self.conversations.get((name, key))
+        if state is not None:
+            return state, None
+        user = self.users.get(user_id)
+        return None, user.current_state if user else None
+
+    def write_behind_stats(self) -> Optional[Dict[str, Any]]:
+        return None
+
+    def user_cache_stats(self) -> Optional[Dict[str, Any]]:
+        return None
+
+    def commit_stats(self) -> Dict[str, int]:
+        return {'commits': self.commits, 'log_flushes': 0}
+
+    def close(self):
+        """Данные в памяти не требуют закрытия"""
+
+
+# Бэкенды хранилища по имени STORAGE_BACKEND; сетевой SQL-бэкенд добавляется сюда же
+STORAGE_BACKENDS: Dict[str, Callable[..., Storage]] = {
+    'sqlite': Database,
+    'memory': MemoryStorage
+}
+
+
+def create_storage(backend: str = STORAGE_BACKEND, db_name: str = DB_NAME, **options) -> Storage:
+    """Создать хранилище выбранного бэкенда"""
+    if backend not in STORAGE_BACKENDS:
+        raise ValueError(
+            f"Неизвестный бэкенд хранилища: {backend} (доступны: {', '.join(STORAGE_BACKENDS)})"
         )
-        user = self.cursor.fetchone()
+    return STORAGE_BACKENDS[backend](db_name, **options)
+
+
+class AsyncDatabase:
+    """Асинхронный доступ к хранилищу (Storage).
+
+    Все запросы выполняются в выделенном потоке БД, которому принадлежит
+    соединение SQLite, поэтому медленный commit/fsync не блокирует event loop.
+    """
+
+    def __init__(self, db_name: str = DB_NAME, readers: int = DB_READERS,
+                 backend: str = STORAGE_BACKEND, **options):
+        self.db_name = db_name
+        self.backend = backend
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='db-writer')
+        # Соединение создаётся в потоке БД и используется только им
+        self._db: Storage = self._executor.submit(
+            create_storage, backend, db_name, readers=readers, **options
+        ).result()
+        # Чтения идут через пул читателей в отдельных потоках и не ждут записи;
+        # бэкенд без параллельного чтения читает в том же потоке, что и пишет
+        if self._db.concurrent_reads:
+            self._read_executor = ThreadPoolExecutor(
+                max_workers=max(readers, 1),
+                thread_name_prefix='db-reader'
+            )
+        else:
+            self._read_executor = self._executor
+
+    def submit(self, method: str, *args, **kwargs) -> Future:
+        """Поставить вызов метода Database в очередь потока БД"""
+        return self._executor.submit(getattr(self._db, method), *args, **kwargs)
+
+    def call(self, method: str, *args, **kwargs) -> Any:
+        """Синхронный вызов метода Database (для кода вне event loop)"""
+        return self.submit(method, *args, **kwargs).result()
+
+    @property
+    def maintenance(self) -> bool:
+        """Бэкенд поддерживает миграции и очистку логов (MaintenanceStorage)"""
+        return isinstance(self._db, MaintenanceStorage)
+
+    def call_read(self, method: str, *args, **kwargs) -> Any:
+        """Синхронный вызов читающего метода Database через пул читателей"""
+        return self._read_executor.submit(getattr(self._db, method), *args, **kwargs).result()
+
+    async def _run(self, method: str, *args, **kwargs) -> Any:
+        """Выполнить метод Database в потоке БД и дождаться результата"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                self._executor,
+                functools.partial(getattr(self._db, method), *args, **kwargs)
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_LATENCY.observe(elapsed, (method,))
+            record_step(f"db {method}", elapsed)
+
+    async def _read(self, method: str, *args, **kwargs) -> Any:
+        """Выполнить читающий метод Database в потоке пула читателей"""
+        loop = asyncio.get_running_loop()
+        started = time.perf_counter()
+        try:
+            return await loop.run_in_executor(
+                self._read_executor,
+                functools.partial(getattr(self._db, method), *args, **kwargs)
+            )
+        finally:
+            elapsed = time.perf_counter() - started
+            DB_LATENCY.observe(elapsed, (method,))
+            record_step(f"db {method}", elapsed)
+
+    async def get_or_create_user(self, user_id: int) -> UserRecord:
+        return await self._run('get_or_create_user', user_id)
+
+    async def update_user_state(self, user_id: int, state: str):
+        return await self._run('update_user_state', user_id, state)
+
+    async def transition(self, user_id: int, new_state: str,
+                         pause: Optional[int] = None,
+                         feedback: Optional[Tuple[str, Optional[str]]] = None,
+                         session: Optional[int] = None,
+                         schedule: Optional['ScheduledJob'] = None,
+                         cancel_jobs: bool = False,
+                         claim: Optional[str] = None,
+                         active: bool = False) -> Optional[UserRecord]:
+        return await self._run('transition', user_id, new_state,
+                               pause=pause, feedback=feedback, session=session,
+                               schedule=schedule, cancel_jobs=cancel_jobs, claim=claim,
+                               active=active)
+
+    async def load_jobs(self, shard: Optional[Tuple[int, int]] = None) -> List['ScheduledJob']:
+        return await self._run('load_jobs', shard)
+
+    async def save_persistence(self, user_data: Dict[int, Optional[bytes]],
+                               conversations: Dict[Tuple[str, str], Optional[str]]):
+        return await self._run('save_persistence', user_data, conversations)
+
+    async def load_user_data(self, user_id: int) -> Optional[bytes]:
+        return await self._read('load_user_data', user_id)
+
+    async def load_conversation(self, name: str, key: str,
+                                user_id: int) -> Tuple[Optional[str], Optional[str]]:
+        return await self._read('load_conversation', name, key, user_id)
+
+    async def claim_job(self, job_key: str) -> bool:
+        return await self._run('claim_job', job_key)
+
+    async def recover_active_sessions(self, due_at: float) -> int:
+        return await self._run('recover_active_sessions', due_at)
+
+    async def increment_session_count(self, user_id: int) -> int:
+        return await self._run('increment_session_count', user_id)
+
+    async def set_pause_flag(self, user_id: int, pause_value: int) -> int:
+        return await self._run('set_pause_flag', user_id, pause_value)
+
+    async def add_feedback(self, user_id: int, feedback_type: str,
+                           discomfort_detail: Optional[str] = None,
+                           session_number: Optional[int] = None):
+        return await self._run('add_feedback', user_id, feedback_type,
+                               discomfort_detail, session_number)
+
+    async def add_session(self, user_id: int, session_number: int, duration: int):
+        return await self._run('add_session', user_id, session_number, duration)
+
+    async def log_state(self, user_id: int, state: str):
+        return await self._run('log_state', user_id, state)
+
+    async def get_user(self, user_id: int) -> Optional[UserRecord]:
+        return await self._read('get_user', user_id)
+
+    async def get_user_stats(self, user_id: int) -> Dict[str, Any]:
+        return await self._read('get_user_stats', user_id)
+
+    async def get_analytics(self) -> Dict[str, Any]:
+        return await self._read('get_analytics')
+
+    async def count_users_by_state(self) -> Dict[str, int]:
+        return await self._read('count_users_by_state')
+
+    async def migrate(self, online: bool = False) -> List[int]:
+        return await self._run('migrate', online)
+
+    async def campaign_cursor(self, campaign: str, state: str, cutoff: str) -> Tuple[str, str, int, bool]:
+        return await self._run('campaign_cursor', campaign, state, cutoff)
+
+    async def idle_users_page(self, state: str, cutoff: str, after_updated_at: str, after_user_id: int,
+                              limit: int) -> List[Tuple[int, str]]:
+        return await self._read('idle_users_page', state, cutoff, after_updated_at, after_user_id, limit)
+
+    async def claim_reminders(self, campaign: str, state: str, user_ids: List[int],
+                              after_updated_at: str, after_user_id: int,
+                              last_updated_at: str, last_user_id: int) -> bool:
+        return await self._run('claim_reminders', campaign, state, user_ids,
+                               after_updated_at, after_user_id, last_updated_at, last_user_id)
+
+    async def finish_campaign(self, campaign: str, state: str):
+        return await self._run('finish_campaign', campaign, state)
+
+    async def flush_logs(self):
+        return await self._run('flush_logs')
+
+    async def rebuild_analytics(self):
+        return await self._run('rebuild_analytics')
+
+    async def retention_bound(self, table: str, cutoff: str) -> int:
+        return await self._read('retention_bound', table, cutoff)
+
+    async def read_log_rows(self, table: str, since_id: int, until_id: int, limit: int) -> List[Tuple]:
+        return await self._read('read_log_rows', table, since_id, until_id, limit)
+
+    async def archive_rows(self, table: str, rows: List[Tuple], archive_dir: str = ARCHIVE_DIR) -> List[str]:
+        # Запись в архивные файлы идёт в потоке читателей, писатель не занят
+        return await self._read('archive_rows', table, rows, archive_dir)
+
+    async def purge_log_rows(self, table: str, rows: List[Tuple]) -> int:
+        return await self._run('purge_log_rows', table, rows)
+
+    def write_behind_stats(self) -> Optional[Dict[str, Any]]:
+        """Счётчики очереди отложенной записи (читаются без потока БД)"""
+        return self._db.write_behind_stats()
+
+    def user_cache_stats(self) -> Optional[Dict[str, Any]]:
+        """Статистика кэша пользователей (читается без потока БД)"""
+        return self._db.user_cache_stats()
+
+    def commit_stats(self) -> Dict[str, int]:
+        """Счётчики коммитов (читаются без потока БД)"""
+        return self._db.commit_stats()
+
+    def close(self):
+        """Закрыть соединение в потоке БД и остановить поток"""
+        if self._read_executor is not self._executor:
+            self._read_executor.shutdown(wait=True)
+        self.call('close')
+        self._executor.shutdown(wait=True)
+
+# ==================== ХРАНЕНИЕ ЛОГОВ ====================
+
+class RetentionWorker:
+    """Фоновая очистка state_log и feedback_log по сроку хранения.
+
+    Строки старше retention_days суток (граница — начало суток UTC, чтобы
+    сутки сворачивались целиком) обрабатываются порциями: чтение и запись
+    в архив — в потоках читателей, сводка и удаление — одной короткой
+    транзакцией в потоке БД. Между порциями пауза, поэтому записи бота
+    не ждут очистку дольше одной порции. Выгрузку export.py очистка не ждёт:
+    строки, удалённые раньше инкрементальной выгрузки, есть только в архиве.
+    """
+
+    def __init__(self, db: AsyncDatabase,
+                 retention_days: int = RETENTION_DAYS,
+                 archive_dir: str = ARCHIVE_DIR,
+                 batch_size: int = RETENTION_BATCH_SIZE,
+                 interval: float = RETENTION_INTERVAL,
+                 pause: float = RETENTION_PAUSE):
+        self.db = db
+        self.retention_days = retention_days
+        self.archive_dir = archive_dir
+        self.batch_size = batch_size
+        self.interval = interval
+        self.pause = pause
+        self.purged: Dict[str, int] = {table: 0 for table in RETENTION_TABLES}
+        self.last_run: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def cutoff(self) -> str:
+        """Граница хранения в формате CURRENT_TIMESTAMP SQLite (UTC)"""
+        day = datetime.now(timezone.utc).date() - timedelta(days=self.retention_days)
+        return f"{day.isoformat()} 00:00:00"
+
+    async def run_once(self) -> Dict[str, int]:
+        """Один проход по всем таблицам; возвращает число удалённых строк"""
+        if self.retention_days <= 0:
+            return {}
+        cutoff = self.cutoff()
+        result = {}
+        for table in RETENTION_TABLES:
+            bound = await self.db.retention_bound(table, cutoff)
+            deleted = 0
+            while True:
+                rows = await self.db.read_log_rows(table, 0, bound, self.batch_size)
+                if not rows:
+                    break
+                await self.db.archive_rows(table, rows, self.archive_dir)
+                deleted += await self.db.purge_log_rows(table, rows)
+                await asyncio.sleep(self.pause)
+            self.purged[table] += deleted
+            result[table] = deleted
+        self.last_run = time.time()
+        if any(result.values()):
+            logging.info(f"Хранение логов: до {cutoff} удалено {result}, архив в {self.archive_dir}")
+        return result
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                await self.run_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка очистки логов: {e}")
+            await asyncio.sleep(self.interval)
+
+# ==================== ПЛАНИРОВЩИК ====================
+
+class ScheduledJob(NamedTuple):
+    """Отложенная задача: ключ, пользователь, тип, время (unix) и параметры"""
+    key: str
+    user_id: int
+    kind: str
+    due_at: float
+    payload: Dict[str, Any]
+
+
+def delayed_message(user_id: int, delay: float, text: str,
+                    keyboard: Optional[str] = None,
+                    next_state: Optional[str] = None) -> ScheduledJob:
+    """Задача "отправить сообщение и выполнить переход через delay секунд"
+
+    keyboard — состояние, клавиатура которого прикладывается к сообщению;
+    next_state — состояние, в которое пользователь переводится при отправке.
+    """
+    return ScheduledJob(
+        key=f"message:{user_id}",
+        user_id=user_id,
+        kind='delayed_message',
+        due_at=time.time() + delay,
+        payload={'text': text, 'keyboard': keyboard, 'next_state': next_state}
+    )
+
+
+class JobScheduler:
+    """Единый планировщик отложенных задач вместо отдельной asyncio-задачи на сеанс.
+
+    Задачи хранятся в куче по времени срабатывания (O(log n) на постановку),
+    отменённые записи кучи пропускаются лениво. Время срабатывания сохраняется
+    в SQLite вместе с переходом FSM, поэтому после рестарта задачи
+    восстанавливаются, а просроченные срабатывают сразу. Задача выполняется
+    обработчиком своего типа, который забирает её из БД атомарно вместе с переходом.
+    """
+
+    def __init__(self, db: AsyncDatabase, shard: Optional[Tuple[int, int]] = None):
+        self.db = db
+        # В кластере обработчик отвечает только за задачи пользователей своего шарда
+        self.shard = shard
+        self.bot = None
+        self._heap: List[Tuple[float, int, str]] = []
+        self._jobs: Dict[str, Tuple[int, ScheduledJob]] = {}
+        self._user_jobs: Dict[int, Set[str]] = {}
+        self._handlers: Dict[str, Callable[[ScheduledJob, Any], Awaitable[None]]] = {}
+        self._seq = 0
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._running: Set[asyncio.Task] = set()
+
+    def __len__(self) -> int:
+        return len(self._jobs)
+
+    def register(self, kind: str, handler: Callable[[ScheduledJob, Any], Awaitable[None]]):
+        """Зарегистрировать обработчик для типа задач"""
+        self._handlers[kind] = handler
+
+    def add(self, job: ScheduledJob):
+        """Поставить задачу в очередь (в БД она сохраняется вызывающим через transition)"""
+        self._seq += 1
+        self._jobs[job.key] = (self._seq, job)
+        self._user_jobs.setdefault(job.user_id, set()).add(job.key)
+        heapq.heappush(self._heap, (job.due_at, self._seq, job.key))
+
+        # Будим цикл, только если новая задача стала ближайшей
+        if self._heap[0][2] == job.key:
+            self._wakeup.set()
+
+    def cancel(self, key: str):
+        """Отменить задачу по ключу (запись в куче удалится лениво)"""
+        entry = self._jobs.pop(key, None)
+        if entry is not None:
+            user_keys = self._user_jobs.get(entry[1].user_id)
+            if user_keys is not None:
+                user_keys.discard(key)
+                if not user_keys:
+                    del self._user_jobs[entry[1].user_id]
+
+    def cancel_user(self, user_id: int):
+        """Отменить все задачи пользователя"""
+        for key in list(self._user_jobs.get(user_id, ())):
+            self.cancel(key)
+
+    async def start(self, bot):
+        """Восстановить задачи из БД и запустить цикл планировщика"""
+        self.bot = bot
+        recovered = await self.db.recover_active_sessions(time.time())
+        if recovered:
+            logging.info(f"Восстановлено таймеров сеансов без задачи: {recovered}")
+
+        for job in await self.db.load_jobs(self.shard):
+            self.add(job)
+        logging.info(f"Планировщик запущен, задач в очереди: {len(self)}")
+
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Остановить цикл; задачи остаются в БД и восстановятся при следующем старте.
+
+        Уже сработавшие задачи дорабатывают не дольше timeout, затем прерываются.
+        """
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+        if self._running:
+            _, pending = await asyncio.wait(self._running, timeout=timeout)
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    async def _run(self):
+        """Цикл: спим до ближайшей задачи или до появления более ранней"""
+        while True:
+            self._wakeup.clear()
+            now = time.time()
+
+            while self._heap and self._heap[0][0] <= now:
+                _, seq, key = heapq.heappop(self._heap)
+                entry = self._jobs.get(key)
+                if entry is None or entry[0] != seq:
+                    continue
+                self.cancel(key)
+                task = asyncio.create_task(self._fire(entry[1]))
+                self._running.add(task)
+                task.add_done_callback(self._running.discard)
+
+            timeout = self._heap[0][0] - now if self._heap else None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _fire(self, job: ScheduledJob):
+        """Выполнить задачу обработчиком её типа"""
+        handler = self._handlers.get(job.kind)
+        if handler is None:
+            logging.error(f"Нет обработчика для задачи типа {job.kind}")
+            return
+
+        started = time.perf_counter()
+        try:
+            await handler(job, self.bot)
+        except Exception as e:
+            logging.error(f"Ошибка при выполнении задачи {job.key}: {e}")
+        finally:
+            JOB_LATENCY.observe(time.perf_counter() - started, (job.kind,))
+
+# ==================== ПЕРСИСТЕНТНОСТЬ ДИАЛОГОВ ====================
+
+# Состояние диалога, восстанавливаемое из users.current_state при холодном старте.
+# Из S7 пользователь уходит в S3 отложенным сообщением, поэтому диалог ждёт S3.
+CONVERSATION_STATE_BY_USER_STATE = {
+    STATES['S7_REGULAR_USE']: STATES['S3_READY_FOR_SESSION']
+}
+
+
+def compact(container, removed: int):
+    """Пересобрать dict или set на месте, если удалённых ключей не меньше оставшихся.
+
+    Таблица dict/set не уменьшается при удалении ключей: после выгрузки
+    простаивающих память освобождается только пересборкой.
+    """
+    if removed and removed >= len(container):
+        items = container.copy()
+        container.clear()
+        container.update(items)
+
+
+class SQLitePersistence(BasePersistence):
+    """Персистентность PTB в собственной SQLite базе бота.
+
+    Хранит состояния ConversationHandler и context.user_data. Изменения
+    копятся в памяти и пишутся одной транзакцией раз в flush_interval
+    секунд, а не на каждое обновление. Данные читаются лениво: user_data —
+    при первом обновлении пользователя, диалог — через rehydrate_conversation.
+    Время последнего обновления каждого пользователя ведёт IdleUserEvictor.
+    """
+
+    # Ключи user_data прежних версий вида {ключ: {user_id: значение}} -> плоский ключ
+    LEGACY_USER_DATA_KEYS = {'current_question_index': 'question', 'discomfort_detail_needed': 'discomfort'}
+
+    def __init__(self, db: AsyncDatabase, flush_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, callback_data=False),
+            update_interval=flush_interval
+        )
+        self.db = db
+        self.flush_interval = flush_interval
+        self._dirty_users: Dict[int, Optional[bytes]] = {}
+        self._dirty_conversations: Dict[Tuple[str, str], Optional[str]] = {}
+        # user_id -> время последнего обновления (monotonic); порядок — от давних к недавним
+        self._last_seen: Dict[int, float] = {}
+        self._flush_task: Optional[asyncio.Task] = None
+
+    @staticmethod
+    def conversation_key(key: Tuple[int, ...]) -> str:
+        """Сериализация ключа диалога"""
+        return json.dumps(list(key))
+
+    # --- чтение ---
+
+    async def get_user_data(self) -> Dict[int, Dict[str, Any]]:
+        # user_data загружаются лениво в refresh_user_data
+        return {}
+
+    async def get_chat_data(self) -> Dict[int, Any]:
+        return {}
+
+    async def get_bot_data(self) -> Dict[str, Any]:
+        return {}
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> Dict[Tuple[int, ...], object]:
+        # Диалоги восстанавливаются лениво через rehydrate_conversation
+        return {}
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict[str, Any]):
+        """Подгрузить сохранённые user_data при первом обращении пользователя
+        (и первом после выгрузки из памяти)"""
+        # Переставляем в конец: словарь остаётся упорядоченным по времени обновления
+        loaded = self._last_seen.pop(user_id, None) is not None
+        self._last_seen[user_id] = time.monotonic()
+        if loaded:
+            return
+
+        data = await self.db.load_user_data(user_id)
+        if data:
+            # Значения, уже изменённые в этом процессе, не перетираем
+            for key, value in self._flatten(user_id, pickle.loads(data)).items():
+                user_data.setdefault(key, value)
+
+    @classmethod
+    def _flatten(cls, user_id: int, data: Dict[str, Any]) -> Dict[str, Any]:
+        """Перевести вложенные ключи прежних версий в плоские"""
+        for legacy, key in cls.LEGACY_USER_DATA_KEYS.items():
+            nested = data.pop(legacy, None)
+            if isinstance(nested, dict) and user_id in nested:
+                data.setdefault(key, nested[user_id])
+        return data
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Any):
+        pass
+
+    async def refresh_bot_data(self, bot_data: Any):
+        pass
+
+    async def load_conversation_state(self, name: str, key: Tuple[int, ...],
+                                      user_id: int) -> Optional[object]:
+        """Состояние диалога из таблицы conversations или из users.current_state"""
+        stored, user_state = await self.db.load_conversation(
+            name, self.conversation_key(key), user_id
+        )
+        if stored is not None:
+            return json.loads(stored)
+        if user_state is None or user_state == STATES['S0_INIT']:
+            return None
+        return CONVERSATION_STATE_BY_USER_STATE.get(user_state, user_state)
+
+    # --- запись (пакетами) ---
+
+    async def update_user_data(self, user_id: int, data: Dict[str, Any]):
+        # Пустые user_data (вне анкеты) не храним: строка удаляется
+        self._dirty_users[user_id] = pickle.dumps(data) if data else None
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int):
+        self._dirty_users[user_id] = None
+        self._last_seen.pop(user_id, None)
+        self._schedule_flush()
+
+    async def update_conversation(self, name: str, key: Tuple[int, ...],
+                                  new_state: Optional[object]):
+        state = json.dumps(new_state) if new_state is not None else None
+        self._dirty_conversations[(name, self.conversation_key(key))] = state
+        self._schedule_flush()
+
+    async def update_chat_data(self, chat_id: int, data: Any):
+        pass
+
+    async def update_bot_data(self, data: Any):
+        pass
+
+    async def update_callback_data(self, data: Any):
+        pass
+
+    async def drop_chat_data(self, chat_id: int):
+        pass
+
+    def _schedule_flush(self):
+        """Запланировать пакетную запись, если она ещё не запланирована"""
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(self.flush_interval)
+        await self._write_dirty()
+
+    async def _write_dirty(self):
+        """Записать накопленные изменения одной транзакцией"""
+        if not self._dirty_users and not self._dirty_conversations:
+            return
+        users, self._dirty_users = self._dirty_users, {}
+        conversations, self._dirty_conversations = self._dirty_conversations, {}
+        try:
+            await self.db.save_persistence(users, conversations)
+        except Exception as e:
+            logging.error(f"Ошибка записи персистентных данных: {e}")
+            # Возвращаем несохранённое, не затирая более свежие изменения
+            for user_id, data in users.items():
+                self._dirty_users.setdefault(user_id, data)
+            for key, state in conversations.items():
+                self._dirty_conversations.setdefault(key, state)
+
+    async def flush(self):
+        """Записать всё несохранённое (вызывается PTB при остановке)"""
+        if self._flush_task and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self._write_dirty()
+
+    # --- простаивающие пользователи ---
+
+    def resident_users(self) -> int:
+        """Пользователи, чьи данные загружены в память"""
+        return len(self._last_seen)
+
+    def idle_users(self, idle_seconds: float) -> List[int]:
+        """Пользователи без обновлений дольше idle_seconds, все изменения которых записаны в БД"""
+        cutoff = time.monotonic() - idle_seconds
+        pending = set(self._dirty_users)
+        pending.update(json.loads(key)[-1] for _, key in self._dirty_conversations)
+        idle = []
+        for user_id, seen in self._last_seen.items():
+            if seen >= cutoff:
+                break
+            if user_id not in pending:
+                idle.append(user_id)
+        return idle
+
+    def forget(self, user_ids: Iterable[int]):
+        """Снять отметку загрузки: следующее обновление снова прочитает user_data из БД"""
+        removed = sum(self._last_seen.pop(user_id, None) is not None for user_id in user_ids)
+        compact(self._last_seen, removed)
+
+
+class PTBInternals:
+    """Единственное место, где бот обращается к закрытым полям PTB.
+
+    Публичного API для этого нет: ConversationHandler не умеет восстановить
+    одно состояние, не отметив его для записи в персистентность, а Application —
+    выгрузить user_data из памяти, не удалив их из БД (drop_user_data удаляет).
+    Поля проверены на python-telegram-bot VERSION, requirements.txt закрепляет
+    её точно; check() при запуске проверяет, что поля на месте.
+    """
+
+    VERSION = "22.6"
+
+    @classmethod
+    def check(cls, application: Application, conversation: ConversationHandler):
+        """Проверить поля после application.initialize() (тогда PTB создаёт TrackingDict диалогов)"""
+        from telegram import __version__ as version
+        if version != cls.VERSION:
+            logging.warning(f"python-telegram-bot {version}, закрытые поля проверены на {cls.VERSION}")
+        conversations = getattr(conversation, '_conversations', None)
+        missing = []
+        if not isinstance(getattr(application, '_user_data', None), dict):
+            missing.append('Application._user_data')
+        if not (hasattr(conversations, 'update_no_track') and isinstance(getattr(conversations, 'data', None), dict)):
+            missing.append('ConversationHandler._conversations')
+        if missing:
+            raise RuntimeError(f"В python-telegram-bot {version} нет полей {', '.join(missing)}")
+
+    @staticmethod
+    def has_conversation(conversation: ConversationHandler, key: Tuple[int, ...]) -> bool:
+        return key in conversation._conversations
+
+    @staticmethod
+    def restore_conversation(conversation: ConversationHandler, key: Tuple[int, ...], state: object):
+        """Вернуть состояние в память без отметки записи в персистентность"""
+        conversation._conversations.update_no_track({key: state})
+
+    @staticmethod
+    def drop_conversations(conversation: ConversationHandler, keys: Iterable[Tuple[int, ...]]) -> int:
+        """Удалить состояния из памяти (мимо TrackingDict, в БД они остаются)"""
+        data = conversation._conversations.data
+        dropped = sum(data.pop(key, None) is not None for key in keys)
+        compact(data, dropped)
+        return dropped
+
+    @staticmethod
+    def drop_user_data(application: Application, user_ids: Iterable[int]) -> int:
+        """Удалить user_data из памяти (Application.drop_user_data удалил бы их и из БД)"""
+        user_data = application._user_data
+        dropped = sum(user_data.pop(user_id, None) is not None for user_id in user_ids)
+        compact(user_data, dropped)
+        return dropped
+
+
+class PersistentConversationHandler(ConversationHandler):
+    """ConversationHandler с ленивым восстановлением диалогов из SQLite"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._checked_keys: Set[Tuple[int, ...]] = set()
+
+    async def rehydrate_conversation(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Восстановить состояние диалога при первом обновлении пользователя
+
+        Вызывается до ConversationHandler (группа -1), поэтому пользователь
+        после рестарта продолжает с того же шага, а не начинает с /start.
+        """
+        if not (update.effective_user and update.effective_chat):
+            return
+
+        key = (update.effective_chat.id, update.effective_user.id)
+        if key in self._checked_keys:
+            return
+        self._checked_keys.add(key)
+        if PTBInternals.has_conversation(self, key):
+            return
+
+        state = await context.application.persistence.load_conversation_state(
+            self.name, key, update.effective_user.id
+        )
+        if state is not None:
+            PTBInternals.restore_conversation(self, key, state)
+
+    def evict(self, user_ids: Set[int]) -> int:
+        """Выгрузить диалоги пользователей из памяти; возвращает число диалогов.
+
+        Состояния уже записаны в БД, поэтому удаляются без отметки записи
+        и восстановятся через rehydrate_conversation.
+        """
+        keys = [key for key in self._checked_keys if key[-1] in user_ids]
+        for key in keys:
+            self._checked_keys.discard(key)
+        compact(self._checked_keys, len(keys))
+        return PTBInternals.drop_conversations(self, keys)
+
+
+class IdleUserEvictor:
+    """Выгрузка из памяти данных пользователей, давно не присылавших обновлений.
+
+    PTB держит user_data и состояния диалогов каждого, кто когда-либо писал
+    боту. Раз в interval секунд данные пользователей без обновлений дольше
+    idle_seconds удаляются из памяти, но не из БД: следующее обновление
+    прочитает их заново (refresh_user_data, rehydrate_conversation).
+    Пользователи с ещё не записанными изменениями пропускаются до следующей проверки.
+    """
+
+    def __init__(self, persistence: SQLitePersistence, conversation: PersistentConversationHandler,
+                 idle_seconds: float = USER_IDLE_EVICT,
+                 interval: float = USER_EVICT_INTERVAL):
+        self.persistence = persistence
+        self.conversation = conversation
+        self.idle_seconds = idle_seconds
+        self.interval = interval
+        self.evicted = 0
+        self._task: Optional[asyncio.Task] = None
+
+    async def run_once(self, application: Application) -> int:
+        """Одна проверка; возвращает число выгруженных пользователей"""
+        # Изменения, ещё не переданные PTB в персистентность, становятся видимыми для idle_users
+        await application.update_persistence()
+        user_ids = set(self.persistence.idle_users(self.idle_seconds))
+        if not user_ids:
+            return 0
+
+        PTBInternals.drop_user_data(application, user_ids)
+        conversations = self.conversation.evict(user_ids)
+        self.persistence.forget(user_ids)
+        self.evicted += len(user_ids)
+        logging.info(f"Выгружены из памяти простаивающие пользователи: {len(user_ids)} "
+                     f"(диалогов {conversations}), в памяти {self.persistence.resident_users()}")
+        return len(user_ids)
+
+    def start(self, application: Application):
+        self._task = asyncio.create_task(self._run(application))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, application: Application):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.run_once(application)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка выгрузки простаивающих пользователей: {e}")
+
+# ==================== ДИСПЕТЧЕР ОБНОВЛЕНИЙ ====================
+
+class _Lane:
+    """Последовательная полоса обработки одного пользователя"""
+    __slots__ = ('lock', 'depth')
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.depth = 0
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обработчик обновлений с полосами по effective_user.id.
+
+    Обновления одного пользователя выполняются строго в порядке поступления
+    (asyncio.Lock справедлив), поэтому два нажатия не гонятся в одном
+    обработчике. Полосы разных пользователей работают параллельно, общее
+    число одновременно выполняемых обработчиков ограничено max_concurrent.
+    Ожидание в своей полосе не занимает общий слот.
+    """
+
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES,
+                 max_pending: int = MAX_PENDING_UPDATES,
+                 profiler: Optional['UpdateProfiler'] = None):
+        # Семафор базового класса ограничивает обновления в работе и ожидании
+        super().__init__(max_pending)
+        self.max_concurrent = max_concurrent
+        self.profiler = profiler
+        self._limit = asyncio.Semaphore(max_concurrent)
+        self._lanes: Dict[int, _Lane] = {}
+        # Задачи обновлений в обработке и ожидании полосы (для прерывания при завершении)
+        self._tasks: Set[asyncio.Task] = set()
+        self.processed = 0
+        self.in_flight = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]):
+        task = asyncio.current_task()
+        self._tasks.add(task)
+        try:
+            await self._process(update, coroutine)
+        finally:
+            self._tasks.discard(task)
+
+    async def _process(self, update: object, coroutine: Awaitable[Any]):
+        user = getattr(update, 'effective_user', None)
+        if user is None:
+            await self._execute(update, coroutine, time.perf_counter())
+            return
+
+        lane = self._lanes.get(user.id)
+        if lane is None:
+            lane = self._lanes[user.id] = _Lane()
+        lane.depth += 1
+        queued_at = time.perf_counter()
+        try:
+            async with lane.lock:
+                await self._execute(update, coroutine, queued_at)
+        finally:
+            lane.depth -= 1
+            if lane.depth == 0:
+                del self._lanes[user.id]
+
+    async def _execute(self, update: object, coroutine: Awaitable[Any], queued_at: float):
+        """Выполнить обработку в пределах общего лимита, учитывая время ожидания"""
+        async with self._limit:
+            started = time.perf_counter()
+            waited = started - queued_at
+            self.wait_total += waited
+            self.wait_max = max(self.wait_max, waited)
+            self.in_flight += 1
+
+            trace = [] if SLOW_UPDATE_MS > 0 else None
+            token = UPDATE_TRACE.set(trace)
+            profile = self.profiler.begin_update() if self.profiler else None
+            try:
+                await coroutine
+            finally:
+                if profile is not None:
+                    self.profiler.end_update(profile)
+                UPDATE_TRACE.reset(token)
+                self.in_flight -= 1
+                self.processed += 1
+
+                elapsed = time.perf_counter() - started
+                if trace is not None and elapsed * 1000 >= SLOW_UPDATE_MS:
+                    log_slow_update(update, waited, elapsed, trace)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def cancel_in_flight(self) -> int:
+        """Прервать обновления в обработке и ожидании полосы; возвращает их число"""
+        tasks = [task for task in self._tasks if not task.done()]
+        for task in tasks:
+            task.cancel()
+        return len(tasks)
+
+    def lane_depths(self) -> Dict[int, int]:
+        """Глубина очереди по полосам (только пользователи с обновлениями в работе)"""
+        return {user_id: lane.depth for user_id, lane in self._lanes.items()}
+
+    def stats(self) -> Dict[str, Any]:
+        """Сводка: полосы, их глубина и время ожидания обработки"""
+        depths = [lane.depth for lane in self._lanes.values()]
+        return {
+            'lanes': len(depths),
+            'queued': sum(depths),
+            'max_lane_depth': max(depths, default=0),
+            'in_flight': self.in_flight,
+            'processed': self.processed,
+            'wait_avg_ms': round(self.wait_total / self.processed * 1000, 3) if self.processed else 0.0,
+            'wait_max_ms': round(self.wait_max * 1000, 3)
+        }
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+
+class TokenBucket:
+    """Token bucket с резервированием: каждый запрос получает свой момент отправки"""
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько ждать до появления токена"""
+        self._refill(time.monotonic())
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def reserve(self) -> float:
+        """Занять токен (допускается долг) и вернуть время ожидания"""
+        self._refill(time.monotonic())
+        self.tokens -= 1
+        return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def idle(self) -> bool:
+        """Корзина полна — её состояние можно забыть"""
+        self._refill(time.monotonic())
+        return self.tokens >= self.capacity
+
+
+# Приоритет отправки для сокращений PTB (Message.reply_text и т.п.): они не
+# принимают rate_limit_args; None — приоритет не задан (PRIORITY_NORMAL)
+SEND_PRIORITY: contextvars.ContextVar[Optional[int]] = contextvars.ContextVar(
+    'send_priority', default=None
+)
+
+
+@contextmanager
+def send_priority(priority: int):
+    """Приоритет отправок внутри блока: with send_priority(PRIORITY_LOW): reply_text(...)"""
+    token = SEND_PRIORITY.set(priority)
+    try:
+        yield
+    finally:
+        SEND_PRIORITY.reset(token)
+
+
+class PriorityRateLimiter(BaseRateLimiter[int]):
+    """Очередь исходящих запросов к Bot API с лимитами и приоритетами.
+
+    Лимиты Telegram касаются отправки сообщений: методы SEND_PREFIXES
+    (reply_text, send_message и т.д.) сначала ждут свой слот в корзине чата,
+    затем — глобальный токен, который выдаётся в порядке приоритета
+    (rate_limit_args или send_priority, см. PRIORITY_*). При RetryAfter
+    запрос повторяется через указанную сервером задержку. Служебные вызовы
+    (getUpdates, getMe, setWebhook и т.п.) идут мимо очереди и не учитываются
+    в метриках отправки.
+    """
+
+    SEND_PREFIXES = ('send', 'forward', 'copy', 'edit')
+
+    def __init__(self, global_rate: float = SEND_GLOBAL_RATE,
+                 chat_rate: float = SEND_CHAT_RATE,
+                 chat_burst: int = SEND_CHAT_BURST,
+                 max_retries: int = SEND_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: Dict[Any, TokenBucket] = {}
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = 0
+        self._dispatcher: Optional[asyncio.Task] = None
+        self.stats = {
+            'sent': 0,
+            'retries': 0,
+            'send_errors': 0,
+            'waiting_chat': 0,
+            'latency_total_s': 0.0,
+            'latency_max_s': 0.0
+        }
 
-        if not user:
-            # Создаем нового пользователя
-            self.cursor.execute(
-                "INSERT INTO users (telegram_user_id) VALUES (?)",
-                (user_id,)
-            )
-            self.conn.commit()
+    async def initialize(self):
+        pass
 
-            # Логируем начальное состояние
-            self.log_state(user_id, STATES['S0_INIT'])
+    async def shutdown(self):
+        if self._dispatcher:
+            self._dispatcher.cancel()
+            self._dispatcher = None
 
-            return {
-                'telegram_user_id': user_id,
-                'current_state': STATES['S0_INIT'],
-                'session_count': 0,
-                'pause_flag': 0
-            }
+    def queue_depth(self) -> int:
+        """Запросы, ожидающие отправки (в корзинах чатов и в общей очереди)"""
+        return self.stats['waiting_chat'] + len(self._waiters)
 
+    def metrics(self) -> Dict[str, Any]:
+        """Метрики очереди отправки: глубина, задержка, повторы и ошибки"""
+        sent = self.stats['sent']
         return {
-            'telegram_user_id': user[0],
-            'current_state': user[1],
-            'session_count': user[2],
-            'pause_flag': user[3]
+            'queue_depth': self.queue_depth(),
+            'queue_global': len(self._waiters),
+            'sent': sent,
+            'retries': self.stats['retries'],
+            'send_errors': self.stats['send_errors'],
+            'latency_avg_ms': round(self.stats['latency_total_s'] / sent * 1000, 3) if sent else 0.0,
+            'latency_max_ms': round(self.stats['latency_max_s'] * 1000, 3)
         }
 
-    def update_user_state(self, user_id: int, state: str):
-        """Обновить состояние пользователя"""
-        self.cursor.execute(
-            "UPDATE users SET current_state = ?, updated_at = CURRENT_TIMESTAMP WHERE telegram_user_id = ?",
-            (state, user_id)
-        )
-        self.conn.commit()
-        self.log_state(user_id, state)
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        if not endpoint.startswith(self.SEND_PREFIXES):
+            return await callback(*args, **kwargs)
+
+        if rate_limit_args is None:
+            rate_limit_args = SEND_PRIORITY.get()
+        priority = PRIORITY_NORMAL if rate_limit_args is None else rate_limit_args
+        chat_id = data.get('chat_id')
+        started = time.perf_counter()
+
+        for attempt in range(self.max_retries + 1):
+            if chat_id is not None:
+                await self._chat_slot(chat_id)
+            await self._global_slot(priority)
+
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == self.max_retries:
+                    self.stats['send_errors'] += 1
+                    raise
+                self.stats['retries'] += 1
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                logging.warning(f"Flood limit на {endpoint}, повтор через {retry_after} сек.")
+                await asyncio.sleep(retry_after)
+                continue
+            except Exception:
+                self.stats['send_errors'] += 1
+                raise
+
+            latency = time.perf_counter() - started
+            SEND_LATENCY.observe(latency, (endpoint,))
+            record_step(f"send {endpoint}", latency)
+            self.stats['sent'] += 1
+            self.stats['latency_total_s'] += latency
+            self.stats['latency_max_s'] = max(self.stats['latency_max_s'], latency)
+            return result
+
+    async def _chat_slot(self, chat_id: Any):
+        """Дождаться слота в корзине чата (порядок внутри чата сохраняется)"""
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # Полные корзины неактивных чатов не храним
+            if len(self._chats) > 10000:
+                self._chats = {key: b for key, b in self._chats.items() if not b.idle()}
+            bucket = self._chats[chat_id] = TokenBucket(self.chat_rate, self.chat_burst)
+
+        wait = bucket.reserve()
+        if wait > 0:
+            self.stats['waiting_chat'] += 1
+            try:
+                await asyncio.sleep(wait)
+            finally:
+                self.stats['waiting_chat'] -= 1
+
+    async def _global_slot(self, priority: int):
+        """Получить глобальный токен; при очереди — в порядке приоритета"""
+        if not self._waiters and self._global.delay() == 0:
+            self._global.reserve()
+            return
 
-    def increment_session_count(self, user_id: int) -> int:
-        """Увеличить счетчик сессий пользователя"""
-        self.cursor.execute(
-            "UPDATE users SET session_count = session_count + 1 WHERE telegram_user_id = ?",
-            (user_id,)
-        )
-        self.conn.commit()
+        self._seq += 1
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, self._seq, future))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    async def _dispatch(self):
+        """Выдача глобальных токенов ожидающим по приоритету"""
+        while self._waiters:
+            wait = self._global.delay()
+            if wait > 0:
+                await asyncio.sleep(wait)
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                self._global.reserve()
+                future.set_result(None)
+
+# ==================== HTTP И WEBHOOK ====================
+
+class HttpRequest(NamedTuple):
+    """Разобранный HTTP-запрос"""
+    method: str
+    path: str
+    headers: Dict[str, str]
+    body: bytes
+
+
+class HttpResponse(NamedTuple):
+    """HTTP-ответ обработчика"""
+    status: int
+    body: bytes = b''
+    content_type: str = 'text/plain; charset=utf-8'
+
+
+HTTP_REASONS = {
+    200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found',
+    405: 'Method Not Allowed', 408: 'Request Timeout', 411: 'Length Required',
+    413: 'Payload Too Large', 431: 'Request Header Fields Too Large',
+    500: 'Internal Server Error', 501: 'Not Implemented', 503: 'Service Unavailable'
+}
 
-        self.cursor.execute(
-            "SELECT session_count FROM users WHERE telegram_user_id = ?",
-            (user_id,)
-        )
-        return self.cursor.fetchone()[0]
 
-    def set_pause_flag(self, user_id: int, pause_value: int) -> int:
-        """Установить флаг паузы"""
-        self.cursor.execute(
-            "UPDATE users SET pause_flag = ? WHERE telegram_user_id = ?",
-            (pause_value, user_id)
-        )
-        self.conn.commit()
-        return pause_value
+class HttpRequestError(Exception):
+    """Некорректный запрос: ответить status и закрыть соединение"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+
+
+class HttpServer:
+    """Минимальный HTTP/1.1 сервер на asyncio (без внешних зависимостей).
+
+    Поддерживает keep-alive и тело только с Content-Length: запросы
+    с Transfer-Encoding (chunked) отклоняются 501, POST без длины — 411,
+    чтобы граница тела не толковалась иначе, чем у прокси перед сервером.
+    Обработчики регистрируются по (метод, путь) и возвращают HttpResponse.
+    reuse_port (SO_REUSEPORT) позволяет новому процессу слушать тот же
+    порт, пока старый дорабатывает. Медленные и слишком большие запросы
+    ограничены: соединение без нового запроса закрывается через IDLE_TIMEOUT,
+    заголовки и тело должны прийти за READ_TIMEOUT.
+    """
+
+    MAX_BODY = 1024 * 1024
+    MAX_HEADERS = 100
+    MAX_HEADER_BYTES = 16 * 1024
+    IDLE_TIMEOUT = 75.0   # ожидание следующего запроса keep-alive, сек
+    READ_TIMEOUT = 10.0   # чтение заголовков и тела начатого запроса, сек
+
+    def __init__(self, host: str, port: int, reuse_port: bool = False):
+        self.host = host
+        self.port = port
+        self.reuse_port = reuse_port
+        self._routes: Dict[Tuple[str, str], Callable[[HttpRequest], Awaitable[HttpResponse]]] = {}
+        self._server: Optional[asyncio.AbstractServer] = None
+        # Открытые соединения: True — простаивает в ожидании следующего запроса
+        self._connections: Dict[asyncio.StreamWriter, bool] = {}
+        self._closing = False
+
+    def route(self, method: str, path: str,
+              handler: Callable[[HttpRequest], Awaitable[HttpResponse]]):
+        """Зарегистрировать обработчик"""
+        self._routes[(method, path)] = handler
+
+    async def start(self):
+        """Начать приём соединений"""
+        self._closing = False
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, reuse_port=self.reuse_port)
+        if self.port == 0:
+            self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        """Перестать принимать соединения.
+
+        Простаивающие keep-alive соединения закрываются сразу, начатые
+        запросы получают ответ с Connection: close — клиент переподключится
+        к процессу, который продолжает слушать порт.
+        """
+        if self._server:
+            self._closing = True
+            self._server.close()
+            for writer, idle in list(self._connections.items()):
+                if idle:
+                    writer.close()
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader: asyncio.StreamReader) -> Optional[HttpRequest]:
+        """Прочитать один запрос; None — соединение закрыто или простаивает дольше IDLE_TIMEOUT.
+
+        Некорректный запрос — HttpRequestError со статусом ответа.
+        """
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.IDLE_TIMEOUT)
+        except asyncio.TimeoutError:
+            return None
+        except ValueError:
+            raise HttpRequestError(400, "Слишком длинная строка запроса")
+        if not request_line:
+            return None
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+            raise HttpRequestError(400, "Некорректная строка запроса")
+        method, target, _ = parts
 
-    def add_feedback(self, user_id: int, feedback_type: str,
-                    discomfort_detail: Optional[str] = None,
-                    session_number: Optional[int] = None):
-        """Добавить запись фидбэка"""
-        self.cursor.execute(
-            """INSERT INTO feedback_log 
-               (telegram_user_id, feedback_type, discomfort_detail, session_number) 
-               VALUES (?, ?, ?, ?)""",
-            (user_id, feedback_type, discomfort_detail, session_number)
+        try:
+            headers, body = await asyncio.wait_for(self._read_message(reader, method), self.READ_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise HttpRequestError(408, "Запрос не получен за READ_TIMEOUT")
+        return HttpRequest(method, target.split('?', 1)[0], headers, body)
+
+    async def _read_message(self, reader: asyncio.StreamReader, method: str) -> Tuple[Dict[str, str], bytes]:
+        """Заголовки и тело запроса"""
+        headers = {}
+        size = 0
+        while True:
+            try:
+                line = await reader.readline()
+            except ValueError:
+                raise HttpRequestError(431, "Слишком длинный заголовок")
+            if line in (b'\r\n', b'\n', b''):
+                break
+            size += len(line)
+            if size > self.MAX_HEADER_BYTES or len(headers) >= self.MAX_HEADERS:
+                raise HttpRequestError(431, "Слишком много заголовков")
+            name, sep, value = line.decode('latin-1').partition(':')
+            # Пробел в имени и продолжение заголовка на новой строке (obs-fold)
+            # прокси и сервер могут прочитать по-разному
+            if not sep or not name.strip() or name != name.strip():
+                raise HttpRequestError(400, "Некорректный заголовок")
+            name, value = name.lower(), value.strip()
+            if name == 'content-length' and headers.get(name, value) != value:
+                raise HttpRequestError(400, "Несколько разных Content-Length")
+            headers[name] = value
+
+        if 'transfer-encoding' in headers:
+            raise HttpRequestError(501, "Transfer-Encoding не поддерживается")
+        if method == 'POST' and 'content-length' not in headers:
+            raise HttpRequestError(411, "POST без Content-Length")
+        length = headers.get('content-length', '0')
+        if not (length.isascii() and length.isdigit()):
+            raise HttpRequestError(400, "Некорректный Content-Length")
+        length = int(length)
+        if length > self.MAX_BODY:
+            raise HttpRequestError(413, "Слишком большое тело запроса")
+        body = await reader.readexactly(length) if length else b''
+        return headers, body
+
+    async def _serve(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        """Обслуживание соединения (keep-alive)"""
+        try:
+            while not self._closing:
+                self._connections[writer] = True
+                try:
+                    request = await self._read_request(reader)
+                except HttpRequestError as e:
+                    await self._write(writer, HttpResponse(e.status), close=True)
+                    return
+                except asyncio.IncompleteReadError:
+                    # Клиент закрыл соединение посреди тела
+                    return
+                if request is None:
+                    return
+                self._connections[writer] = False
+
+                handler = self._routes.get((request.method, request.path))
+                if handler is None:
+                    allowed = any(path == request.path for _, path in self._routes)
+                    response = HttpResponse(405 if allowed else 404)
+                else:
+                    try:
+                        response = await handler(request)
+                    except Exception as e:
+                        logging.error(f"Ошибка обработки HTTP-запроса {request.path}: {e}")
+                        response = HttpResponse(500)
+
+                close = self._closing or request.headers.get('connection', '').lower() == 'close'
+                await self._write(writer, response, close)
+                if close:
+                    return
+        except (ConnectionError, asyncio.CancelledError):
+            pass
+        finally:
+            self._connections.pop(writer, None)
+            writer.close()
+
+    @staticmethod
+    async def _write(writer: asyncio.StreamWriter, response: HttpResponse, close: bool):
+        head = (
+            f"HTTP/1.1 {response.status} {HTTP_REASONS.get(response.status, '')}\r\n"
+            f"Content-Type: {response.content_type}\r\n"
+            f"Content-Length: {len(response.body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n"
         )
-        self.conn.commit()
+        writer.write(head.encode('latin-1') + response.body)
+        await writer.drain()
+
+
+class WebhookServer:
+    """Приём обновлений Telegram через webhook.
+
+    Проверяет секретный токен, разбирает обновление, ставит его в
+    application.update_queue и сразу отвечает 200 — обработка идёт
+    асинхронно. GET /healthz сообщает о готовности и длине очереди.
+    """
+
+    def __init__(self, application: Application, secret_token: str = WEBHOOK_SECRET,
+                 host: str = WEBHOOK_LISTEN, port: int = WEBHOOK_PORT,
+                 path: str = WEBHOOK_PATH, reuse_port: bool = False):
+        self.application = application
+        self.secret_token = secret_token
+        self.path = path
+        self.http = HttpServer(host, port, reuse_port)
+        self.http.route('POST', path, self.handle_update)
+        self.http.route('GET', '/healthz', self.handle_health)
+        self.stats = {'accepted': 0, 'rejected': 0, 'malformed': 0}
+
+    async def start(self):
+        await self.http.start()
+        logging.info(f"Webhook слушает {self.http.host}:{self.http.port}{self.path}")
+
+    async def stop(self):
+        await self.http.stop()
+
+    async def handle_update(self, request: HttpRequest) -> HttpResponse:
+        """POST от Telegram: проверка секрета и постановка в очередь"""
+        if self.secret_token:
+            received = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(received, self.secret_token):
+                self.stats['rejected'] += 1
+                return HttpResponse(403)
 
-    def add_session(self, user_id: int, session_number: int, duration: int):
-        """Добавить запись о сессии"""
-        self.cursor.execute(
-            """INSERT INTO sessions 
-               (telegram_user_id, session_number, duration_seconds) 
-               VALUES (?, ?, ?)""",
-            (user_id, session_number, duration)
+        try:
+            update = Update.de_json(json.loads(request.body), self.application.bot)
+        except Exception:
+            self.stats['malformed'] += 1
+            return HttpResponse(400)
+
+        self.application.update_queue.put_nowait(update)
+        self.stats['accepted'] += 1
+        return HttpResponse(200)
+
+    async def handle_health(self, request: HttpRequest) -> HttpResponse:
+        """Проверка живости для балансировщика/оркестратора"""
+        health = {
+            'status': 'ok' if self.application.running else 'starting',
+            'update_queue': self.application.update_queue.qsize(),
+            **self.stats
+        }
+        rate_limiter = self.application.bot.rate_limiter
+        if isinstance(rate_limiter, PriorityRateLimiter):
+            health['send_queue'] = rate_limiter.metrics()
+        body = json.dumps(health)
+        return HttpResponse(
+            200 if self.application.running else 503,
+            body.encode(),
+            'application/json'
         )
-        self.conn.commit()
 
-    def log_state(self, user_id: int, state: str):
-        """Записать состояние в лог"""
-        self.cursor.execute(
-            "INSERT INTO state_log (telegram_user_id, state) VALUES (?, ?)",
-            (user_id, state)
-        )
-        self.conn.commit()
+# ==================== МЕТРИКИ ====================
+
+# Границы корзин гистограмм задержек (в секундах)
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape_label(value: Any) -> str:
+    """Экранирование значения метки Prometheus"""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = '') -> str:
+    """Метки в формате Prometheus: {name="value",...}"""
+    pairs = [f'{name}="{_escape_label(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class Histogram:
+    """Гистограмма Prometheus с метками.
+
+    observe вызывается из потока event loop, поэтому обходится без блокировок:
+    поиск корзины и два инкремента. Ряды хранят счётчики по корзинам
+    (последняя — +Inf) и сумму значений.
+    """
+
+    def __init__(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                 buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labels = labels
+        self.buckets = buckets
+        self._series: Dict[Tuple[str, ...], List[float]] = {}
+
+    def observe(self, value: float, labels: Tuple[str, ...] = ()):
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect_left(self.buckets, value)] += 1
+        series[-1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in list(self._series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), series):
+                cumulative += count
+                bucket_labels = _format_labels(self.labels, labels, f'le="{bound}"')
+                lines.append(f"{self.name}_bucket{bucket_labels} {cumulative}")
+            series_labels = _format_labels(self.labels, labels)
+            lines.append(f"{self.name}_sum{series_labels} {series[-1]}")
+            lines.append(f"{self.name}_count{series_labels} {cumulative}")
+        return lines
+
+
+class MetricsRegistry:
+    """Реестр метрик: гистограммы и значения, снимаемые при каждом запросе /metrics"""
+
+    def __init__(self):
+        self._histograms: Dict[str, Histogram] = {}
+        self._collectors: Dict[str, Tuple[str, str, Tuple[str, ...], Callable[[], Any]]] = {}
+
+    def histogram(self, name: str, help_text: str, labels: Tuple[str, ...] = (),
+                  buckets: Tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        if name not in self._histograms:
+            self._histograms[name] = Histogram(name, help_text, labels, buckets)
+        return self._histograms[name]
+
+    def collector(self, name: str, help_text: str, kind: str, collect: Callable[[], Any],
+                  labels: Tuple[str, ...] = ()):
+        """Зарегистрировать gauge/counter; collect возвращает число или {метки: число}.
+
+        Повторная регистрация с тем же именем заменяет прежнюю.
+        """
+        self._collectors[name] = (help_text, kind, labels, collect)
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self._histograms.values():
+            lines.extend(histogram.render())
+
+        for name, (help_text, kind, labels, collect) in self._collectors.items():
+            try:
+                value = collect()
+            except Exception as e:
+                logging.error(f"Ошибка сбора метрики {name}: {e}")
+                continue
+            if value is None:
+                continue
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+            if isinstance(value, dict):
+                for label_values, sample in value.items():
+                    if not isinstance(label_values, tuple):
+                        label_values = (label_values,)
+                    lines.append(f"{name}{_format_labels(labels, label_values)} {sample}")
+            else:
+                lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+METRICS = MetricsRegistry()
+
+HANDLER_LATENCY = METRICS.histogram(
+    'bot_handler_duration_seconds', "Время обработчика по состоянию FSM", ('state', 'handler')
+)
+JOB_LATENCY = METRICS.histogram(
+    'bot_job_duration_seconds', "Время выполнения отложенной задачи", ('kind',)
+)
+DB_LATENCY = METRICS.histogram(
+    'bot_db_call_duration_seconds', "Время вызова метода Database с ожиданием потока БД", ('method',)
+)
+SEND_LATENCY = METRICS.histogram(
+    'bot_send_duration_seconds', "Время запроса к Bot API с ожиданием в очереди отправки", ('endpoint',)
+)
+LOOP_LAG = METRICS.histogram(
+    'bot_event_loop_lag_seconds', "Задержка event loop (опоздание таймера)"
+)
 
-    def get_user_stats(self, user_id: int) -> Dict[str, Any]:
-        """Получить статистику пользователя"""
-        self.cursor.execute(
-            "SELECT session_count, pause_flag FROM users WHERE telegram_user_id = ?",
-            (user_id,)
-        )
-        stats = self.cursor.fetchone()
 
-        self.cursor.execute(
-            """SELECT feedback_type, COUNT(*) 
-               FROM feedback_log 
-               WHERE telegram_user_id = ? 
-               GROUP BY feedback_type""",
-            (user_id,)
-        )
-        feedback_dist = dict(self.cursor.fetchall())
+# Шаги текущего обновления (имя, секунды) для журнала медленных обновлений;
+# None вне обработки обновления или при выключенном журнале
+UPDATE_TRACE: contextvars.ContextVar[Optional[List[Tuple[str, float]]]] = contextvars.ContextVar(
+    'update_trace', default=None
+)
 
-        return {
-            'session_count': stats[0] if stats else 0,
-            'pause_flag': stats[1] if stats else 0,
-            'feedback_distribution': feedback_dist
-        }
 
-    def get_analytics(self) -> Dict[str, Any]:
-        """Получить аналитику по всей системе"""
-        self.cursor.execute("SELECT COUNT(DISTINCT telegram_user_id) FROM users")
-        total_users = self.cursor.fetchone()[0]
+def record_step(name: str, elapsed: float):
+    """Добавить шаг в разбивку текущего обновления"""
+    trace = UPDATE_TRACE.get()
+    if trace is not None:
+        trace.append((name, elapsed))
 
-        self.cursor.execute("SELECT AVG(session_count) FROM users WHERE session_count > 0")
-        avg_sessions = self.cursor.fetchone()[0] or 0
 
-        self.cursor.execute(
-            """SELECT feedback_type, COUNT(*) 
-               FROM feedback_log 
-               GROUP BY feedback_type"""
-        )
-        feedback_dist = dict(self.cursor.fetchall())
+def instrumented(state: str, name: str, callback: Callable[..., Awaitable[Any]]):
+    """Обёртка обработчика PTB с замером времени в HANDLER_LATENCY"""
+    labels = (state, name)
+    step = f"handler {state}/{name}"
 
-        return {
-            'total_users': total_users,
-            'average_sessions': round(avg_sessions, 2),
-            'feedback_distribution': feedback_dist
-        }
+    async def wrapper(update: Update, context: ContextTypes.DEFAULT_TYPE):
+        started = time.perf_counter()
+        try:
+            return await callback(update, context)
+        finally:
+            elapsed = time.perf_counter() - started
+            HANDLER_LATENCY.observe(elapsed, labels)
+            record_step(step, elapsed)
+    return wrapper
+
+
+class LoopLagMonitor:
+    """Замер задержки event loop: насколько позже срабатывает sleep(interval)"""
+
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(0.0, loop.time() - started - self.interval)
+            LOOP_LAG.observe(self.lag)
+
+
+class MetricsServer:
+    """GET /metrics в текстовом формате Prometheus.
+
+    Перед отрисовкой вызываются refreshers — корутины, обновляющие
+    дорогие значения (например, пользователей по состояниям) с кэшированием.
+    """
+
+    def __init__(self, registry: MetricsRegistry = METRICS,
+                 host: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.registry = registry
+        self.refreshers: List[Callable[[], Awaitable[None]]] = []
+        self.http = HttpServer(host, port)
+        self.http.route('GET', '/metrics', self.handle_metrics)
+
+    async def start(self):
+        await self.http.start()
+        logging.info(f"Метрики: http://{self.http.host}:{self.http.port}/metrics")
+
+    async def stop(self):
+        await self.http.stop()
+
+    async def handle_metrics(self, request: HttpRequest) -> HttpResponse:
+        for refresh in self.refreshers:
+            try:
+                await refresh()
+            except Exception as e:
+                logging.error(f"Ошибка обновления метрик: {e}")
+        return HttpResponse(
+            200,
+            self.registry.render().encode(),
+            'text/plain; version=0.0.4; charset=utf-8'
+        )
 
-    def close(self):
-        """Закрыть соединение с базой данных"""
-        if self.conn:
-            self.conn.close()
+# ==================== ПРОФИЛИРОВАНИЕ ====================
+
+def log_slow_update(update: object, waited: float, elapsed: float, steps: List[Tuple[str, float]]):
+    """Запись о медленном обновлении с разбивкой по шагам.
+
+    Шаги вложены: отправка и вызовы БД идут внутри обработчика; "ptb" —
+    время обработки за вычетом обработчиков (диспетчеризация PTB, персистентность).
+    """
+    user = getattr(update, 'effective_user', None)
+    message = getattr(update, 'effective_message', None)
+    text = (getattr(message, 'text', None) or '')[:32]
+
+    handlers_total = sum(duration for name, duration in steps if name.startswith('handler '))
+    parts = [f"ожидание {waited * 1000:.1f} мс"]
+    parts += [f"{name} {duration * 1000:.1f} мс" for name, duration in steps]
+    parts.append(f"ptb {(elapsed - handlers_total) * 1000:.1f} мс")
+
+    logging.getLogger('bot.slow').warning(
+        f"Медленное обновление {elapsed * 1000:.1f} мс "
+        f"(пользователь {user.id if user else '-'}, {text!r}): " + "; ".join(parts)
+    )
+
+
+class SamplingProfiler:
+    """Сэмплирующий профилировщик всех потоков процесса.
+
+    Фоновый поток каждые interval секунд снимает стеки через sys._current_frames
+    и копит их в свёрнутом формате (folded stacks: "поток;f1;f2 N"),
+    который понимают flamegraph.pl и speedscope. Сам профилируемый код
+    не замедляется, кроме захвата GIL на время снятия стеков.
+    """
+
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples: Counter = Counter()
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self) -> Counter:
+        self._stop.set()
+        if self._thread:
+            self._thread.join()
+        return self.samples
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self._stop.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+
+
+class UpdateProfiler:
+    """Профилирование на ограниченное окно без рестарта.
+
+    Режимы:
+    sample — SamplingProfiler, результат в .folded;
+    cprofile — cProfile для доли обновлений (fraction), результат в .pstats.
+    cProfile ведёт одно обновление за раз: пока оно выполняется, в профиль
+    попадает и конкурентная работа event loop, поэтому долю лучше держать малой.
+    Окно закрывается само через duration секунд, файл пишется в output_dir.
+    """
+
+    MODES = ('sample', 'cprofile')
+
+    def __init__(self, output_dir: str = PROFILE_DIR):
+        self.output_dir = output_dir
+        self.mode: Optional[str] = None
+        self.path: Optional[str] = None
+        self.fraction = 1.0
+        self.until = 0.0
+        self._sampler: Optional[SamplingProfiler] = None
+        self._profiles: List['cProfile.Profile'] = []
+        self._active: Optional['cProfile.Profile'] = None
+        self._timer: Optional[asyncio.TimerHandle] = None
+
+    @property
+    def running(self) -> bool:
+        return self.mode is not None
+
+    def start(self, mode: str, duration: float, fraction: float = 1.0) -> str:
+        """Открыть окно профилирования; возвращает путь будущего файла"""
+        if self.running:
+            raise ValueError(f"Профилирование уже идёт ({self.mode})")
+        if mode not in self.MODES:
+            raise ValueError(f"Неизвестный режим профилирования: {mode}")
+        duration = min(max(duration, 1.0), PROFILE_MAX_WINDOW)
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        stamp = datetime.now().strftime('%Y%m%d-%H%M%S')
+        extension = 'folded' if mode == 'sample' else 'pstats'
+        self.path = os.path.join(self.output_dir, f"{mode}-{stamp}.{extension}")
+        self.mode = mode
+        self.fraction = min(max(fraction, 0.0), 1.0)
+        self.until = time.time() + duration
+
+        if mode == 'sample':
+            self._sampler = SamplingProfiler()
+            self._sampler.start()
+        self._timer = asyncio.get_running_loop().call_later(duration, self.stop)
+        logging.info(f"Профилирование {mode} на {duration:.0f} сек. -> {self.path}")
+        return self.path
+
+    def stop(self) -> Optional[str]:
+        """Закрыть окно и записать результат; возвращает путь файла"""
+        if not self.running:
+            return None
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        path = self.path
+        if self.mode == 'sample':
+            samples = self._sampler.stop()
+            with open(path, 'w', encoding='utf-8') as f:
+                for stack, count in samples.most_common():
+                    f.write(f"{stack} {count}\n")
+            self._sampler = None
+        else:
+            if self._active is not None:
+                self.end_update(self._active)
+            if self._profiles:
+                import pstats
+                stats = pstats.Stats(self._profiles[0])
+                for profile in self._profiles[1:]:
+                    stats.add(profile)
+                stats.dump_stats(path)
+            else:
+                path = None
+            self._profiles = []
+
+        logging.info(f"Профилирование {self.mode} завершено: {path or 'нет данных'}")
+        self.mode = None
+        self.path = None
+        return path
+
+    def begin_update(self) -> Optional['cProfile.Profile']:
+        """Начать профиль обновления, если оно выбрано (режим cprofile)"""
+        if self.mode != 'cprofile' or self._active is not None or random.random() >= self.fraction:
+            return None
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Уже активен другой профилировщик
+            return None
+        self._active = profile
+        return profile
+
+    def end_update(self, profile: 'cProfile.Profile'):
+        profile.disable()
+        if profile is self._active:
+            self._active = None
+            if self.mode == 'cprofile':
+                self._profiles.append(profile)
+
+    def status(self) -> str:
+        if not self.running:
+            return "Профилирование выключено"
+        left = max(0, self.until - time.time())
+        detail = f", доля обновлений {self.fraction:g}, профилей {len(self._profiles)}" \
+            if self.mode == 'cprofile' else ''
+        return f"Профилирование {self.mode}: осталось {left:.0f} сек.{detail}, файл {self.path}"
+
+    def start_from_spec(self, spec: str) -> str:
+        """Запуск по строке "режим:секунды[:доля]" (переменная PROFILE)"""
+        parts = spec.split(':')
+        mode = parts[0]
+        duration = float(parts[1]) if len(parts) > 1 else 60.0
+        fraction = float(parts[2]) if len(parts) > 2 else 1.0
+        return self.start(mode, duration, fraction)
+
+    def toggle(self):
+        """Переключатель по сигналу: запустить сэмплирование на 60 сек. или остановить"""
+        if self.running:
+            self.stop()
+        else:
+            self.start('sample', 60)
 
 # ==================== КЛАВИАТУРЫ ====================
 
-def get_keyboard(state: str) -> ReplyKeyboardMarkup:
-    """Получить клавиатуру для указанного состояния"""
+# Раскладки клавиатур: состояние -> ряды кнопок
+KEYBOARD_LAYOUTS = {
+    STATES['S0_INIT']: (("Начать",),),
+    STATES['S1_CONFIRM_CONDITIONS']: (("Подтверждаю",), ("Не подтверждаю",)),
+    STATES['S2_CHECK_CONTRAINDICATIONS']: (("Да", "Нет"),),
+    STATES['S3_READY_FOR_SESSION']: (("Начать сеанс",),),
+    STATES['S5_POST_SESSION']: (("Продолжить",),),
+    STATES['S6_FEEDBACK']: (("Комфортно", "Нейтрально"), ("Дискомфорт",)),
+    "DISCOMFORT_DETAIL": (("Да", "Нет"),)
+}
 
-    if state == STATES['S0_INIT']:
-        keyboard = [[KeyboardButton("Начать")]]
 
-    elif state == STATES['S1_CONFIRM_CONDITIONS']:
-        keyboard = [
-            [KeyboardButton("Подтверждаю")],
-            [KeyboardButton("Не подтверждаю")]
-        ]
+class FrozenKeyboard(ReplyKeyboardMarkup):
+    """Неизменяемая клавиатура с заранее сериализованной разметкой.
 
-    elif state == STATES['S2_CHECK_CONTRAINDICATIONS']:
-        keyboard = [[KeyboardButton("Да"), KeyboardButton("Нет")]]
+    Создаётся один раз при загрузке модуля; при отправке Bot API получает
+    готовый словарь вместо повторной сериализации кнопок. Кэш хранится
+    в защищённом атрибуте: TelegramObject разрешает задавать такие и после
+    заморозки, открытые поля клавиатуры не меняются.
+    """
+    __slots__ = ('_serialized',)
 
-    elif state == STATES['S3_READY_FOR_SESSION']:
-        keyboard = [[KeyboardButton("Начать сеанс")]]
+    def __init__(self, layout: Tuple[Tuple[str, ...], ...]):
+        super().__init__(layout, resize_keyboard=True, one_time_keyboard=True)
+        self._serialized = super().to_dict()
 
-    elif state == STATES['S5_POST_SESSION']:
-        keyboard = [[KeyboardButton("Продолжить")]]
+    def to_dict(self, recursive: bool = True) -> Dict[str, Any]:
+        return self._serialized if recursive else super().to_dict(recursive)
 
-    elif state == STATES['S6_FEEDBACK']:
-        keyboard = [
-            [KeyboardButton("Комфортно"), KeyboardButton("Нейтрально")],
-            [KeyboardButton("Дискомфорт")]
-        ]
 
-    elif state == "DISCOMFORT_DETAIL":
-        keyboard = [[KeyboardButton("Да"), KeyboardButton("Нет")]]
+KEYBOARDS = {state: FrozenKeyboard(layout) for state, layout in KEYBOARD_LAYOUTS.items()}
+EMPTY_KEYBOARD = FrozenKeyboard(())
 
-    else:
-        keyboard = []
 
-    return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
+def get_keyboard(state: str) -> ReplyKeyboardMarkup:
+    """Получить клавиатуру для указанного состояния"""
+    return KEYBOARDS.get(state, EMPTY_KEYBOARD)
 
 # ==================== ОБРАБОТЧИКИ КОМАНД ====================
 
 class CommandHandlers:
     """Обработчики команд бота"""
 
-    def __init__(self, db: Database):
+    def __init__(self, db: AsyncDatabase, scheduler: JobScheduler,
+                 profiler: Optional[UpdateProfiler] = None):
         self.db = db
+        self.scheduler = scheduler
+        self.profiler = profiler
 
     async def handle_start(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
         """Обработчик команды /start"""
         user = update.effective_user
-        user_data = self.db.get_or_create_user(user.id)
+        user_data = await self.db.get_or_create_user(user.id)
 
         # Если пользователь уже не в начальном состоянии и не на паузе
-        if user_data['current_state'] != STATES['S0_INIT'] and user_data['pause_flag'] == 0:
+        if user_data.current_state != STATES['S0_INIT'] and user_data.pause_flag == 0:
             await update.message.reply_text(MESSAGES['ALREADY_STARTED'])
             return ConversationHandler.END
 
-        # Сброс флага паузы при старте
-        if user_data['pause_flag'] == 1:
-            self.db.set_pause_flag(user.id, 0)
-
-        # Устанавливаем начальное состояние
-        self.db.update_user_state(user.id, STATES['S0_INIT'])
+        # Устанавливаем начальное состояние со сбросом флага паузы
+        await self.db.transition(
+            user.id,
+            STATES['S0_INIT'],
+            pause=0 if user_data.pause_flag == 1 else None
+        )
+        context.user_data.clear()
 
         # Отправляем приветственное сообщение
         await update.message.reply_text(
@@ -375,67 +3890,53 @@ class CommandHandlers:
     async def handle_status(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /status"""
         user = update.effective_user
-        user_data = self.db.get_or_create_user(user.id)
-
-        # Маппинг состояний на читаемые названия
-        state_names = {
-            STATES['S0_INIT']: "🔄 Инициализация",
-            STATES['S1_CONFIRM_CONDITIONS']: "✅ Подтверждение условий",
-            STATES['S2_CHECK_CONTRAINDICATIONS']: "⚠️ Проверка противопоказаний",
-            STATES['S3_READY_FOR_SESSION']: "🎯 Готов к сеансу",
-            STATES['S4_SESSION_ACTIVE']: "⏳ Сеанс активен",
-            STATES['S5_POST_SESSION']: "📊 После сеанса",
-            STATES['S6_FEEDBACK']: "💭 Обратная связь",
-            STATES['S7_REGULAR_USE']: "📈 Регулярное использование",
-            STATES['S8_PAUSE']: "⏸️ Пауза"
-        }
+        # Чтение через пул читателей: /status не ждёт записи
+        user_data = await self.db.get_user(user.id)
+        if user_data is None:
+            user_data = await self.db.get_or_create_user(user.id)
 
         # Формируем текст статуса
         status_text = (
             f"📊 Ваш статус:\n\n"
-            f"📍 Текущее состояние: {state_names.get(user_data['current_state'], 'Неизвестно')}\n"
-            f"🔢 Количество сеансов: {user_data['session_count']}\n"
-            f"⏸️ Режим паузы: {'Включен' if user_data['pause_flag'] == 1 else 'Выключен'}\n\n"
+            f"📍 Текущее состояние: {STATE_NAMES.get(user_data.current_state, 'Неизвестно')}\n"
+            f"🔢 Количество сеансов: {user_data.session_count}\n"
+            f"⏸️ Режим паузы: {'Включен' if user_data.pause_flag == 1 else 'Выключен'}\n\n"
             f"ℹ️ Используйте /help для списка команд"
         )
 
-        await update.message.reply_text(status_text)
+        with send_priority(PRIORITY_LOW):
+            await update.message.reply_text(status_text)
 
     async def handle_pause(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /pause"""
         user = update.effective_user
 
-        # Устанавливаем флаг паузы
-        self.db.set_pause_flag(user.id, 1)
-        self.db.update_user_state(user.id, STATES['S8_PAUSE'])
+        # Устанавливаем флаг паузы и отменяем таймеры (в БД - той же транзакцией)
+        await self.db.transition(user.id, STATES['S8_PAUSE'], pause=1, cancel_jobs=True)
+        self.scheduler.cancel_user(user.id)
+        # Ход анкеты и ожидание уточнения сбрасываются вместе с потоком
+        context.user_data.clear()
 
-        # Отменяем таймеры, если есть
-        if 'session_timer' in context.user_data:
-            if context.user_data['session_timer']:
-                context.user_data['session_timer'].cancel()
-
-        await update.message.reply_text(
-            MESSAGES['S8'],
-            reply_markup=ReplyKeyboardRemove()
-        )
+        with send_priority(PRIORITY_CRITICAL):
+            await update.message.reply_text(
+                MESSAGES['S8'],
+                reply_markup=ReplyKeyboardRemove()
+            )
 
     async def handle_resume(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /resume"""
         user = update.effective_user
-        user_data = self.db.get_or_create_user(user.id)
+        user_data = await self.db.get_or_create_user(user.id)
 
-        if user_data['pause_flag'] != 1:
+        if user_data.pause_flag != 1:
             await update.message.reply_text(MESSAGES['NO_PAUSE'])
             return
 
         # Снимаем паузу и переходим к проверке противопоказаний
-        self.db.set_pause_flag(user.id, 0)
-        self.db.update_user_state(user.id, STATES['S2_CHECK_CONTRAINDICATIONS'])
+        await self.db.transition(user.id, STATES['S2_CHECK_CONTRAINDICATIONS'], pause=0)
 
         # Инициализируем индекс вопроса
-        if 'current_question_index' not in context.user_data:
-            context.user_data['current_question_index'] = {}
-        context.user_data['current_question_index'][user.id] = 0
+        context.user_data['question'] = 0
 
         # Задаем первый вопрос
         await update.message.reply_text(
@@ -447,256 +3948,588 @@ class CommandHandlers:
 
     async def handle_help(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /help"""
-        await update.message.reply_text(MESSAGES['HELP'])
+        with send_priority(PRIORITY_LOW):
+            await update.message.reply_text(MESSAGES['HELP'])
+
+    async def handle_profile(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /profile (только ADMIN_IDS).
+
+        /profile — статус; /profile sample 30; /profile cprofile 30 0.1; /profile stop
+        """
+        if self.profiler is None or update.effective_user.id not in ADMIN_IDS:
+            return
+
+        args = context.args or []
+        try:
+            if not args:
+                text = self.profiler.status()
+            elif args[0] == 'stop':
+                path = self.profiler.stop()
+                text = f"Профиль записан: {path}" if path else "Профилирование не шло или нет данных"
+            else:
+                duration = float(args[1]) if len(args) > 1 else 60.0
+                fraction = float(args[2]) if len(args) > 2 else 1.0
+                path = self.profiler.start(args[0], duration, fraction)
+                text = f"Профилирование {args[0]} запущено, файл: {path}"
+        except ValueError as e:
+            text = f"Ошибка: {e}"
+
+        with send_priority(PRIORITY_LOW):
+            await update.message.reply_text(text)
 
 # ==================== ОБРАБОТЧИКИ СОСТОЯНИЙ ====================
 
 class StateHandlers:
-    """Обработчики состояний FSM"""
+    """Обработчики состояний FSM.
+
+    Обработчик кнопки получает строку таблицы переходов (step), записывает
+    переход в step.next_state и возвращает текст ответа; клавиатуру
+    и приоритет ответа берёт из строки TransitionDispatcher. Другой исход,
+    чем в строке, обработчик возвращает как Reply, None — кнопка сейчас
+    не действует.
+
+    context.user_data хранит только ход потока, плоскими ключами:
+    'question' — индекс текущего вопроса S2, 'discomfort' — ждём уточнения
+    дискомфорта в S6. Вне анкеты и уточнения user_data пусты и не сохраняются.
+    """
 
-    def __init__(self, db: Database):
+    def __init__(self, db: AsyncDatabase, scheduler: JobScheduler):
         self.db = db
+        self.scheduler = scheduler
 
-    async def handle_s0_init(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s0_init(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                             step: 'Transition') -> str:
         """Обработчик состояния S0 - Инициализация"""
         user = update.effective_user
 
         # Переход к подтверждению условий
-        self.db.update_user_state(user.id, STATES['S1_CONFIRM_CONDITIONS'])
+        await self.db.transition(user.id, step.next_state)
 
-        await update.message.reply_text(
-            MESSAGES['S1'],
-            reply_markup=get_keyboard(STATES['S1_CONFIRM_CONDITIONS'])
-        )
+        return MESSAGES['S1']
 
-        return STATES['S1_CONFIRM_CONDITIONS']
-
-    async def handle_s1_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s1_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                step: 'Transition') -> str:
         """Обработчик состояния S1 - Подтверждение условий"""
         user = update.effective_user
         text = update.message.text
 
         if text == "Подтверждаю":
             # Переход к проверке противопоказаний
-            self.db.update_user_state(user.id, STATES['S2_CHECK_CONTRAINDICATIONS'])
+            await self.db.transition(user.id, step.next_state)
 
             # Инициализация индекса вопроса
-            if 'current_question_index' not in context.user_data:
-                context.user_data['current_question_index'] = {}
-            context.user_data['current_question_index'][user.id] = 0
+            context.user_data['question'] = 0
 
             # Первый вопрос проверки
-            await update.message.reply_text(
-                MESSAGES['S2_QUESTIONS'][0],
-                reply_markup=get_keyboard(STATES['S2_CHECK_CONTRAINDICATIONS'])
-            )
-
-            return STATES['S2_CHECK_CONTRAINDICATIONS']
+            return MESSAGES['S2_QUESTIONS'][0]
         else:
             # Переход в режим паузы
-            self.db.update_user_state(user.id, STATES['S8_PAUSE'])
-            self.db.set_pause_flag(user.id, 1)
-
-            await update.message.reply_text(
-                MESSAGES['S8'],
-                reply_markup=ReplyKeyboardRemove()
-            )
+            await self.db.transition(user.id, step.next_state, pause=1)
 
-            return STATES['S8_PAUSE']
+            return MESSAGES['S8']
 
-    async def handle_s2_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s2_check(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              step: 'Transition') -> Union[str, 'Reply']:
         """Обработчик состояния S2 - Проверка противопоказаний"""
         user = update.effective_user
         text = update.message.text
 
         # Если ответ "Да" на любой вопрос - переход в паузу
         if text == "Да":
-            self.db.update_user_state(user.id, STATES['S8_PAUSE'])
-            self.db.set_pause_flag(user.id, 1)
-
-            await update.message.reply_text(
-                MESSAGES['S8'],
-                reply_markup=ReplyKeyboardRemove()
-            )
+            context.user_data.pop('question', None)
+            await self.db.transition(user.id, step.next_state, pause=1)
 
-            return STATES['S8_PAUSE']
+            return MESSAGES['S8']
 
-        # Получаем текущий индекс вопроса
-        if 'current_question_index' not in context.user_data:
-            context.user_data['current_question_index'] = {}
-
-        idx = context.user_data['current_question_index'].get(user.id, 0)
-
-        # Переходим к следующему вопросу
-        idx += 1
+        # Получаем текущий индекс вопроса и переходим к следующему
+        idx = context.user_data.get('question', 0) + 1
 
         # Если вопросы закончились
         if idx >= len(MESSAGES['S2_QUESTIONS']):
-            # Переход к готовности сеанса
-            self.db.update_user_state(user.id, STATES['S3_READY_FOR_SESSION'])
-
-            await update.message.reply_text(
-                MESSAGES['S3'],
-                reply_markup=get_keyboard(STATES['S3_READY_FOR_SESSION'])
-            )
+            # Индекс больше не нужен: пустые user_data не хранятся
+            context.user_data.pop('question', None)
+            # Переход к готовности сеанса вместо следующего вопроса из таблицы
+            await self.db.transition(user.id, STATES['S3_READY_FOR_SESSION'])
 
-            return STATES['S3_READY_FOR_SESSION']
+            return Reply(MESSAGES['S3'], STATES['S3_READY_FOR_SESSION'], STATES['S3_READY_FOR_SESSION'])
 
         # Сохраняем индекс и задаем следующий вопрос
-        context.user_data['current_question_index'][user.id] = idx
-
-        await update.message.reply_text(
-            MESSAGES['S2_QUESTIONS'][idx],
-            reply_markup=get_keyboard(STATES['S2_CHECK_CONTRAINDICATIONS'])
-        )
+        context.user_data['question'] = idx
 
-        return STATES['S2_CHECK_CONTRAINDICATIONS']
+        return MESSAGES['S2_QUESTIONS'][idx]
 
-    async def handle_s3_ready(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s3_ready(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                              step: 'Transition') -> str:
         """Обработчик состояния S3 - Готов к сеансу"""
         user = update.effective_user
 
-        # Переход к активному сеансу
-        self.db.update_user_state(user.id, STATES['S4_SESSION_ACTIVE'])
-
-        # Отправляем сообщение о начале сеанса
-        await update.message.reply_text(
-            MESSAGES['S4'],
-            reply_markup=ReplyKeyboardRemove()
+        # Переход к активному сеансу; таймер сохраняется в БД той же транзакцией.
+        # Ещё не отправленное предложение нового сеанса (FOLLOW_UP_DELAY) отменяется,
+        # иначе его переход в S3 прервал бы начатый сеанс
+        timer = ScheduledJob(
+            key=f"session_end:{user.id}",
+            user_id=user.id,
+            kind='session_end',
+            due_at=time.time() + SESSION_DURATION,
+            payload={}
         )
+        await self.db.transition(user.id, step.next_state, schedule=timer, cancel_jobs=True)
+        self.scheduler.cancel_user(user.id)
+        self.scheduler.add(timer)
+
+        # Сообщение о начале сеанса
+        return MESSAGES['S4']
+
+    async def complete_session(self, job: ScheduledJob, bot):
+        """Завершение сеанса по таймеру (вызывается планировщиком)"""
+        # Регистрируем завершение сеанса и переходим к пост-сеансовому состоянию,
+        # только если таймер не был отменён и пользователь не ушёл в паузу
+        user_data = await self.db.transition(
+            job.user_id,
+            STATES['S5_POST_SESSION'],
+            session=SESSION_DURATION,
+            claim=job.key,
+            active=True
+        )
+        if user_data is None:
+            return
 
-        # Запускаем таймер сеанса в фоновом режиме
-        asyncio.create_task(self._session_timer(user.id, context))
-
-        return STATES['S4_SESSION_ACTIVE']
-
-    async def _session_timer(self, user_id: int, context: ContextTypes.DEFAULT_TYPE):
-        """Таймер сеанса (работает в фоне)"""
-        try:
-            # Ждем указанное время
-            await asyncio.sleep(SESSION_DURATION)
-
-            # Проверяем, не ушел ли пользователь в паузу
-            user_data = self.db.get_or_create_user(user_id)
-            if user_data['pause_flag'] == 1:
-                return
-
-            # Регистрируем завершение сеанса
-            session_number = self.db.increment_session_count(user_id)
-            self.db.add_session(user_id, session_number, SESSION_DURATION)
-
-            # Переход к пост-сеансовому состоянию
-            self.db.update_user_state(user_id, STATES['S5_POST_SESSION'])
-
-            # Отправляем сообщение о завершении сеанса
-            await context.bot.send_message(
-                chat_id=user_id,
-                text=MESSAGES['S5'],
-                reply_markup=get_keyboard(STATES['S5_POST_SESSION'])
-            )
-
-        except Exception as e:
-            logging.error(f"Ошибка в таймере сеанса: {e}")
+        # Отправляем сообщение о завершении сеанса
+        await bot.send_message(
+            chat_id=job.user_id,
+            text=MESSAGES['S5'],
+            reply_markup=get_keyboard(STATES['S5_POST_SESSION']),
+            rate_limit_args=PRIORITY_CRITICAL
+        )
 
-    async def handle_s5_post_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s5_post_session(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                     step: 'Transition') -> Optional[str]:
         """Обработчик состояния S5 - После сеанса"""
         user = update.effective_user
 
-        # Переход к сбору фидбэка
-        self.db.update_user_state(user.id, STATES['S6_FEEDBACK'])
+        # Диалог мог остаться в S4 (таймер сработал в фоне или после рестарта):
+        # переходим дальше, только если сеанс действительно завершён
+        user_data = await self.db.get_or_create_user(user.id)
+        if user_data.current_state != STATES['S5_POST_SESSION']:
+            return None
 
-        await update.message.reply_text(
-            MESSAGES['S6'],
-            reply_markup=get_keyboard(STATES['S6_FEEDBACK'])
-        )
+        # Переход к сбору фидбэка
+        await self.db.transition(user.id, step.next_state)
 
-        return STATES['S6_FEEDBACK']
+        return MESSAGES['S6']
 
-    async def handle_s6_feedback(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s6_feedback(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                 step: 'Transition') -> str:
         """Обработчик состояния S6 - Обратная связь"""
         user = update.effective_user
         text = update.message.text
-        user_data = self.db.get_or_create_user(user.id)
-
-        # Сохраняем фидбэк
-        self.db.add_feedback(user.id, text, session_number=user_data['session_count'])
 
         if text == "Дискомфорт":
-            # Нужны детали дискомфорта
-            if 'discomfort_detail_needed' not in context.user_data:
-                context.user_data['discomfort_detail_needed'] = {}
-            context.user_data['discomfort_detail_needed'][user.id] = True
+            # Фидбэк пишется переходом в то же S6 (номер сеанса берётся из users)
+            await self.db.transition(user.id, step.next_state, feedback=(text, None))
 
-            await update.message.reply_text(
-                MESSAGES['S6_DISCOMFORT'],
-                reply_markup=get_keyboard("DISCOMFORT_DETAIL")
-            )
+            # Нужны детали дискомфорта
+            context.user_data['discomfort'] = True
 
-            return STATES['S6_FEEDBACK']
+            return MESSAGES['S6_DISCOMFORT']
         else:
-            # Переход к завершению потока
-            return await self._complete_feedback_flow(user.id, update, context)
+            # Фидбэк сохраняется вместе с переходом к завершению потока
+            return await self._complete_feedback_flow(user.id, step, feedback=(text, None))
 
-    async def handle_s6_discomfort_detail(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def handle_s6_discomfort_detail(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                          step: 'Transition') -> str:
         """Обработчик деталей дискомфорта"""
         user = update.effective_user
         text = update.message.text
-        user_data = self.db.get_or_create_user(user.id)
+        context.user_data.pop('discomfort', None)
 
         if text == "Да":
             # Дискомфорт с усилением - переход в паузу
-            self.db.add_feedback(
+            await self.db.transition(
                 user.id,
-                "Дискомфорт с усилением",
-                "Усиливающиеся ощущения",
-                user_data['session_count']
+                step.next_state,
+                pause=1,
+                feedback=("Дискомфорт с усилением", "Усиливающиеся ощущения")
             )
 
-            self.db.update_user_state(user.id, STATES['S8_PAUSE'])
-            self.db.set_pause_flag(user.id, 1)
-
-            await update.message.reply_text(
-                MESSAGES['S8'],
-                reply_markup=ReplyKeyboardRemove()
-            )
-
-            return STATES['S8_PAUSE']
+            return MESSAGES['S8']
         else:
             # Дискомфорт без усиления - завершение потока
-            self.db.add_feedback(
-                user.id,
-                "Дискомфорт без усиления",
-                "Без усиления",
-                user_data['session_count']
+            return await self._complete_feedback_flow(
+                user.id, step,
+                feedback=("Дискомфорт без усиления", "Без усиления")
             )
 
-            return await self._complete_feedback_flow(user.id, update, context)
-
-    async def _complete_feedback_flow(self, user_id: int, update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    async def _complete_feedback_flow(self, user_id: int, step: 'Transition',
+                                      feedback: Optional[Tuple[str, Optional[str]]] = None) -> str:
         """Завершение потока фидбэка"""
-        # Переход к регулярному использованию
-        self.db.update_user_state(user_id, STATES['S7_REGULAR_USE'])
+        # Предложение нового сеанса отправится планировщиком через FOLLOW_UP_DELAY,
+        # обработчик не ждёт; /pause до срабатывания отменяет отправку
+        follow_up = delayed_message(
+            user_id,
+            FOLLOW_UP_DELAY,
+            MESSAGES['READY_FOR_NEXT'],
+            keyboard=STATES['S3_READY_FOR_SESSION'],
+            next_state=STATES['S3_READY_FOR_SESSION']
+        )
 
-        await update.message.reply_text(
-            MESSAGES['S7'],
-            reply_markup=ReplyKeyboardRemove()
+        # Переход к регулярному использованию (вместе с записью фидбэка и задачей)
+        await self.db.transition(
+            user_id,
+            step.next_state,
+            feedback=feedback,
+            schedule=follow_up
+        )
+        self.scheduler.add(follow_up)
+
+        return MESSAGES['S7']
+
+    async def send_delayed_message(self, job: ScheduledJob, bot):
+        """Отправка отложенного сообщения с переходом (вызывается планировщиком)"""
+        # Забираем задачу из БД (вместе с переходом, если он задан);
+        # пользователю на паузе сообщение не отправляется
+        next_state = job.payload.get('next_state')
+        if next_state:
+            claimed = await self.db.transition(job.user_id, next_state, claim=job.key, active=True) is not None
+        else:
+            user_data = await self.db.get_user(job.user_id)
+            if user_data is None or user_data.pause_flag == 1:
+                return
+            claimed = await self.db.claim_job(job.key)
+        if not claimed:
+            return
+
+        keyboard = job.payload.get('keyboard')
+        await bot.send_message(
+            chat_id=job.user_id,
+            text=job.payload['text'],
+            reply_markup=get_keyboard(keyboard) if keyboard else None,
+            rate_limit_args=job.payload.get('priority', PRIORITY_LOW)
         )
 
-        # Ждем и предлагаем новый сеанс
-        await asyncio.sleep(2)
+# ==================== НАПОМИНАНИЯ ====================
+
+class ReminderCampaign:
+    """Напоминания пользователям, давно не проходившим сеанс.
 
-        user_data = self.db.get_or_create_user(user_id)
-        if user_data['pause_flag'] == 0:
-            await context.bot.send_message(
+    Раз в сутки создаётся кампания с фиксированной границей простоя.
+    Пользователи выбираются порциями по индексу idx_users_idle с keyset-курсором
+    (updated_at, id), курсор хранится в campaign_progress — прерванная кампания
+    продолжается с места остановки. Порция отмечается в reminders до отправки,
+    поэтому после сбоя никто не получит напоминание дважды. Отправка идёт
+    с низким приоритетом через общий ограничитель: ответы на действия
+    пользователей не ждут рассылку.
+    """
+
+    def __init__(self, db: AsyncDatabase,
+                 idle_hours: float = REMINDER_IDLE_HOURS,
+                 batch_size: int = REMINDER_BATCH_SIZE,
+                 interval: float = REMINDER_INTERVAL):
+        self.db = db
+        self.idle_hours = idle_hours
+        self.batch_size = batch_size
+        self.interval = interval
+        self.stats: Dict[str, int] = {'sent': 0, 'skipped': 0, 'failed': 0}
+        self._task: Optional[asyncio.Task] = None
+
+    def campaign(self) -> Tuple[str, str]:
+        """Имя сегодняшней кампании и граница простоя (формат CURRENT_TIMESTAMP, UTC)"""
+        now = datetime.now(timezone.utc)
+        cutoff = now - timedelta(hours=self.idle_hours)
+        return f"idle-{now.date().isoformat()}", cutoff.strftime('%Y-%m-%d %H:%M:%S')
+
+    async def run_once(self, bot) -> Dict[str, int]:
+        """Пройти (или дозавершить) сегодняшнюю кампанию; возвращает итоги отправки"""
+        if self.idle_hours <= 0:
+            return {}
+        campaign, cutoff = self.campaign()
+        result = Counter()
+        for state in REMINDER_STATES:
+            # При возобновлении граница берётся из сохранённой кампании
+            cutoff, after_updated_at, after_user_id, finished = \
+                await self.db.campaign_cursor(campaign, state, cutoff)
+            while not finished:
+                page = await self.db.idle_users_page(
+                    state, cutoff, after_updated_at, after_user_id, self.batch_size
+                )
+                if not page:
+                    await self.db.finish_campaign(campaign, state)
+                    break
+                last_user_id, last_updated_at = page[-1]
+                user_ids = [user_id for user_id, _ in page]
+                if not await self.db.claim_reminders(campaign, state, user_ids, after_updated_at, after_user_id,
+                                                     last_updated_at, last_user_id):
+                    # Порцию забрал другой процесс — продолжаем с его курсора
+                    cutoff, after_updated_at, after_user_id, finished = \
+                        await self.db.campaign_cursor(campaign, state, cutoff)
+                    continue
+                after_updated_at, after_user_id = last_updated_at, last_user_id
+                outcomes = await asyncio.gather(*(self._remind(bot, user_id, state) for user_id in user_ids))
+                result.update(outcomes)
+        for outcome, count in result.items():
+            self.stats[outcome] += count
+        if result:
+            logging.info(f"Напоминания {campaign}: {dict(result)}")
+        return dict(result)
+
+    async def _remind(self, bot, user_id: int, state: str) -> str:
+        # Пользователь мог поставить паузу или начать сеанс, пока шла кампания
+        user_data = await self.db.get_user(user_id)
+        if not user_data or user_data.pause_flag or user_data.current_state != state:
+            return 'skipped'
+        try:
+            await bot.send_message(
                 chat_id=user_id,
-                text=MESSAGES['READY_FOR_NEXT'],
-                reply_markup=get_keyboard(STATES['S3_READY_FOR_SESSION'])
+                text=MESSAGES['REMINDER'],
+                reply_markup=get_keyboard(STATES['S3_READY_FOR_SESSION']),
+                rate_limit_args=PRIORITY_LOW
+            )
+        except TelegramError as e:
+            logging.warning(f"Напоминание пользователю {user_id} не отправлено: {e}")
+            return 'failed'
+        return 'sent'
+
+    def start(self, bot):
+        self._task = asyncio.create_task(self._run(bot))
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    async def _run(self, bot):
+        while True:
+            try:
+                await self.run_once(bot)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logging.error(f"Ошибка кампании напоминаний: {e}")
+            await asyncio.sleep(self.interval)
+
+# ==================== ТАБЛИЦА ПЕРЕХОДОВ ====================
+
+class Transition(NamedTuple):
+    """Строка таблицы переходов FSM"""
+    state: str                         # состояние диалога, в котором нажата кнопка
+    text: str                          # текст кнопки
+    handler: str                       # метод StateHandlers: запись перехода в БД и текст ответа
+    next_state: str                    # состояние после нажатия (в БД и у ConversationHandler)
+    keyboard: Optional[str]            # клавиатура ответа (KEYBOARD_LAYOUTS); None — убрать
+    priority: int = PRIORITY_NORMAL    # приоритет ответа в очереди отправки
+
+
+class Reply(NamedTuple):
+    """Ответ обработчика, выбравшего другой исход, чем строка таблицы"""
+    text: str
+    next_state: str
+    keyboard: Optional[str]
+    priority: int = PRIORITY_NORMAL
+
+
+# Сценарий S0–S8 целиком: каждая показанная кнопка обязана иметь строку здесь
+TRANSITIONS = (
+    Transition(STATES['S0_INIT'], "Начать", 'handle_s0_init',
+               STATES['S1_CONFIRM_CONDITIONS'], STATES['S1_CONFIRM_CONDITIONS']),
+    Transition(STATES['S1_CONFIRM_CONDITIONS'], "Подтверждаю", 'handle_s1_confirm',
+               STATES['S2_CHECK_CONTRAINDICATIONS'], STATES['S2_CHECK_CONTRAINDICATIONS']),
+    Transition(STATES['S1_CONFIRM_CONDITIONS'], "Не подтверждаю", 'handle_s1_confirm',
+               STATES['S8_PAUSE'], None, PRIORITY_CRITICAL),
+    Transition(STATES['S2_CHECK_CONTRAINDICATIONS'], "Да", 'handle_s2_check',
+               STATES['S8_PAUSE'], None, PRIORITY_CRITICAL),
+    # Следующий вопрос; после последнего обработчик отвечает переходом в S3
+    Transition(STATES['S2_CHECK_CONTRAINDICATIONS'], "Нет", 'handle_s2_check',
+               STATES['S2_CHECK_CONTRAINDICATIONS'], STATES['S2_CHECK_CONTRAINDICATIONS']),
+    Transition(STATES['S3_READY_FOR_SESSION'], "Начать сеанс", 'handle_s3_ready',
+               STATES['S4_SESSION_ACTIVE'], None),
+    # Кнопку "Продолжить" присылает планировщик, диалог при этом может остаться в S4
+    Transition(STATES['S4_SESSION_ACTIVE'], "Продолжить", 'handle_s5_post_session',
+               STATES['S6_FEEDBACK'], STATES['S6_FEEDBACK']),
+    Transition(STATES['S5_POST_SESSION'], "Продолжить", 'handle_s5_post_session',
+               STATES['S6_FEEDBACK'], STATES['S6_FEEDBACK']),
+    Transition(STATES['S6_FEEDBACK'], "Комфортно", 'handle_s6_feedback',
+               STATES['S7_REGULAR_USE'], None),
+    Transition(STATES['S6_FEEDBACK'], "Нейтрально", 'handle_s6_feedback',
+               STATES['S7_REGULAR_USE'], None),
+    Transition(STATES['S6_FEEDBACK'], "Дискомфорт", 'handle_s6_feedback',
+               STATES['S6_FEEDBACK'], "DISCOMFORT_DETAIL"),
+    Transition(STATES['S6_FEEDBACK'], "Да", 'handle_s6_discomfort_detail',
+               STATES['S8_PAUSE'], None, PRIORITY_CRITICAL),
+    Transition(STATES['S6_FEEDBACK'], "Нет", 'handle_s6_discomfort_detail',
+               STATES['S7_REGULAR_USE'], None),
+    # Предложение нового сеанса присылает планировщик, диалог при этом остаётся в S7
+    Transition(STATES['S7_REGULAR_USE'], "Начать сеанс", 'handle_s3_ready',
+               STATES['S4_SESSION_ACTIVE'], None),
+)
+
+# Клавиатуры, которые показываются вне таблицы (планировщик, напоминания, команды):
+# состояния диалога, в которых их видит пользователь (по умолчанию — состояние,
+# именем которого клавиатура названа)
+KEYBOARD_STATES = {
+    STATES['S3_READY_FOR_SESSION']: (STATES['S3_READY_FOR_SESSION'], STATES['S7_REGULAR_USE']),
+    STATES['S5_POST_SESSION']: (STATES['S4_SESSION_ACTIVE'], STATES['S5_POST_SESSION']),
+    "DISCOMFORT_DETAIL": (STATES['S6_FEEDBACK'],),
+}
+
+
+class TransitionDispatcher:
+    """Таблица переходов, скомпилированная в словари состояние -> кнопка -> обработчик.
+
+    На каждое состояние приходится один MessageHandler с фильтром по множеству
+    кнопок; выбор обработчика — поиск в словаре вместо цепочки регулярных выражений.
+    Следующее состояние, клавиатура и приоритет ответа берутся из строки таблицы.
+    """
+
+    def __init__(self, state_handlers: 'StateHandlers', transitions: Tuple[Transition, ...] = TRANSITIONS):
+        self.routes: Dict[str, Dict[str, Tuple[Transition, Callable]]] = {state: {} for state in STATES.values()}
+        for transition in transitions:
+            routes = self.routes[transition.state]
+            if transition.text in routes:
+                raise ValueError(f"Дублирующийся переход: {transition.state} / {transition.text}")
+            routes[transition.text] = (transition, instrumented(
+                transition.state,
+                transition.handler,
+                functools.partial(getattr(state_handlers, transition.handler), step=transition)
+            ))
+        self._validate(transitions)
+
+    def _validate(self, transitions: Tuple[Transition, ...]):
+        """Каждая кнопка каждой клавиатуры должна вести к обработчику"""
+        shown = [(keyboard, state) for keyboard in KEYBOARD_LAYOUTS
+                 for state in KEYBOARD_STATES.get(keyboard, (keyboard,))]
+        for transition in transitions:
+            if transition.next_state not in self.routes:
+                raise ValueError(f"Неизвестное состояние {transition.next_state} в таблице переходов")
+            if transition.keyboard is not None:
+                if transition.keyboard not in KEYBOARD_LAYOUTS:
+                    raise ValueError(f"Неизвестная клавиатура {transition.keyboard} в таблице переходов")
+                shown.append((transition.keyboard, transition.next_state))
+        for keyboard, state in shown:
+            for row in KEYBOARD_LAYOUTS[keyboard]:
+                for text in row:
+                    if text not in self.routes[state]:
+                        raise ValueError(
+                            f"Кнопка '{text}' в состоянии {state} "
+                            f"не описана в таблице переходов"
+                        )
+
+    def handlers(self) -> Dict[str, List[MessageHandler]]:
+        """Обработчики для ConversationHandler(states=...)"""
+        states = {}
+        for state, routes in self.routes.items():
+            states[state] = [
+                MessageHandler(filters.Text(frozenset(routes)), functools.partial(self.dispatch, state))
+            ] if routes else []
+        return states
+
+    async def dispatch(self, state: str, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[str]:
+        """Нажатие кнопки в состоянии state: обработчик, ответ и следующее состояние диалога"""
+        transition, callback = self.routes[state][update.message.text]
+        reply = await callback(update, context)
+        if reply is None:
+            # Кнопка сейчас не действует: ответа нет, состояние не меняется
+            return None
+        if not isinstance(reply, Reply):
+            reply = Reply(reply, transition.next_state, transition.keyboard, transition.priority)
+        with send_priority(reply.priority):
+            await update.message.reply_text(
+                reply.text,
+                reply_markup=get_keyboard(reply.keyboard) if reply.keyboard else ReplyKeyboardRemove()
             )
+        return reply.next_state
 
-            self.db.update_user_state(user_id, STATES['S3_READY_FOR_SESSION'])
-            return STATES['S3_READY_FOR_SESSION']
+# ==================== ЗАВЕРШЕНИЕ И ПЕРЕДАЧА ПРИЁМА ====================
 
-        return STATES['S7_REGULAR_USE']
+class IngestLock:
+    """Замок процесса, принимающего обновления: pid-файл под flock.
+
+    Ядро снимает flock при завершении процесса, поэтому после падения замок
+    не остаётся занятым. Файл не удаляется: иначе ожидающий процесс мог бы
+    взять замок на удалённом файле одновременно с новым, создавшим файл заново.
+    """
+
+    def __init__(self, path: str = PIDFILE):
+        self.path = path
+        self._fd: Optional[int] = None
+
+    def owner(self) -> Optional[int]:
+        """pid, записанный владельцем замка (None — файла нет или он пуст)"""
+        try:
+            with open(self.path, encoding='ascii') as f:
+                return int(f.read().strip() or 0) or None
+        except (OSError, ValueError):
+            return None
+
+    def acquire(self) -> bool:
+        """Взять замок без ожидания и записать свой pid"""
+        if fcntl is None:
+            return True
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            return False
+        os.ftruncate(fd, 0)
+        os.write(fd, f"{os.getpid()}\n".encode('ascii'))
+        self._fd = fd
+        return True
+
+    async def wait_acquire(self, timeout: float) -> bool:
+        """Ждать освобождения замка не дольше timeout"""
+        deadline = time.monotonic() + timeout
+        while not self.acquire():
+            if time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.02)
+        return True
+
+    def release(self):
+        if self._fd is not None:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+            os.close(self._fd)
+            self._fd = None
+
+
+def add_stop_handlers(stop_event: asyncio.Event) -> bool:
+    """SIGINT/SIGTERM выставляют stop_event.
+
+    Цикл событий Windows обработчиков сигналов не поддерживает (False):
+    тогда asyncio.run по Ctrl+C отменяет главную задачу, и wait_stop
+    превращает отмену в выставление stop_event.
+    """
+    loop = asyncio.get_running_loop()
+    try:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop_event.set)
+    except NotImplementedError:
+        return False
+    return True
+
+
+async def wait_stop(stop_event: asyncio.Event, handlers: bool,
+                    serving: Optional[asyncio.Future] = None):
+    """Ждать stop_event (или завершения serving, работающего до stop_event).
+
+    Без обработчиков сигналов Ctrl+C (KeyboardInterrupt) тоже ведёт
+    к корректному завершению: отмена главной задачи снимается и
+    выставляется stop_event.
+    """
+    waiter = serving or asyncio.ensure_future(stop_event.wait())
+    while True:
+        try:
+            return await asyncio.shield(waiter)
+        except asyncio.CancelledError:
+            if handlers or waiter.done():
+                raise
+            task = asyncio.current_task()
+            if hasattr(task, 'uncancel'):
+                task.uncancel()
+            stop_event.set()
 
 # ==================== ОСНОВНОЙ КЛАСС БОТА ====================
 
@@ -704,101 +4537,251 @@ class ProductModeResultBot:
     """Главный класс Telegram-бота"""
 
     def __init__(self, token: str):
-        self.token = token
-        self.db = Database()
-        self.command_handlers = CommandHandlers(self.db)
-        self.state_handlers = StateHandlers(self.db)
-
-        # Настройка логирования
+        # Логирование настраивается до открытия БД: миграции схемы пишут в лог
         logging.basicConfig(
             format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
             level=logging.INFO
         )
         self.logger = logging.getLogger(__name__)
 
+        self.token = token
+        self.db = AsyncDatabase(DB_NAME, backend=STORAGE_BACKEND)
+        self.scheduler = JobScheduler(self.db)
+        self.profiler = UpdateProfiler()
+        self.command_handlers = CommandHandlers(self.db, self.scheduler, self.profiler)
+        self.state_handlers = StateHandlers(self.db, self.scheduler)
+        self.dispatcher = TransitionDispatcher(self.state_handlers)
+        self.scheduler.register('session_end', self.state_handlers.complete_session)
+        self.scheduler.register('delayed_message', self.state_handlers.send_delayed_message)
+        self.persistence = SQLitePersistence(self.db)
+        self.update_processor = PerUserUpdateProcessor(profiler=self.profiler)
+        self.rate_limiter = PriorityRateLimiter()
+        self.loop_monitor = LoopLagMonitor()
+        self.retention = RetentionWorker(self.db)
+        self.reminders = ReminderCampaign(self.db)
+        # Создаётся вместе с ConversationHandler в create_application
+        self.evictor: Optional[IdleUserEvictor] = None
+        self.metrics_server: Optional[MetricsServer] = None
+        self.metrics_port = METRICS_PORT
+        self._migration_task: Optional[asyncio.Task] = None
+        self._users_by_state: Dict[str, int] = {}
+        self._users_by_state_at: Optional[float] = None
+        self._register_metrics()
+
     def create_application(self) -> Application:
         """Создание и настройка приложения бота"""
 
         # Создаем приложение
-        application = Application.builder().token(self.token).build()
+        builder = (
+            Application.builder()
+            .token(self.token)
+            .persistence(self.persistence)
+            .concurrent_updates(self.update_processor)
+            .rate_limiter(self.rate_limiter)
+        )
+        if BOT_API_URL:
+            builder = builder.base_url(f"{BOT_API_URL.rstrip('/')}/bot")
+        application = builder.build()
 
         # Добавляем обработчик ошибок
         application.add_error_handler(self._error_handler)
 
+        # Команды с замером времени (метка состояния — command)
+        commands = {
+            name: instrumented('command', f"handle_{name}", getattr(self.command_handlers, f"handle_{name}"))
+            for name in ('start', 'status', 'pause', 'resume', 'help', 'profile')
+        }
+
         # Создаем Conversation Handler для управления состояниями
-        conv_handler = ConversationHandler(
-            entry_points=[CommandHandler('start', self.command_handlers.handle_start)],
-            states={
-                STATES['S0_INIT']: [
-                    MessageHandler(filters.Regex('^Начать$'), self.state_handlers.handle_s0_init)
-                ],
-                STATES['S1_CONFIRM_CONDITIONS']: [
-                    MessageHandler(
-                        filters.Regex('^(Подтверждаю|Не подтверждаю)$'),
-                        self.state_handlers.handle_s1_confirm
-                    )
-                ],
-                STATES['S2_CHECK_CONTRAINDICATIONS']: [
-                    MessageHandler(
-                        filters.Regex('^(Да|Нет)$'),
-                        self.state_handlers.handle_s2_check
-                    )
-                ],
-                STATES['S3_READY_FOR_SESSION']: [
-                    MessageHandler(
-                        filters.Regex('^Начать сеанс$'),
-                        self.state_handlers.handle_s3_ready
-                    )
-                ],
-                STATES['S4_SESSION_ACTIVE']: [
-                    # В этом состоянии бот не обрабатывает сообщения
-                ],
-                STATES['S5_POST_SESSION']: [
-                    MessageHandler(
-                        filters.Regex('^Продолжить$'),
-                        self.state_handlers.handle_s5_post_session
-                    )
-                ],
-                STATES['S6_FEEDBACK']: [
-                    MessageHandler(
-                        filters.Regex('^(Комфортно|Нейтрально)$'),
-                        self.state_handlers.handle_s6_feedback
-                    ),
-                    MessageHandler(
-                        filters.Regex('^Дискомфорт$'),
-                        self.state_handlers.handle_s6_feedback
-                    ),
-                    MessageHandler(
-                        filters.Regex('^(Да|Нет)$'),
-                        self.state_handlers.handle_s6_discomfort_detail
-                    )
-                ],
-                STATES['S7_REGULAR_USE']: [
-                    # Можно добавить переход к новому сеансу
-                ],
-                STATES['S8_PAUSE']: [
-                    # Обработка через команду /resume
-                ]
-            },
+        # (состояния диалогов сохраняются в SQLite и переживают рестарт)
+        conv_handler = PersistentConversationHandler(
+            name='fsm',
+            persistent=True,
+            entry_points=[CommandHandler('start', commands['start'])],
+            states=self.dispatcher.handlers(),
             fallbacks=[
-                CommandHandler('start', self.command_handlers.handle_start),
-                CommandHandler('status', self.command_handlers.handle_status),
-                CommandHandler('pause', self.command_handlers.handle_pause),
-                CommandHandler('resume', self.command_handlers.handle_resume),
-                CommandHandler('help', self.command_handlers.handle_help),
+                CommandHandler(name, commands[name])
+                for name in ('start', 'status', 'pause', 'resume', 'help')
             ],
             allow_reentry=True
         )
 
-        # Регистрируем обработчики
+        self.evictor = IdleUserEvictor(self.persistence, conv_handler)
+
+        # Регистрируем обработчики; восстановление диалога идёт раньше остальных
+        application.add_handler(TypeHandler(Update, conv_handler.rehydrate_conversation), group=-1)
         application.add_handler(conv_handler)
-        application.add_handler(CommandHandler('status', self.command_handlers.handle_status))
-        application.add_handler(CommandHandler('pause', self.command_handlers.handle_pause))
-        application.add_handler(CommandHandler('resume', self.command_handlers.handle_resume))
-        application.add_handler(CommandHandler('help', self.command_handlers.handle_help))
+        for name in ('status', 'pause', 'resume', 'help', 'profile'):
+            application.add_handler(CommandHandler(name, commands[name]))
 
         return application
 
+    def _leads_cluster(self) -> bool:
+        """Процесс ведёт общие фоновые задачи: вне кластера или первый обработчик"""
+        return self.scheduler.shard is None or self.scheduler.shard[0] == 0
+
+    async def _post_init(self, application: Application):
+        """Запуск фоновых сервисов после инициализации приложения"""
+        if self.evictor:
+            PTBInternals.check(application, self.evictor.conversation)
+        # Восстанавливаем таймеры из БД; просроченные сработают сразу
+        with startup_phase('scheduler'):
+            await self.scheduler.start(application.bot)
+        self.loop_monitor.start()
+        # Фоновые шаги схемы (сборка индексов) — после старта, в кластере их ведёт первый обработчик
+        if self.db.maintenance and self._leads_cluster():
+            self._migration_task = asyncio.create_task(self._migrate_online(application.bot))
+        # Архивирование и удаление по сроку хранения — только у MaintenanceStorage;
+        # в кластере его ведёт первый обработчик: таблицы логов общие
+        if RETENTION_DAYS > 0 and self.db.maintenance and self._leads_cluster():
+            self.retention.start()
+        # В кластере кампанию ведёт только первый обработчик: курсор общий.
+        # С MaintenanceStorage она стартует в _migrate_online: выборка идёт
+        # по индексу idx_users_idle, который строится фоновой миграцией
+        if REMINDER_IDLE_HOURS > 0 and self._leads_cluster() and not self.db.maintenance:
+            self.reminders.start(application.bot)
+        if USER_IDLE_EVICT > 0 and self.evictor:
+            self.evictor.start(application)
+
+        # Профилирование без рестарта: SIGUSR1 включает/выключает сэмплирование
+        try:
+            asyncio.get_running_loop().add_signal_handler(signal.SIGUSR1, self.profiler.toggle)
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass
+        if PROFILE_ON_START:
+            try:
+                self.profiler.start_from_spec(PROFILE_ON_START)
+            except ValueError as e:
+                self.logger.error(f"Некорректная переменная PROFILE: {e}")
+
+        if self.metrics_port:
+            self.metrics_server = MetricsServer(port=self.metrics_port)
+            self.metrics_server.refreshers.append(self._refresh_users_by_state)
+            try:
+                await self.metrics_server.start()
+            except OSError as e:
+                # Метрики не должны мешать работе бота
+                self.logger.error(f"Не удалось запустить сервер метрик: {e}")
+                self.metrics_server = None
+
+        self.logger.info("Фазы запуска:\n" + startup_report())
+
+    async def _post_shutdown(self, application: Application, timeout: Optional[float] = None):
+        """Остановка фоновых сервисов при завершении приложения
+
+        timeout — сколько ждать уже сработавшие задачи планировщика.
+        """
+        if self.metrics_server:
+            await self.metrics_server.stop()
+            self.metrics_server = None
+        self.profiler.stop()
+        try:
+            asyncio.get_running_loop().remove_signal_handler(signal.SIGUSR1)
+        except (NotImplementedError, RuntimeError, AttributeError):
+            pass
+        if self._migration_task:
+            self._migration_task.cancel()
+            self._migration_task = None
+        await self.reminders.stop()
+        if self.evictor:
+            await self.evictor.stop()
+        await self.retention.stop()
+        await self.loop_monitor.stop()
+        await self.scheduler.stop(timeout)
+
+    def _register_metrics(self):
+        """Значения, снимаемые при запросе /metrics"""
+        METRICS.collector(
+            'bot_active_timers', "Отложенные задачи в планировщике (таймеры сеансов и сообщения)",
+            'gauge', lambda: len(self.scheduler)
+        )
+        METRICS.collector(
+            'bot_users_by_state', "Пользователи по current_state (кэш METRICS_STATE_TTL)",
+            'gauge', lambda: self._users_by_state, labels=('state',)
+        )
+        METRICS.collector(
+            'bot_event_loop_lag_last_seconds', "Последний замер задержки event loop",
+            'gauge', lambda: self.loop_monitor.lag
+        )
+        METRICS.collector(
+            'bot_updates_in_flight', "Обновления в обработке",
+            'gauge', lambda: self.update_processor.in_flight
+        )
+        METRICS.collector(
+            'bot_updates_processed_total', "Обработанные обновления",
+            'counter', lambda: self.update_processor.processed
+        )
+        METRICS.collector(
+            'bot_send_queue_depth', "Исходящие запросы, ожидающие отправки",
+            'gauge', lambda: self.rate_limiter.queue_depth()
+        )
+        METRICS.collector(
+            'bot_send_errors_total', "Ошибки отправки в Bot API",
+            'counter', lambda: self.rate_limiter.stats['send_errors']
+        )
+        METRICS.collector(
+            'bot_send_retries_total', "Повторы отправки после RetryAfter",
+            'counter', lambda: self.rate_limiter.stats['retries']
+        )
+        METRICS.collector(
+            'bot_db_commits_total', "Коммиты пишущего соединения",
+            'counter', lambda: self.db.commit_stats()['commits']
+        )
+        METRICS.collector(
+            'bot_write_behind_queue_depth', "Строки логов в очереди отложенной записи",
+            'gauge', lambda: (self.db.write_behind_stats() or {}).get('queue_depth')
+        )
+        METRICS.collector(
+            'bot_write_behind_flush_errors_total', "Ошибки записи пакетов логов (повод для тревоги)",
+            'counter', lambda: (self.db.write_behind_stats() or {}).get('flush_errors')
+        )
+        METRICS.collector(
+            'bot_write_behind_dropped_rows_total', "Строки логов, потерянные после ошибок записи",
+            'counter', lambda: (self.db.write_behind_stats() or {}).get('dropped_rows')
+        )
+        METRICS.collector(
+            'bot_retention_purged_rows_total', "Строки логов, удалённые по сроку хранения",
+            'counter', lambda: self.retention.purged, labels=('table',)
+        )
+        METRICS.collector(
+            'bot_reminders_total', "Напоминания неактивным пользователям по исходу",
+            'counter', lambda: self.reminders.stats, labels=('outcome',)
+        )
+        METRICS.collector(
+            'bot_users_resident', "Пользователи, чьи user_data и диалоги загружены в память",
+            'gauge', self.persistence.resident_users
+        )
+        METRICS.collector(
+            'bot_users_evicted_total', "Выгрузки простаивающих пользователей из памяти",
+            'counter', lambda: self.evictor.evicted if self.evictor else 0
+        )
+
+    async def _migrate_online(self, bot):
+        """Фоновые миграции: чтения идут параллельно, записи ждут в очереди потока БД.
+
+        Кампания напоминаний запускается после них: без индекса idx_users_idle
+        каждая её порция просматривала бы всю таблицу users.
+        """
+        try:
+            applied = await self.db.migrate(online=True)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.logger.error(f"Ошибка фоновой миграции схемы, напоминания не запущены: {e}")
+            return
+        if applied:
+            self.logger.info(f"Фоновые миграции схемы применены: {applied}")
+        if REMINDER_IDLE_HOURS > 0:
+            self.reminders.start(bot)
+
+    async def _refresh_users_by_state(self):
+        """Пересчёт пользователей по состояниям не чаще METRICS_STATE_TTL"""
+        if self._users_by_state_at is not None and \
+                time.monotonic() - self._users_by_state_at < METRICS_STATE_TTL:
+            return
+        self._users_by_state = await self.db.count_users_by_state()
+        self._users_by_state_at = time.monotonic()
+
     async def _error_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик ошибок"""
         self.logger.error(f"Ошибка: {context.error}", exc_info=True)
@@ -809,36 +4792,573 @@ class ProductModeResultBot:
         except:
             pass
 
-    def run(self):
-        """Запуск бота"""
+    def run(self, mode: str = BOT_MODE, handoff: bool = False):
+        """Запуск бота
+
+        handoff — принять приём обновлений у работающего экземпляра (PIDFILE):
+        новый процесс полностью готовится, затем останавливает старый
+        и начинает приём, как только тот его освободит.
+        """
+        lock = IngestLock()
+        if not handoff and not lock.acquire():
+            print(f"❌ Бот уже запущен (pid {lock.owner()}, замок {lock.path}).")
+            print("   Перезапуск без простоя: python bot.py --handoff")
+            return
+
         print("=" * 50)
         print("🚀 Запуск Telegram-бота 'Продукт → Режим → Результат'")
         print("=" * 50)
         print(f"📊 База данных: {self.db.db_name}")
+        print(f"💾 Хранилище: {self.db.backend}, профиль: {DB_PROFILE}, читателей: {DB_READERS}")
         print(f"⏱  Длительность сеанса: {SESSION_DURATION} сек.")
         print(f"🔄 Режим паузы: /pause, /resume")
         print(f"📈 Статус: /status")
         print(f"❓ Помощь: /help")
+        print(f"📡 Режим приёма обновлений: {mode}")
         print("=" * 50)
         print("⏸  Для остановки нажмите Ctrl+C")
         print("=" * 50)
 
         # Создаем и запускаем приложение
-        application = self.create_application()
-        application.run_polling()
+        with startup_phase('application_build'):
+            application = self.create_application()
+        webhook = None
+        if mode == 'webhook':
+            # SO_REUSEPORT: при передаче приёма новый процесс слушает порт вместе со старым
+            webhook = WebhookServer(application, reuse_port=hasattr(socket, 'SO_REUSEPORT'))
+        asyncio.run(self._serve(application, webhook, lock, handoff))
+
+    def run_shard(self, shard: int, shards: int, port: int, secret: str):
+        """Запуск обработчика кластера: обновления шарда приходят от входного процесса.
+
+        Обработчик не вызывает getUpdates/setWebhook, принимает обновления
+        на 127.0.0.1:port и загружает только задачи своего шарда. Глобальный
+        лимит отправки делится между обработчиками поровну.
+        """
+        self.scheduler.shard = (shard, shards)
+        self.rate_limiter = PriorityRateLimiter(global_rate=SEND_GLOBAL_RATE / shards)
+        if self.metrics_port:
+            self.metrics_port += 1 + shard
+
+        with startup_phase('application_build'):
+            application = self.create_application()
+        webhook = WebhookServer(application, secret_token=secret, host='127.0.0.1', port=port)
+        self.logger.info(f"Обработчик {shard + 1}/{shards} (pid {os.getpid()}) на порту {port}")
+        asyncio.run(self._serve(application, webhook, register_webhook=False))
+
+    async def _serve(self, application: Application, webhook: Optional[WebhookServer] = None,
+                     lock: Optional[IngestLock] = None, handoff: bool = False,
+                     register_webhook: bool = True):
+        """Работа до SIGINT/SIGTERM с корректным завершением
+
+        webhook — сервер приёма (без него — polling). register_webhook=False
+        у обработчика кластера: адрес у Telegram регистрирует входной процесс.
+        lock — замок приёма; при handoff он забирается у работающего процесса
+        после полной готовности этого. Обработка обновлений (application.start)
+        и фоновые сервисы (_post_init: планировщик, напоминания, хранение логов,
+        фоновая миграция) запускаются только с замком: до этого webhook лишь
+        копит обновления в update_queue. Так обновления одного пользователя
+        не идут в двух процессах сразу, диалоги и задачи читаются из БД уже
+        после записи их старым процессом, а кампанию и задачи ведёт один процесс.
+        """
+        stop_event = asyncio.Event()
+        handlers = add_stop_handlers(stop_event)
+
+        async with application:
+            if webhook:
+                await webhook.start()
+            if handoff:
+                await self._take_over(lock)
+            await self._post_init(application)
+            await application.start()
+
+            if webhook is None:
+                await application.updater.start_polling()
+            elif WEBHOOK_URL and register_webhook:
+                await application.bot.set_webhook(
+                    url=WEBHOOK_URL,
+                    secret_token=WEBHOOK_SECRET or None,
+                    allowed_updates=Update.ALL_TYPES
+                )
+
+            await wait_stop(stop_event, handlers)
+            await self._shutdown(application, webhook, lock)
+
+    async def _take_over(self, lock: IngestLock):
+        """Передача приёма: SIGTERM владельцу замка и ожидание, пока он перестанет принимать"""
+        started = time.monotonic()
+        owner = None
+        if not lock.acquire():
+            owner = lock.owner()
+            if owner:
+                self.logger.info(f"Передача приёма: останавливаем процесс {owner}")
+                try:
+                    os.kill(owner, signal.SIGTERM)
+                except ProcessLookupError:
+                    pass
+            if not await lock.wait_acquire(HANDOFF_TIMEOUT):
+                raise RuntimeError(f"Процесс {owner} не освободил приём за {HANDOFF_TIMEOUT:.0f} сек")
+        self.logger.info(f"Приём обновлений у этого процесса (предыдущий: {owner or 'нет'}), "
+                         f"ожидание {(time.monotonic() - started) * 1000:.0f} мс")
+
+    async def _shutdown(self, application: Application, webhook: Optional[WebhookServer],
+                        lock: Optional[IngestLock]):
+        """Корректное завершение.
+
+        1. Приём обновлений останавливается (webhook нового процесса
+           --handoff уже слушает порт и копит обновления).
+        2. Начатые и полученные обновления обрабатываются не дольше
+           DRAIN_TIMEOUT, оставшиеся прерываются.
+        3. Фоновые сервисы останавливаются; сработавшие задачи планировщика
+           дорабатывают в остатке срока, остальные таймеры и отложенные
+           сообщения уже в БД и восстановятся при следующем старте.
+        4. Персистентность и отложенные логи записываются в БД, и только
+           затем освобождается замок: новый процесс читает из БД актуальные
+           диалоги и user_data, а поздняя запись этого процесса не перетрёт его данные.
+        """
+        started = time.monotonic()
+        if application.updater and application.updater.running:
+            await application.updater.stop()
+        if webhook:
+            await webhook.stop()
+
+        pending = self.update_processor.in_flight + application.update_queue.qsize()
+        stopping = asyncio.ensure_future(application.stop())
+        await asyncio.wait({stopping}, timeout=DRAIN_TIMEOUT)
+        aborted = 0
+        while not stopping.done():
+            aborted += self.update_processor.cancel_in_flight()
+            await asyncio.wait({stopping}, timeout=1.0)
+        stopping.result()
+
+        await self._post_shutdown(application, timeout=max(DRAIN_TIMEOUT - (time.monotonic() - started), 0.0))
+
+        await application.update_persistence()
+        await self.persistence.flush()
+        await self.db.flush_logs()
+        if lock:
+            lock.release()
+        self.logger.info(f"Остановка за {time.monotonic() - started:.2f} сек: обновлений в работе "
+                         f"было {pending}, прервано по DRAIN_TIMEOUT {aborted}")
 
     def get_analytics(self) -> Dict[str, Any]:
         """Получить аналитику системы"""
-        return self.db.get_analytics()
+        return self.db.call_read('get_analytics')
+
+    def get_send_metrics(self) -> Dict[str, Any]:
+        """Метрики очереди исходящих сообщений"""
+        return self.rate_limiter.metrics()
 
     def close(self):
         """Корректное завершение работы"""
+        # Сначала дописываем отложенные строки логов, затем закрываем БД
+        self.db.call('flush_logs')
         self.db.close()
         self.logger.info("Бот завершил работу")
 
+# ==================== КЛАСТЕР ====================
+
+def update_user_id(update: Dict[str, Any]) -> Optional[int]:
+    """id пользователя (или чата) из сырого обновления Telegram без разбора в объекты PTB"""
+    for value in update.values():
+        if not isinstance(value, dict):
+            continue
+        user = value.get('from') or value.get('user')
+        if isinstance(user, dict) and 'id' in user:
+            return user['id']
+        chat = value.get('chat') or (value.get('message') or {}).get('chat')
+        if isinstance(chat, dict) and 'id' in chat:
+            return chat['id']
+    return None
+
+
+class ShardForwarder:
+    """Пересылка обновлений одного шарда его процессу-обработчику.
+
+    Одно keep-alive соединение с WebhookServer обработчика; обновления
+    отправляются строго по очереди, поэтому порядок внутри шарда сохраняется.
+    Пока обработчик недоступен (падение, перезапуск), текущее обновление
+    повторяется с растущей паузой, остальные ждут в очереди.
+    """
+
+    def __init__(self, shard: int, port: int, secret: str, max_pending: int = MAX_PENDING_UPDATES):
+        self.shard = shard
+        self.port = port
+        self.secret = secret
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=max_pending)
+        self.stats = {'forwarded': 0, 'retries': 0, 'dropped': 0}
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def drain(self, timeout: float):
+        """Дождаться пересылки очереди (не дольше timeout секунд)"""
+        try:
+            await asyncio.wait_for(self.queue.join(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Шард {self.shard}: не переслано обновлений: {self.queue.qsize()}")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        self._close()
+
+    def _close(self):
+        if self._writer:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def _post(self, body: bytes) -> int:
+        """POST обновления обработчику; возвращает HTTP-статус"""
+        if self._writer is None:
+            self._reader, self._writer = await asyncio.open_connection('127.0.0.1', self.port)
+        self._writer.write((
+            f"POST {WEBHOOK_PATH} HTTP/1.1\r\n"
+            f"Host: 127.0.0.1\r\n"
+            f"Content-Type: application/json\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"X-Telegram-Bot-Api-Secret-Token: {self.secret}\r\n\r\n"
+        ).encode() + body)
+        await self._writer.drain()
+
+        status_line = await self._reader.readline()
+        if not status_line:
+            raise ConnectionError("Обработчик закрыл соединение")
+        length = 0
+        while True:
+            line = await self._reader.readline()
+            if line in (b'\r\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            if name.lower() == 'content-length':
+                length = int(value)
+        if length:
+            await self._reader.readexactly(length)
+        return int(status_line.split()[1])
+
+    async def _run(self):
+        while True:
+            body = await self.queue.get()
+            delay = 0.05
+            while True:
+                try:
+                    status = await self._post(body)
+                except (OSError, ValueError, asyncio.IncompleteReadError):
+                    self._close()
+                    status = None
+                if status == 200:
+                    self.stats['forwarded'] += 1
+                    break
+                if status == 400:
+                    # Обработчик не смог разобрать обновление: повтор не поможет
+                    self.stats['dropped'] += 1
+                    break
+                self.stats['retries'] += 1
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 2.0)
+            self.queue.task_done()
+
+
+class ClusterSupervisor:
+    """Входной процесс кластера и надзор за процессами-обработчиками.
+
+    Принимает обновления (getUpdates или webhook) как сырой JSON, без разбора
+    в объекты PTB, и по telegram_user_id отправляет каждое в свой шард:
+    пользователь всегда обслуживается одним процессом, поэтому порядок
+    обновлений, context.user_data и кэш пользователей остаются согласованными.
+    Обработчики — обычные ProductModeResultBot (run_shard), запущенные через
+    multiprocessing; упавший обработчик перезапускается с растущей паузой,
+    а его обновления ждут в очереди шарда.
+    """
+
+    def __init__(self, token: str, workers: int = WORKERS, mode: str = BOT_MODE,
+                 base_port: int = CLUSTER_BASE_PORT):
+        self.token = token
+        self.workers = workers
+        self.mode = mode
+        self.base_port = base_port
+        # Секрет между входным процессом и обработчиками, новый на каждый запуск
+        self.secret = secrets.token_hex(16)
+        self.forwarders = [ShardForwarder(shard, base_port + shard, self.secret) for shard in range(workers)]
+        self.processes: List[Optional['multiprocessing.Process']] = [None] * workers
+        self.restarts = [0] * workers
+        self.stats = {'accepted': 0, 'rejected': 0, 'malformed': 0, 'overflow': 0}
+        import multiprocessing
+        self._context = multiprocessing.get_context('spawn')
+        self._started_at = [0.0] * workers
+        self._failures = [0] * workers
+        self._restart_at: List[Optional[float]] = [None] * workers
+        self._stopping = False
+
+        logging.basicConfig(
+            format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+            level=logging.INFO
+        )
+
+    def run(self):
+        asyncio.run(self._main())
+
+    def _spawn(self, shard: int):
+        process = self._context.Process(
+            target=run_worker,
+            args=(self.token, shard, self.workers, self.base_port + shard, self.secret),
+            name=f"worker-{shard}",
+            daemon=True
+        )
+        process.start()
+        self.processes[shard] = process
+        self._started_at[shard] = time.monotonic()
+
+    def forwarder_for(self, update: Dict[str, Any]) -> ShardForwarder:
+        """Шард обновления; обновления без пользователя идут в шард 0"""
+        user_id = update_user_id(update)
+        return self.forwarders[shard_for(user_id, self.workers) if user_id is not None else 0]
+
+    async def _main(self):
+        stop_event = asyncio.Event()
+        handlers = add_stop_handlers(stop_event)
+        await wait_stop(stop_event, handlers, asyncio.ensure_future(self.serve(stop_event)))
+
+    async def serve(self, stop_event: asyncio.Event):
+        """Работа кластера до stop_event"""
+        loop = asyncio.get_running_loop()
+        # Схему мигрируют сами обработчики: шаг применяется под BEGIN IMMEDIATE
+        # один раз, фоновые шаги ведёт первый обработчик
+        for shard in range(self.workers):
+            self._spawn(shard)
+        for forwarder in self.forwarders:
+            forwarder.start()
+        watcher = asyncio.create_task(self._watch())
+        logging.info(f"Кластер: {self.workers} обработчиков, приём обновлений: {self.mode}")
+
+        api_url = f"{(BOT_API_URL or 'https://api.telegram.org').rstrip('/')}/bot{self.token}/"
+        async with httpx.AsyncClient(base_url=api_url, timeout=httpx.Timeout(10.0, read=40.0)) as client:
+            if self.mode == 'webhook':
+                http = HttpServer(WEBHOOK_LISTEN, WEBHOOK_PORT)
+                http.route('POST', WEBHOOK_PATH, self.handle_update)
+                http.route('GET', '/healthz', self.handle_health)
+                await http.start()
+                logging.info(f"Webhook кластера слушает {http.host}:{http.port}{WEBHOOK_PATH}")
+                if WEBHOOK_URL:
+                    await self._api(client, 'setWebhook', url=WEBHOOK_URL,
+                                    secret_token=WEBHOOK_SECRET or None,
+                                    allowed_updates=Update.ALL_TYPES)
+                await stop_event.wait()
+                await http.stop()
+            else:
+                poller = asyncio.create_task(self._poll(client))
+                await stop_event.wait()
+                poller.cancel()
+                await asyncio.gather(poller, return_exceptions=True)
+
+        # Остановка: дописываем очереди шардов, затем SIGTERM обработчикам
+        self._stopping = True
+        watcher.cancel()
+        await asyncio.gather(*(forwarder.drain(10.0) for forwarder in self.forwarders))
+        for forwarder in self.forwarders:
+            await forwarder.stop()
+        for process in self.processes:
+            if process and process.is_alive():
+                process.terminate()
+        for process in self.processes:
+            if process:
+                await loop.run_in_executor(None, process.join, 15)
+                if process.is_alive():
+                    process.kill()
+        logging.info("Кластер остановлен")
+
+    async def _api(self, client: httpx.AsyncClient, method: str, **params) -> Any:
+        """Вызов Bot API; параметры как у PTB: строки как есть, остальное — JSON"""
+        data = {
+            name: value if isinstance(value, str) else json.dumps(value)
+            for name, value in params.items() if value is not None
+        }
+        response = await client.post(method, data=data)
+        payload = response.json()
+        if not payload.get('ok'):
+            raise RuntimeError(f"{method}: {payload.get('description')}")
+        return payload['result']
+
+    async def _poll(self, client: httpx.AsyncClient):
+        """Long polling getUpdates; при переполнении шарда чтение приостанавливается"""
+        await self._api(client, 'deleteWebhook')
+        offset = 0
+        while True:
+            try:
+                updates = await self._api(client, 'getUpdates', offset=offset, timeout=30,
+                                          allowed_updates=Update.ALL_TYPES)
+            except (httpx.HTTPError, RuntimeError, ValueError) as e:
+                logging.error(f"Ошибка getUpdates: {e}")
+                await asyncio.sleep(1)
+                continue
+            touched = set()
+            for update in updates:
+                forwarder = self.forwarder_for(update)
+                await forwarder.queue.put(json.dumps(update).encode())
+                touched.add(forwarder)
+                self.stats['accepted'] += 1
+            # offset подтверждает порцию Telegram при следующем getUpdates, поэтому
+            # сдвигается только после пересылки обработчикам: при падении входного
+            # процесса неподтверждённые обновления Telegram отдаст заново
+            for forwarder in touched:
+                await forwarder.queue.join()
+            if updates:
+                offset = updates[-1]['update_id'] + 1
+
+    async def handle_update(self, request: HttpRequest) -> HttpResponse:
+        """POST от Telegram: проверка секрета и постановка в очередь шарда.
+
+        Telegram считает обновление доставленным по ответу 200, поэтому
+        обновления, ещё не пересланные из очередей шардов, при падении
+        входного процесса теряются (в отличие от polling).
+        """
+        if WEBHOOK_SECRET:
+            received = request.headers.get('x-telegram-bot-api-secret-token', '')
+            if not hmac.compare_digest(received, WEBHOOK_SECRET):
+                self.stats['rejected'] += 1
+                return HttpResponse(403)
+        try:
+            update = json.loads(request.body)
+        except ValueError:
+            self.stats['malformed'] += 1
+            return HttpResponse(400)
+        try:
+            self.forwarder_for(update).queue.put_nowait(request.body)
+        except asyncio.QueueFull:
+            # Telegram повторит доставку позже
+            self.stats['overflow'] += 1
+            return HttpResponse(503)
+        self.stats['accepted'] += 1
+        return HttpResponse(200)
+
+    async def handle_health(self, request: HttpRequest) -> HttpResponse:
+        """Состояние обработчиков и очередей шардов"""
+        workers = [
+            {
+                'shard': shard,
+                'pid': process.pid if process else None,
+                'alive': bool(process and process.is_alive()),
+                'restarts': self.restarts[shard],
+                'queue': self.forwarders[shard].queue.qsize(),
+                **self.forwarders[shard].stats
+            }
+            for shard, process in enumerate(self.processes)
+        ]
+        healthy = all(worker['alive'] for worker in workers)
+        body = json.dumps({'status': 'ok' if healthy else 'degraded', 'workers': workers, **self.stats})
+        return HttpResponse(200 if healthy else 503, body.encode(), 'application/json')
+
+    async def _watch(self):
+        """Перезапуск упавших обработчиков: пауза растёт при частых падениях"""
+        while True:
+            await asyncio.sleep(1)
+            now = time.monotonic()
+            for shard, process in enumerate(self.processes):
+                if self._stopping or process is None or process.is_alive():
+                    continue
+                if self._restart_at[shard] is None:
+                    # Проработавший больше минуты обработчик перезапускается сразу
+                    if now - self._started_at[shard] > 60:
+                        self._failures[shard] = 0
+                    delay = min(2.0 ** self._failures[shard] - 1, CLUSTER_RESTART_MAX_DELAY)
+                    self._failures[shard] += 1
+                    self._restart_at[shard] = now + delay
+                    logging.error(
+                        f"Обработчик {shard + 1}/{self.workers} завершился (код {process.exitcode}), "
+                        f"перезапуск через {delay:.0f} сек."
+                    )
+                elif now >= self._restart_at[shard]:
+                    self._restart_at[shard] = None
+                    self.restarts[shard] += 1
+                    self._spawn(shard)
+
+
+def run_worker(token: str, shard: int, shards: int, port: int, secret: str):
+    """Точка входа процесса-обработчика кластера"""
+    with startup_phase('bot_init'):
+        worker = ProductModeResultBot(token)
+    try:
+        worker.run_shard(shard, shards, port, secret)
+    finally:
+        worker.close()
+
 # ==================== ЗАПУСК ПРОГРАММЫ ====================
 
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description="Telegram-бот 'Продукт → Режим → Результат'")
+    parser.add_argument(
+        '--rebuild-analytics',
+        action='store_true',
+        help="пересчитать счётчики аналитики по сырым логам и выйти"
+    )
+    parser.add_argument(
+        '--retention',
+        action='store_true',
+        help="свернуть, заархивировать и удалить логи старше RETENTION_DAYS и выйти"
+    )
+    parser.add_argument(
+        '--migrate',
+        action='store_true',
+        help="применить все миграции схемы, включая фоновую сборку индексов, и выйти"
+    )
+    parser.add_argument(
+        '--startup-report',
+        action='store_true',
+        help="собрать бота без приёма обновлений, вывести время фаз запуска и выйти"
+    )
+    parser.add_argument(
+        '--handoff',
+        action='store_true',
+        help="перезапуск без простоя: подготовиться, остановить работающий экземпляр (PIDFILE) и принять приём"
+    )
+    parser.add_argument(
+        '--mode',
+        choices=['polling', 'webhook'],
+        default=BOT_MODE,
+        help="режим приёма обновлений (по умолчанию BOT_MODE)"
+    )
+    parser.add_argument(
+        '--workers',
+        type=int,
+        default=WORKERS,
+        help="число процессов-обработчиков, шардированных по пользователю (0 — без кластера)"
+    )
+    args = parser.parse_args()
+
+    if args.rebuild_analytics:
+        database = Database(DB_NAME, migrate=False)
+        database.rebuild_analytics()
+        print(f"📊 Счётчики пересчитаны: {database.get_analytics()}")
+        database.close()
+        exit(0)
+
+    if args.migrate:
+        database = Database(DB_NAME, readers=0, cache_size=0)
+        applied = database.migrate(online=True)
+        print(f"🧱 Схема БД v{database.schema_version()}, применены миграции: {applied or 'нет'}")
+        database.close()
+        exit(0)
+
+    if args.retention:
+        async def run_retention():
+            database = AsyncDatabase(DB_NAME, migrate=False)
+            try:
+                return await RetentionWorker(database).run_once()
+            finally:
+                database.close()
+
+        print(f"🗄  Удалено строк логов: {asyncio.run(run_retention())}")
+        exit(0)
+
     # Получаем токен (можно из переменной окружения или из файла)
     token = BOT_TOKEN
 
@@ -860,11 +5380,26 @@ if __name__ == '__main__':
         print("BOT_TOKEN=ваш_токен_здесь")
         exit(1)
 
+    if args.workers > 0:
+        # Этот процесс только принимает обновления и распределяет их по обработчикам
+        ClusterSupervisor(token, args.workers, args.mode).run()
+        exit(0)
+
     # Создаем и запускаем бота
-    bot = ProductModeResultBot(token)
+    with startup_phase('bot_init'):
+        bot = ProductModeResultBot(token)
+
+    if args.startup_report:
+        # Запуск без приёма обновлений: импорты, открытие БД, миграции, сборка приложения
+        with startup_phase('application_build'):
+            bot.create_application()
+        bot.close()
+        print(f"⏱  Фазы запуска (схема БД v{SCHEMA_VERSION}):")
+        print(startup_report())
+        exit(0)
 
     try:
-        bot.run()
+        bot.run(args.mode, handoff=args.handoff)
     except KeyboardInterrupt:
         print("\n\n👋 Завершение работы бота...")
     except Exception as e:
@@ -0,0 +1,417 @@
+"""
+Проверки конкурентных компонентов бота
+
+Сценарии, которые трудно поймать нагрузочным тестом: порядок обновлений
+в полосе пользователя при параллельной работе разных полос, порядок
+отправки по приоритетам и повтор после RetryAfter, отмена отложенной
+задачи, которая уже сработала. Каждая проверка — отдельный event loop
+с ограничением по времени; зависание считается ошибкой. Проверки
+планировщика работают с хранилищем STORAGE_BACKEND (или --backend)
+во временном каталоге. Код возврата 1, если хотя бы одна проверка не прошла.
+
+Примеры:
+    python concurrency_checks.py
+    python concurrency_checks.py --check lane_keeps_order --verbose
+    python concurrency_checks.py --backend memory
+"""
+
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import time
+import traceback
+from contextlib import contextmanager
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Awaitable, Callable, Iterator, List, Optional
+
+from telegram.error import RetryAfter
+
+from bot import (
+    PRIORITY_CRITICAL, PRIORITY_LOW, STATES, STORAGE_BACKEND, STORAGE_BACKENDS, AsyncDatabase,
+    JobScheduler, PerUserUpdateProcessor, PriorityRateLimiter, ScheduledJob, send_priority
+)
+
+CHECKS: List[Callable[[], Awaitable[None]]] = []
+
+# Ограничение времени одной проверки, сек.
+CHECK_TIMEOUT = 5.0
+
+# Бэкенд хранилища для проверок планировщика (--backend)
+backend = STORAGE_BACKEND
+
+
+def check(func: Callable[[], Awaitable[None]]) -> Callable[[], Awaitable[None]]:
+    """Зарегистрировать проверку"""
+    CHECKS.append(func)
+    return func
+
+
+def expect(actual, expected, what: str):
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+def fake_update(user_id: Optional[int]) -> SimpleNamespace:
+    """Обновление с effective_user, как его видит PerUserUpdateProcessor"""
+    return SimpleNamespace(effective_user=SimpleNamespace(id=user_id) if user_id is not None else None)
+
+
+# ==================== ДИСПЕТЧЕР ОБНОВЛЕНИЙ ====================
+
+@check
+async def lane_keeps_order():
+    processor = PerUserUpdateProcessor(max_concurrent=8)
+    finished: List[int] = []
+    active = {'now': 0, 'max': 0}
+
+    async def handle(number: int):
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        # Ранние обновления работают дольше: без полосы они финишировали бы последними
+        await asyncio.sleep(0.01 * (5 - number))
+        active['now'] -= 1
+        finished.append(number)
+
+    tasks = [asyncio.create_task(processor.process_update(fake_update(1), handle(number)))
+             for number in range(5)]
+    await asyncio.sleep(0.005)
+    expect(processor.lane_depths(), {1: 5}, "глубина полосы во время обработки")
+    await asyncio.gather(*tasks)
+
+    expect(finished, [0, 1, 2, 3, 4], "порядок обработки в полосе")
+    expect(active['max'], 1, "одновременно обрабатываемых обновлений пользователя")
+    expect(processor.stats()['lanes'], 0, "полосы после обработки")
+    expect(processor.processed, 5, "обработано обновлений")
+
+
+@check
+async def lanes_run_in_parallel():
+    processor = PerUserUpdateProcessor(max_concurrent=8)
+    arrived = set()
+    everyone = asyncio.Event()
+
+    async def handle(user_id: int):
+        arrived.add(user_id)
+        if len(arrived) == 3:
+            everyone.set()
+        # Последовательные полосы не дождутся друг друга
+        try:
+            await asyncio.wait_for(everyone.wait(), 1.0)
+        except asyncio.TimeoutError:
+            raise AssertionError(f"полоса {user_id} ждёт остальных: полосы выполняются по очереди")
+
+    await asyncio.gather(*(processor.process_update(fake_update(user_id), handle(user_id))
+                           for user_id in (1, 2, 3)))
+    expect(arrived, {1, 2, 3}, "полосы, начавшие работу одновременно")
+
+
+@check
+async def slow_user_does_not_block_others():
+    processor = PerUserUpdateProcessor(max_concurrent=8)
+    release = asyncio.Event()
+    finished: List[str] = []
+
+    async def slow():
+        await release.wait()
+        finished.append('slow')
+
+    async def fast(name: str):
+        finished.append(name)
+
+    slow_task = asyncio.create_task(processor.process_update(fake_update(1), slow()))
+    await asyncio.sleep(0)
+    await asyncio.gather(processor.process_update(fake_update(2), fast('other')),
+                         processor.process_update(fake_update(None), fast('no_user')))
+    expect(finished, ['other', 'no_user'], "обработаны, пока занята чужая полоса")
+    release.set()
+    await slow_task
+    expect(finished[-1], 'slow', "медленное обновление завершилось")
+
+
+@check
+async def concurrency_limit_caps_lanes():
+    processor = PerUserUpdateProcessor(max_concurrent=2)
+    active = {'now': 0, 'max': 0}
+
+    async def handle():
+        active['now'] += 1
+        active['max'] = max(active['max'], active['now'])
+        await asyncio.sleep(0.01)
+        active['now'] -= 1
+
+    await asyncio.gather(*(processor.process_update(fake_update(user_id), handle())
+                           for user_id in range(6)))
+    expect(active['max'], 2, "одновременно обрабатываемых обновлений при max_concurrent=2")
+    expect(processor.processed, 6, "обработано обновлений")
+
+
+# ==================== ИСХОДЯЩИЕ СООБЩЕНИЯ ====================
+
+async def send(limiter: PriorityRateLimiter, sent: List[str], name: str, chat_id: int,
+               priority: Optional[int] = None, endpoint: str = 'sendMessage'):
+    """Запрос через ограничитель; имя попадает в sent в момент отправки"""
+    async def callback():
+        sent.append(name)
+        return name
+
+    return await limiter.process_request(callback, (), {}, endpoint, {'chat_id': chat_id}, priority)
+
+
+async def drain(limiter: PriorityRateLimiter, count: int):
+    """Израсходовать count глобальных токенов (чаты разные, корзины чатов не мешают)"""
+    await asyncio.gather(*(send(limiter, [], 'drain', 1000 + number) for number in range(count)))
+
+
+@check
+async def limiter_sends_by_priority():
+    limiter = PriorityRateLimiter(global_rate=10, chat_rate=100, chat_burst=100)
+    sent: List[str] = []
+    await drain(limiter, 10)
+
+    # Очередь выстраивается в обратном порядке приоритета
+    with send_priority(PRIORITY_LOW):
+        low = asyncio.create_task(send(limiter, sent, 'low', 1))
+    normal = asyncio.create_task(send(limiter, sent, 'normal', 2))
+    critical = asyncio.create_task(send(limiter, sent, 'critical', 3, PRIORITY_CRITICAL))
+    await asyncio.sleep(0.01)
+    expect(limiter.queue_depth(), 3, "запросы в очереди без токенов")
+
+    # Служебные вызовы идут мимо очереди
+    await send(limiter, sent, 'getUpdates', 4, endpoint='getUpdates')
+    await asyncio.gather(low, normal, critical)
+    expect(sent, ['getUpdates', 'critical', 'normal', 'low'], "порядок отправки")
+    expect(limiter.metrics()['sent'], 13, "отправлено сообщений (служебные не считаются)")
+
+
+@check
+async def limiter_retries_after_server_delay():
+    limiter = PriorityRateLimiter(global_rate=10, chat_rate=100, chat_burst=100, max_retries=2)
+    sent: List[str] = []
+    attempts = []
+
+    async def flood_once():
+        attempts.append(asyncio.get_running_loop().time())
+        if len(attempts) == 1:
+            raise RetryAfter(timedelta(milliseconds=50))
+        sent.append('retried')
+
+    retried = asyncio.create_task(limiter.process_request(
+        flood_once, (), {}, 'sendMessage', {'chat_id': 1}, PRIORITY_LOW))
+    await asyncio.sleep(0.01)
+    # Пока запрос ждёт задержку сервера, остальные отправляются; токены кончаются
+    await drain(limiter, 9)
+    await asyncio.sleep(0.06)
+    # Повтор снова встал в общую очередь и пропускает вперёд более важный запрос
+    await send(limiter, sent, 'critical', 2, PRIORITY_CRITICAL)
+    await retried
+
+    expect(len(attempts), 2, "попыток отправки")
+    if attempts[1] - attempts[0] < 0.05:
+        raise AssertionError(f"повтор раньше задержки сервера: {attempts[1] - attempts[0]:.3f} сек.")
+    expect(sent, ['critical', 'retried'], "порядок после повтора")
+    expect(limiter.stats['retries'], 1, "повторов")
+
+
+@check
+async def limiter_gives_up_after_max_retries():
+    limiter = PriorityRateLimiter(global_rate=100, chat_rate=100, chat_burst=100, max_retries=2)
+    attempts = []
+
+    async def always_flood():
+        attempts.append(None)
+        raise RetryAfter(timedelta(milliseconds=10))
+
+    try:
+        await limiter.process_request(always_flood, (), {}, 'sendMessage', {'chat_id': 1}, None)
+    except RetryAfter:
+        pass
+    else:
+        raise AssertionError("RetryAfter после последней попытки не передан вызывающему")
+    expect(len(attempts), 3, "попыток при max_retries=2")
+    expect(limiter.metrics()['send_errors'], 1, "ошибок отправки")
+    expect(limiter.queue_depth(), 0, "очередь после отказа")
+
+
+# ==================== ПЛАНИРОВЩИК ====================
+
+@contextmanager
+def temporary_db() -> Iterator[AsyncDatabase]:
+    """Пустое хранилище во временном каталоге"""
+    with tempfile.TemporaryDirectory() as workdir:
+        db = AsyncDatabase(os.path.join(workdir, 'checks.db'), backend=backend)
+        try:
+            yield db
+        finally:
+            db.close()
+
+
+def session_end(user_id: int, delay: float) -> ScheduledJob:
+    return ScheduledJob(f"session_end:{user_id}", user_id, 'session_end', time.time() + delay, {})
+
+
+async def start_session(db: AsyncDatabase, scheduler: JobScheduler, job: ScheduledJob):
+    """Переход в S4 с сохранением задачи, как при начале сеанса"""
+    await db.get_or_create_user(job.user_id)
+    await db.transition(job.user_id, STATES['S4_SESSION_ACTIVE'], pause=0, schedule=job, cancel_jobs=True)
+    scheduler.add(job)
+
+
+async def pause_session(db: AsyncDatabase, scheduler: JobScheduler, user_id: int):
+    """Пауза с отменой задач в памяти и в хранилище, как в /pause"""
+    scheduler.cancel_user(user_id)
+    await db.transition(user_id, STATES['S8_PAUSE'], pause=1, cancel_jobs=True)
+
+
+async def complete_session(db: AsyncDatabase, job: ScheduledJob) -> bool:
+    """Переход в S5 с забором задачи из хранилища, как в complete_session"""
+    return await db.transition(job.user_id, STATES['S5_POST_SESSION'], claim=job.key, active=True) is not None
+
+
+@check
+async def scheduler_fires_in_due_order():
+    with temporary_db() as db:
+        scheduler = JobScheduler(db)
+        fired: List[int] = []
+
+        async def handle(job: ScheduledJob, bot):
+            fired.append(job.user_id)
+
+        scheduler.register('session_end', handle)
+        await scheduler.start(None)
+        for user_id, delay in ((1, 0.09), (2, 0.03), (3, 0.06)):
+            scheduler.add(session_end(user_id, delay))
+        # Задача раньше ближайшей будит спящий цикл
+        await asyncio.sleep(0.01)
+        scheduler.add(session_end(4, 0.0))
+        await asyncio.sleep(0.15)
+        await scheduler.stop()
+        expect(fired, [4, 2, 3, 1], "порядок срабатывания")
+        expect(len(scheduler), 0, "задач после срабатывания")
+
+
+@check
+async def cancelled_job_does_not_fire():
+    with temporary_db() as db:
+        scheduler = JobScheduler(db)
+        fired: List[str] = []
+
+        async def handle(job: ScheduledJob, bot):
+            fired.append(job.key)
+
+        scheduler.register('session_end', handle)
+        await scheduler.start(None)
+        await start_session(db, scheduler, session_end(1, 0.03))
+        await pause_session(db, scheduler, 1)
+        await asyncio.sleep(0.08)
+        await scheduler.stop()
+        expect(fired, [], "сработавшие отменённые задачи")
+        expect(await db.load_jobs(), [], "задачи в хранилище после паузы")
+
+
+async def run_fired_job_cancelled_meanwhile(reschedule: bool) -> List[float]:
+    """Задача срабатывает и ждёт в обработчике, пока пользователь ставит паузу
+    (и, если reschedule, начинает новый сеанс с тем же ключом задачи).
+    Возвращает due_at завершившихся задач.
+    """
+    with temporary_db() as db:
+        scheduler = JobScheduler(db)
+        started = asyncio.Event()
+        release = asyncio.Event()
+        completed: List[float] = []
+
+        async def handle(job: ScheduledJob, bot):
+            started.set()
+            await release.wait()
+            if await complete_session(db, job):
+                completed.append(job.due_at)
+
+        scheduler.register('session_end', handle)
+        await scheduler.start(None)
+        await start_session(db, scheduler, session_end(1, 0.02))
+        await started.wait()
+
+        await pause_session(db, scheduler, 1)
+        if reschedule:
+            await start_session(db, scheduler, session_end(1, 0.03))
+        release.set()
+        await asyncio.sleep(0.1)
+        await scheduler.stop()
+        return completed
+
+
+@check
+async def fired_job_cancelled_meanwhile_does_not_complete():
+    expect(await run_fired_job_cancelled_meanwhile(reschedule=False), [],
+           "завершения задачи, отменённой после срабатывания")
+
+
+@check
+async def fired_job_cancelled_and_rescheduled_completes_once():
+    completed = await run_fired_job_cancelled_meanwhile(reschedule=True)
+    expect(len(completed), 1, "завершений сеанса после паузы и нового сеанса")
+
+
+@check
+async def restart_fires_overdue_job_once():
+    with temporary_db() as db:
+        fired: List[str] = []
+
+        async def handle(job: ScheduledJob, bot):
+            if await complete_session(db, job):
+                fired.append(job.key)
+
+        # Задача сохранена до рестарта и к старту уже просрочена
+        await start_session(db, JobScheduler(db), session_end(1, -1.0))
+        for _ in range(2):
+            scheduler = JobScheduler(db)
+            scheduler.register('session_end', handle)
+            await scheduler.start(None)
+            await asyncio.sleep(0.03)
+            await scheduler.stop()
+        expect(fired, ['session_end:1'], "срабатывания после двух рестартов")
+
+
+# ==================== ЗАПУСК ====================
+
+def run_check(func: Callable[[], Awaitable[None]], verbose: bool) -> bool:
+    """Выполнить проверку в новом event loop; True, если прошла"""
+    try:
+        asyncio.run(asyncio.wait_for(func(), CHECK_TIMEOUT))
+        status = 'ok'
+    except asyncio.TimeoutError:
+        status = f"ОШИБКА: не завершилась за {CHECK_TIMEOUT} сек."
+    except Exception as e:
+        status = f"ОШИБКА: {e}"
+        if verbose:
+            traceback.print_exc()
+    print(f"{func.__name__:<52} {status}")
+    return status == 'ok'
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Проверки конкурентных компонентов бота")
+    parser.add_argument('--check', action='append', choices=[func.__name__ for func in CHECKS],
+                        help="выполнить только эту проверку (можно несколько раз)")
+    parser.add_argument('--backend', choices=sorted(STORAGE_BACKENDS), default=STORAGE_BACKEND,
+                        help="бэкенд хранилища для проверок планировщика")
+    parser.add_argument('--verbose', action='store_true', help="печатать трассировку ошибок")
+    args = parser.parse_args(argv)
+
+    global backend
+    backend = args.backend
+
+    selected = [func for func in CHECKS if not args.check or func.__name__ in args.check]
+    failed = [func.__name__ for func in selected if not run_check(func, args.verbose)]
+
+    if failed:
+        print(f"Не прошли: {', '.join(failed)}")
+        return 1
+    print(f"Все проверки пройдены ({len(selected)})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,150 @@
+"""
+Потоковая выгрузка логов бота для офлайн-аналитики
+
+Выгружает feedback_log, sessions и state_log порциями фиксированного
+размера (LogReader.export_rows, keyset-пагинация по id) в CSV или
+JSON Lines, при желании со сжатием gzip. Память не зависит от размера
+таблиц; выгрузка открывает только соединение для чтения (без пишущего
+соединения и миграций схемы), поэтому её можно запускать на живой базе,
+не мешая писателю бота.
+
+Инкрементальная выгрузка: с --state файл состояния хранит последний
+выгруженный id каждой таблицы, следующий запуск продолжит с него.
+Граница выгрузки (MAX(id)) фиксируется в начале, строки, записанные
+во время выгрузки, попадут в следующую. Файл выгрузки пишется во
+временный и переименовывается, состояние обновляется только после этого.
+
+Хранение логов (RETENTION_DAYS > 0) удаляет из state_log и feedback_log
+устаревшие строки независимо от выгрузки: строки, удалённые до очередной
+инкрементальной выгрузки, в неё не попадут и остаются только в архивных
+базах ARCHIVE_DIR. Интервал выгрузки должен быть меньше срока хранения.
+
+Примеры:
+    python export.py --out exports
+    python export.py --tables state_log --format csv --gzip --out exports
+    python export.py --state exports/state.json --out exports      # инкрементально
+    python export.py --tables feedback_log --since-id 120000 --out -  # в stdout
+"""
+
+import argparse
+import csv
+import gzip
+import json
+import os
+import sys
+import time
+from datetime import datetime
+from typing import Dict, List, Optional, TextIO
+
+from bot import DB_NAME, EXPORT_CHUNK_SIZE, EXPORT_TABLES, LogReader, ReaderPool
+
+
+def open_output(path: str, compress: bool) -> TextIO:
+    """Текстовый поток в файл (gzip при compress)"""
+    if compress:
+        return gzip.open(path, 'wt', compresslevel=6, encoding='utf-8', newline='')
+    return open(path, 'w', encoding='utf-8', newline='')
+
+
+def write_chunks(out: TextIO, table: str, chunks, fmt: str) -> int:
+    """Записать порции строк в формате csv/jsonl; возвращает число строк"""
+    columns = EXPORT_TABLES[table]
+    written = 0
+    if fmt == 'csv':
+        writer = csv.writer(out)
+        writer.writerow(columns)
+        for rows in chunks:
+            writer.writerows(rows)
+            written += len(rows)
+    else:
+        for rows in chunks:
+            out.write(''.join(
+                json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n' for row in rows
+            ))
+            written += len(rows)
+    return written
+
+
+def load_state(path: Optional[str]) -> Dict[str, int]:
+    """Последние выгруженные id по таблицам"""
+    if not path or not os.path.exists(path):
+        return {}
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('last_ids', {})
+
+
+def save_state(path: str, last_ids: Dict[str, int]):
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump({'last_ids': last_ids, 'updated_at': datetime.now().isoformat(timespec='seconds')},
+                  f, ensure_ascii=False, indent=2)
+    os.replace(tmp, path)
+
+
+def export_table(logs: LogReader, table: str, since_id: int, out_dir: str, fmt: str,
+                 compress: bool, chunk_size: int) -> Dict[str, object]:
+    """Выгрузить таблицу с id > since_id; возвращает сводку"""
+    until_id = logs.max_log_id(table)
+    started = time.perf_counter()
+    summary = {'table': table, 'since_id': since_id, 'until_id': until_id, 'rows': 0, 'file': None}
+    if until_id <= since_id:
+        return summary
+
+    chunks = logs.export_rows(table, since_id, until_id, chunk_size)
+    if out_dir == '-':
+        summary['rows'] = write_chunks(sys.stdout, table, chunks, fmt)
+    else:
+        extension = f"{fmt}.gz" if compress else fmt
+        path = os.path.join(out_dir, f"{table}-{since_id + 1}-{until_id}.{extension}")
+        tmp = f"{path}.part"
+        with open_output(tmp, compress) as out:
+            summary['rows'] = write_chunks(out, table, chunks, fmt)
+        os.replace(tmp, path)
+        summary['file'] = path
+
+    summary['elapsed_s'] = round(time.perf_counter() - started, 3)
+    return summary
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Потоковая выгрузка логов бота")
+    parser.add_argument('--db', default=DB_NAME, help="файл базы данных (по умолчанию DB_NAME)")
+    parser.add_argument('--tables', default=','.join(EXPORT_TABLES),
+                        help=f"таблицы через запятую (по умолчанию {','.join(EXPORT_TABLES)})")
+    parser.add_argument('--format', choices=['jsonl', 'csv'], default='jsonl', help="формат файлов")
+    parser.add_argument('--gzip', action='store_true', help="сжимать файлы gzip")
+    parser.add_argument('--out', default='exports', help="каталог выгрузки ('-' — stdout)")
+    parser.add_argument('--state', help="файл состояния инкрементальной выгрузки")
+    parser.add_argument('--since-id', type=int, help="выгрузить строки с id больше указанного")
+    parser.add_argument('--chunk-size', type=int, default=EXPORT_CHUNK_SIZE, help="строк в порции")
+    args = parser.parse_args(argv)
+
+    tables = [table.strip() for table in args.tables.split(',') if table.strip()]
+    unknown = [table for table in tables if table not in EXPORT_TABLES]
+    if unknown:
+        parser.error(f"неизвестные таблицы: {', '.join(unknown)}")
+    if not os.path.exists(args.db):
+        parser.error(f"база данных не найдена: {args.db}")
+    if args.out != '-':
+        os.makedirs(args.out, exist_ok=True)
+
+    last_ids = load_state(args.state)
+    # Только чтение: одно соединение mode=ro, схема базы не меняется
+    readers = ReaderPool(args.db, size=1)
+    logs = LogReader(readers.connection)
+    try:
+        for table in tables:
+            since_id = args.since_id if args.since_id is not None else last_ids.get(table, 0)
+            summary = export_table(logs, table, since_id, args.out, args.format, args.gzip, args.chunk_size)
+            if summary['rows']:
+                last_ids[table] = summary['until_id']
+                if args.state:
+                    save_state(args.state, last_ids)
+            print(json.dumps(summary, ensure_ascii=False), file=sys.stderr)
+    finally:
+        readers.close()
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,459 @@
+"""
+Нагрузочный тест бота на локальной заглушке Bot API
+
+FakeBotApi отвечает на методы Bot API, которые использует бот (getMe,
+getUpdates, setWebhook, deleteWebhook, sendMessage), поверх HttpServer
+из bot.py. Бот запускается в этом же процессе в режиме polling с
+BOT_API_URL, указывающим на заглушку, а N синтетических пользователей
+проходят сценарий S0 → S8 целиком: два сеанса с фидбэком, между ними
+/pause и /resume. Пользователь реагирует на присланные ботом сообщения,
+нажимая кнопки из клавиатуры.
+
+Отчёт: задержка ответа (обновление → первый sendMessage) p50/p99,
+обновлений/с, коммитов БД/с и пиковый RSS процесса (включает заглушку
+и генератор нагрузки).
+
+Примеры:
+    python loadtest.py --users 1000 --session-duration 1
+    python loadtest.py --users 10000 --ramp 30 --json
+    python loadtest.py --users 200 --telegram-limits
+    python loadtest.py --users 1000 --storage memory   # без SQLite
+    python loadtest.py --users 2000 --workers 4        # кластер из 4 процессов
+    python loadtest.py --api-only --port 8081   # только заглушка для BOT_API_URL
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import os
+import random
+import resource
+import tempfile
+import time
+from collections import deque
+from typing import Any, Callable, Deque, Dict, List, Optional
+from urllib.parse import parse_qsl
+
+import bot as bot_module
+from bot import (
+    MESSAGES,
+    STORAGE_BACKENDS,
+    ClusterSupervisor,
+    HttpRequest,
+    HttpResponse,
+    HttpServer,
+    PriorityRateLimiter,
+    ProductModeResultBot
+)
+from webhook_bench import percentile, synthetic_update_data
+
+TOKEN = "123456:LOADTEST"
+
+# Ответ пользователя в S6; "Дискомфорт" ведёт к уточнению, на которое отвечаем "Нет"
+FEEDBACK_CHOICES = ("Комфортно", "Нейтрально", "Дискомфорт")
+
+
+def parse_params(body: bytes) -> Dict[str, Any]:
+    """Параметры запроса PTB: form-urlencoded, нестроковые значения — в JSON"""
+    params = {}
+    for name, value in parse_qsl(body.decode(), keep_blank_values=True):
+        try:
+            params[name] = json.loads(value)
+        except ValueError:
+            params[name] = value
+    return params
+
+
+class FakeBotApi:
+    """Заглушка Bot API для одного токена.
+
+    Обновления, поставленные push_message, отдаются через getUpdates
+    (long polling с offset/limit/timeout, как у Telegram). Отправленные
+    ботом сообщения передаются в on_message(chat_id, text, buttons).
+    """
+
+    BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'LoadTest', 'username': 'loadtest_bot'}
+    METHODS = ('getMe', 'getUpdates', 'setWebhook', 'deleteWebhook', 'getWebhookInfo', 'sendMessage')
+
+    def __init__(self, token: str = TOKEN, host: str = '127.0.0.1', port: int = 0,
+                 on_message: Optional[Callable[[int, str, List[str]], None]] = None):
+        self.token = token
+        self.on_message = on_message
+        self.http = HttpServer(host, port)
+        for method in self.METHODS:
+            self.http.route('POST', f"/bot{token}/{method}", self._handler(method))
+
+        self.webhook_url = ''
+        self._updates: Deque[Dict[str, Any]] = deque()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._new_updates = asyncio.Event()
+        self.stats = {method: 0 for method in self.METHODS}
+        self.stats['updates_delivered'] = 0
+
+    @property
+    def url(self) -> str:
+        return f"http://{self.http.host}:{self.http.port}"
+
+    async def start(self):
+        await self.http.start()
+
+    async def stop(self):
+        await self.http.stop()
+
+    def push_message(self, user_id: int, text: str):
+        """Пользователь отправил сообщение боту"""
+        self._updates.append(synthetic_update_data(next(self._update_ids), user_id, text))
+        self._new_updates.set()
+
+    def _handler(self, method: str):
+        api_method = getattr(self, f"api_{method}")
+
+        async def handle(request: HttpRequest) -> HttpResponse:
+            self.stats[method] += 1
+            result = await api_method(parse_params(request.body))
+            body = json.dumps({'ok': True, 'result': result}, ensure_ascii=False)
+            return HttpResponse(200, body.encode(), 'application/json')
+        return handle
+
+    async def api_getMe(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return self.BOT_USER
+
+    async def api_getUpdates(self, params: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # offset подтверждает все обновления до него
+        offset = int(params.get('offset') or 0)
+        while self._updates and self._updates[0]['update_id'] < offset:
+            self._updates.popleft()
+
+        timeout = float(params.get('timeout') or 0)
+        if not self._updates and timeout > 0:
+            self._new_updates.clear()
+            try:
+                await asyncio.wait_for(self._new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+        limit = int(params.get('limit') or 100)
+        updates = list(itertools.islice(self._updates, limit))
+        self.stats['updates_delivered'] += len(updates)
+        return updates
+
+    async def api_setWebhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = params.get('url', '')
+        return True
+
+    async def api_deleteWebhook(self, params: Dict[str, Any]) -> bool:
+        self.webhook_url = ''
+        if params.get('drop_pending_updates'):
+            self._updates.clear()
+        return True
+
+    async def api_getWebhookInfo(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {'url': self.webhook_url, 'has_custom_certificate': False,
+                'pending_update_count': len(self._updates)}
+
+    async def api_sendMessage(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        chat_id = int(params['chat_id'])
+        text = str(params.get('text', ''))
+        markup = params.get('reply_markup') or {}
+        buttons = [button['text'] if isinstance(button, dict) else button
+                   for row in markup.get('keyboard', ()) for button in row]
+
+        if self.on_message:
+            self.on_message(chat_id, text, buttons)
+
+        return {
+            'message_id': next(self._message_ids),
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'private'},
+            'from': self.BOT_USER,
+            'text': text
+        }
+
+
+class SimulatedUser:
+    """Пользователь, проходящий сценарий по кнопкам бота"""
+    __slots__ = ('user_id', 'feedback', 'cycle', 'resumed', 'sent_at', 'done')
+
+    def __init__(self, user_id: int, feedback: str):
+        self.user_id = user_id
+        self.feedback = feedback
+        self.cycle = 0
+        self.resumed = False
+        self.sent_at: Optional[float] = None
+        self.done = False
+
+    def react(self, text: str, buttons: List[str]) -> Optional[str]:
+        """Ответ на сообщение бота (None — ждать следующего сообщения)"""
+        if text == MESSAGES['READY_FOR_NEXT']:
+            # После первого сеанса — пауза и возврат, после второго — конец сценария
+            self.cycle += 1
+            if self.cycle == 1:
+                return "/pause"
+            self.done = True
+            return None
+
+        if text == MESSAGES['S8']:
+            if self.resumed:
+                self.done = True
+                return None
+            self.resumed = True
+            return "/resume"
+
+        if not buttons:
+            return None
+        if "Нет" in buttons:
+            return "Нет"
+        if self.feedback in buttons:
+            return self.feedback
+        return buttons[0]
+
+
+class LoadTest:
+    """Генератор нагрузки: пользователи, задержки ответов и завершение"""
+
+    def __init__(self, api: FakeBotApi, users: int, seed: int = 1):
+        rng = random.Random(seed)
+        self.api = api
+        self.users = {
+            user_id: SimulatedUser(user_id, rng.choice(FEEDBACK_CHOICES))
+            for user_id in range(100000, 100000 + users)
+        }
+        self.latencies: List[float] = []
+        self.updates_sent = 0
+        self.messages_received = 0
+        self.finished = 0
+        self.all_done = asyncio.Event()
+        api.on_message = self.on_message
+
+    def send(self, user: SimulatedUser, text: str):
+        user.sent_at = time.perf_counter()
+        self.updates_sent += 1
+        self.api.push_message(user.user_id, text)
+
+    def on_message(self, chat_id: int, text: str, buttons: List[str]):
+        user = self.users.get(chat_id)
+        if user is None or user.done:
+            return
+        self.messages_received += 1
+        if user.sent_at is not None:
+            self.latencies.append(time.perf_counter() - user.sent_at)
+            user.sent_at = None
+
+        reply = user.react(text, buttons)
+        if reply is not None:
+            self.send(user, reply)
+        elif user.done:
+            self.finished += 1
+            if self.finished == len(self.users):
+                self.all_done.set()
+
+    async def start_users(self, ramp: float):
+        """Каждый пользователь отправляет /start; с ramp — равномерно за ramp секунд"""
+        pause = ramp / len(self.users) if ramp > 0 else 0
+        for user in self.users.values():
+            self.send(user, "/start")
+            if pause:
+                await asyncio.sleep(pause)
+
+
+def peak_rss_mb() -> float:
+    """Пиковый RSS процесса (ru_maxrss в Linux — в КБ)"""
+    return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+async def run_loadtest(users: int, session_duration: int, follow_up_delay: float,
+                       ramp: float, timeout: float, telegram_limits: bool, db_name: str,
+                       storage: str = 'sqlite') -> Dict[str, Any]:
+    """Поднять заглушку и бота, прогнать сценарий и собрать метрики"""
+    api = FakeBotApi()
+    await api.start()
+
+    # Конфигурация бота читается при создании объектов, поэтому задаётся до них
+    bot_module.SESSION_DURATION = session_duration
+    bot_module.FOLLOW_UP_DELAY = follow_up_delay
+    bot_module.BOT_API_URL = api.url
+    bot_module.DB_NAME = db_name
+    bot_module.STORAGE_BACKEND = storage
+
+    product_bot = ProductModeResultBot(TOKEN)
+    if not telegram_limits:
+        # Лимиты Telegram замеряли бы заглушку, а не бота
+        product_bot.rate_limiter = PriorityRateLimiter(
+            global_rate=1e6, chat_rate=1e6, chat_burst=1_000_000
+        )
+    application = product_bot.create_application()
+    load = LoadTest(api, users)
+
+    started = time.perf_counter()
+    async with application:
+        await product_bot._post_init(application)
+        await application.start()
+        await application.updater.start_polling(poll_interval=0, timeout=1)
+
+        await load.start_users(ramp)
+        try:
+            await asyncio.wait_for(load.all_done.wait(), timeout)
+        except asyncio.TimeoutError:
+            logging.warning(f"Не все пользователи завершили сценарий за {timeout} сек.")
+        elapsed = time.perf_counter() - started
+
+        await application.updater.stop()
+        await application.stop()
+        await product_bot._post_shutdown(application)
+
+    commits = product_bot.db.commit_stats()
+    processor = product_bot.update_processor.stats()
+    sends = product_bot.rate_limiter.metrics()
+    product_bot.close()
+    await api.stop()
+
+    load.latencies.sort()
+    return {
+        'users': users,
+        'storage': storage,
+        'users_finished': load.finished,
+        'elapsed_s': round(elapsed, 3),
+        'updates': load.updates_sent,
+        'updates_per_s': round(load.updates_sent / elapsed, 1),
+        'messages_sent_by_bot': load.messages_received,
+        'reply_p50_ms': round(percentile(load.latencies, 50) * 1000, 3),
+        'reply_p99_ms': round(percentile(load.latencies, 99) * 1000, 3),
+        'reply_max_ms': round(load.latencies[-1] * 1000, 3) if load.latencies else 0.0,
+        'db_commits': commits['commits'],
+        'db_commits_per_s': round(commits['commits'] / elapsed, 1),
+        'db_log_flushes': commits['log_flushes'],
+        'update_wait_avg_ms': processor['wait_avg_ms'],
+        'update_wait_max_ms': processor['wait_max_ms'],
+        'send_queue': sends,
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+async def run_cluster_loadtest(users: int, workers: int, session_duration: int, follow_up_delay: float,
+                               ramp: float, timeout: float, telegram_limits: bool, db_name: str,
+                               storage: str = 'sqlite') -> Dict[str, Any]:
+    """То же, что run_loadtest, но бот работает кластером из workers процессов.
+
+    Обработчики запускаются как отдельные процессы и читают конфигурацию
+    из окружения, поэтому она задаётся через os.environ до их запуска.
+    """
+    api = FakeBotApi()
+    await api.start()
+
+    os.environ.update({
+        'SESSION_DURATION': str(session_duration),
+        'FOLLOW_UP_DELAY': str(follow_up_delay),
+        'BOT_API_URL': api.url,
+        'DB_NAME': db_name,
+        'STORAGE_BACKEND': storage,
+        'METRICS_PORT': '0'
+    })
+    if not telegram_limits:
+        os.environ.update({'SEND_GLOBAL_RATE': '1e6', 'SEND_CHAT_RATE': '1e6', 'SEND_CHAT_BURST': '1000000'})
+    bot_module.BOT_API_URL = api.url
+    bot_module.DB_NAME = db_name
+    bot_module.STORAGE_BACKEND = storage
+
+    supervisor = ClusterSupervisor(TOKEN, workers, mode='polling')
+    stop_event = asyncio.Event()
+    cluster = asyncio.create_task(supervisor.serve(stop_event))
+    load = LoadTest(api, users)
+
+    started = time.perf_counter()
+    await load.start_users(ramp)
+    try:
+        await asyncio.wait_for(load.all_done.wait(), timeout)
+    except asyncio.TimeoutError:
+        logging.warning(f"Не все пользователи завершили сценарий за {timeout} сек.")
+    elapsed = time.perf_counter() - started
+
+    stop_event.set()
+    await cluster
+    await api.stop()
+
+    load.latencies.sort()
+    return {
+        'users': users,
+        'workers': workers,
+        'storage': storage,
+        'users_finished': load.finished,
+        'elapsed_s': round(elapsed, 3),
+        'updates': load.updates_sent,
+        'updates_per_s': round(load.updates_sent / elapsed, 1),
+        'messages_sent_by_bot': load.messages_received,
+        'reply_p50_ms': round(percentile(load.latencies, 50) * 1000, 3),
+        'reply_p99_ms': round(percentile(load.latencies, 99) * 1000, 3),
+        'reply_max_ms': round(load.latencies[-1] * 1000, 3) if load.latencies else 0.0,
+        'worker_restarts': sum(supervisor.restarts),
+        'peak_rss_mb': peak_rss_mb()
+    }
+
+
+async def serve_api(host: str, port: int):
+    """Только заглушка Bot API, до Ctrl+C"""
+    api = FakeBotApi(host=host, port=port)
+    await api.start()
+    print(f"Заглушка Bot API: BOT_API_URL={api.url}, токен {TOKEN}")
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await api.stop()
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Нагрузочный тест бота на заглушке Bot API")
+    parser.add_argument('--users', type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument('--session-duration', type=int, default=1,
+                        help="SESSION_DURATION на время теста (сек.)")
+    parser.add_argument('--follow-up-delay', type=float, default=0.2,
+                        help="FOLLOW_UP_DELAY на время теста (сек.)")
+    parser.add_argument('--ramp', type=float, default=0.0,
+                        help="растянуть /start всех пользователей на столько секунд")
+    parser.add_argument('--timeout', type=float, default=600.0, help="предельное время прогона (сек.)")
+    parser.add_argument('--telegram-limits', action='store_true',
+                        help="оставить лимиты отправки Telegram (по умолчанию сняты)")
+    parser.add_argument('--db', help="файл БД (по умолчанию — временный)")
+    parser.add_argument('--workers', type=int, default=0,
+                        help="запустить бота кластером из N процессов (0 — в процессе теста)")
+    parser.add_argument('--storage', choices=sorted(STORAGE_BACKENDS), default='sqlite',
+                        help="бэкенд хранилища бота (memory — без диска, предел по самому боту)")
+    parser.add_argument('--json', action='store_true', help="вывести отчёт одной строкой JSON")
+    parser.add_argument('--api-only', action='store_true', help="только поднять заглушку Bot API")
+    parser.add_argument('--host', default='127.0.0.1', help="адрес заглушки для --api-only")
+    parser.add_argument('--port', type=int, default=8081, help="порт заглушки для --api-only")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+                        level=logging.WARNING)
+
+    if args.api_only:
+        try:
+            asyncio.run(serve_api(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
+        return
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_name = args.db or os.path.join(tmp, 'loadtest.db')
+        if args.workers > 0:
+            result = asyncio.run(run_cluster_loadtest(
+                args.users, args.workers, args.session_duration, args.follow_up_delay,
+                args.ramp, args.timeout, args.telegram_limits, db_name, args.storage
+            ))
+        else:
+            result = asyncio.run(run_loadtest(
+                args.users, args.session_duration, args.follow_up_delay,
+                args.ramp, args.timeout, args.telegram_limits, db_name, args.storage
+            ))
+
+    if args.json:
+        print(json.dumps(result, ensure_ascii=False))
+    else:
+        print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
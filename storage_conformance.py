@@ -0,0 +1,265 @@
+"""
+Общий набор проверок бэкендов хранилища (протокол Storage)
+
+Каждая проверка получает свежее хранилище и проверяет поведение, на которое
+опираются обработчики, планировщик и персистентность: создание пользователей,
+атомарные переходы, счётчики аналитики, отложенные задачи, сохранение
+диалогов. Набор запускается для всех бэкендов из STORAGE_BACKENDS (или для
+перечисленных в --backend); новый бэкенд считается готовым, когда проходит его.
+Код возврата 1, если хотя бы одна проверка не прошла.
+
+Примеры:
+    python storage_conformance.py
+    python storage_conformance.py --backend memory
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import traceback
+from typing import Callable, List, Optional
+
+from bot import STATES, STORAGE_BACKENDS, ScheduledJob, Storage, UserRecord, create_storage
+
+CHECKS: List[Callable[[Storage], None]] = []
+
+
+def check(func: Callable[[Storage], None]) -> Callable[[Storage], None]:
+    """Зарегистрировать проверку"""
+    CHECKS.append(func)
+    return func
+
+
+def expect(actual, expected, what: str):
+    if actual != expected:
+        raise AssertionError(f"{what}: ожидалось {expected!r}, получено {actual!r}")
+
+
+# ==================== ПРОВЕРКИ ====================
+
+@check
+def implements_protocol(storage: Storage):
+    expect(isinstance(storage, Storage), True, "реализует Storage")
+
+
+@check
+def creates_user_once(storage: Storage):
+    user = storage.get_or_create_user(1)
+    expect(user, UserRecord(1, STATES['S0_INIT'], 0, 0), "новый пользователь")
+    expect(type(storage.get_or_create_user(1)), UserRecord, "повторный вызов возвращает UserRecord")
+    expect(storage.get_analytics()['total_users'], 1, "total_users после повторного вызова")
+    expect(storage.get_user(2), None, "get_user несуществующего")
+
+
+@check
+def transition_updates_user(storage: Storage):
+    storage.get_or_create_user(1)
+    record = storage.transition(1, STATES['S8_PAUSE'], pause=1)
+    expect(record.current_state, STATES['S8_PAUSE'], "состояние после перехода")
+    expect(record.pause_flag, 1, "pause_flag после перехода")
+    storage.transition(1, STATES['S2_CHECK_CONTRAINDICATIONS'])
+    expect(storage.get_user(1).pause_flag, 1, "pause=None не меняет флаг")
+    storage.update_user_state(1, STATES['S3_READY_FOR_SESSION'])
+    expect(storage.get_user(1).current_state, STATES['S3_READY_FOR_SESSION'], "update_user_state")
+    expect(storage.set_pause_flag(1, 0), 0, "set_pause_flag")
+    expect(storage.get_user(1).pause_flag, 0, "pause_flag после set_pause_flag")
+
+
+@check
+def transition_requires_user(storage: Storage):
+    job = ScheduledJob('session_end:2', 2, 'session_end', time.time() + 60, {})
+    expect(storage.transition(2, STATES['S4_SESSION_ACTIVE'], schedule=job, feedback=("Комфортно", None)),
+           None, "переход несуществующего пользователя")
+    storage.flush_logs()
+    expect(storage.get_user(2), None, "пользователь не создан")
+    expect(storage.load_jobs(), [], "задача не сохранена")
+    expect(storage.get_analytics()['feedback_distribution'], {}, "фидбэк не записан")
+
+
+@check
+def active_transition_skips_paused(storage: Storage):
+    storage.get_or_create_user(1)
+    job = ScheduledJob('session_end:1', 1, 'session_end', time.time() + 60, {})
+    storage.transition(1, STATES['S4_SESSION_ACTIVE'], schedule=job)
+    storage.transition(1, STATES['S8_PAUSE'], pause=1)
+    expect(storage.transition(1, STATES['S5_POST_SESSION'], session=10, claim=job.key, active=True),
+           None, "переход пользователя на паузе с active")
+    expect((storage.get_user(1).current_state, storage.get_user(1).session_count), (STATES['S8_PAUSE'], 0),
+           "состояние и счётчик сеансов не изменены")
+    expect(storage.transition(1, STATES['S3_READY_FOR_SESSION'], pause=0, active=True), None,
+           "active проверяет паузу до перехода")
+    storage.transition(1, STATES['S3_READY_FOR_SESSION'], pause=0)
+    expect(storage.transition(1, STATES['S4_SESSION_ACTIVE'], active=True).current_state,
+           STATES['S4_SESSION_ACTIVE'], "переход без паузы с active")
+
+
+@check
+def sessions_and_feedback_counted(storage: Storage):
+    for user_id in (1, 2):
+        storage.get_or_create_user(user_id)
+    record = storage.transition(1, STATES['S5_POST_SESSION'], session=10)
+    expect(record.session_count, 1, "session_count после сеанса")
+    storage.transition(1, STATES['S7_REGULAR_USE'], feedback=("Комфортно", None))
+    expect(storage.increment_session_count(1), 2, "increment_session_count")
+    storage.add_feedback(2, "Дискомфорт", "Неприятные", 1)
+    storage.log_state(2, STATES['S8_PAUSE'])
+    storage.add_session(2, 1, 10)
+    storage.flush_logs()
+
+    expect(storage.get_user_stats(1),
+           {'session_count': 2, 'pause_flag': 0, 'feedback_distribution': {"Комфортно": 1}},
+           "статистика пользователя")
+    analytics = storage.get_analytics()
+    expect(analytics['feedback_distribution'], {"Комфортно": 1, "Дискомфорт": 1}, "распределение фидбэка")
+    expect(analytics['average_sessions'], 2.0, "среднее число сеансов")
+
+    storage.rebuild_analytics()
+    expect(storage.get_analytics(), analytics, "аналитика после пересчёта")
+
+
+@check
+def counts_users_by_state(storage: Storage):
+    for user_id in (1, 2, 3):
+        storage.get_or_create_user(user_id)
+    storage.transition(3, STATES['S8_PAUSE'], pause=1)
+    expect(storage.count_users_by_state(), {STATES['S0_INIT']: 2, STATES['S8_PAUSE']: 1},
+           "пользователи по состояниям")
+
+
+@check
+def jobs_scheduled_claimed_cancelled(storage: Storage):
+    storage.get_or_create_user(1)
+    job = ScheduledJob('session_end:1', 1, 'session_end', time.time() + 60, {'n': 1})
+    storage.transition(1, STATES['S4_SESSION_ACTIVE'], schedule=job)
+    expect(storage.load_jobs(), [job], "задача сохранена вместе с переходом")
+
+    expect(storage.transition(1, STATES['S5_POST_SESSION'], claim='missing'), None,
+           "переход с чужой задачей не выполняется")
+    expect(storage.get_user(1).current_state, STATES['S4_SESSION_ACTIVE'], "состояние не изменилось")
+    expect(storage.transition(1, STATES['S5_POST_SESSION'], claim=job.key).current_state,
+           STATES['S5_POST_SESSION'], "переход с задачей")
+    expect(storage.claim_job(job.key), False, "задачу нельзя забрать дважды")
+
+    storage.transition(1, STATES['S6_FEEDBACK'], schedule=job._replace(key='message:1'))
+    storage.transition(1, STATES['S8_PAUSE'], cancel_jobs=True)
+    expect(storage.load_jobs(), [], "cancel_jobs удаляет задачи пользователя")
+
+
+@check
+def loads_jobs_by_shard(storage: Storage):
+    for user_id in (1, 2, 3, 4):
+        storage.get_or_create_user(user_id)
+        storage.transition(user_id, STATES['S4_SESSION_ACTIVE'], schedule=ScheduledJob(
+            f"session_end:{user_id}", user_id, 'session_end', 100.0 + user_id, {}
+        ))
+    expect(sorted(job.user_id for job in storage.load_jobs((1, 2))), [1, 3], "задачи шарда 1 из 2")
+    expect(sorted(job.user_id for job in storage.load_jobs((0, 2))), [2, 4], "задачи шарда 0 из 2")
+    expect(len(storage.load_jobs()), 4, "все задачи без шарда")
+
+
+@check
+def recovers_active_sessions(storage: Storage):
+    for user_id in (1, 2, 3):
+        storage.get_or_create_user(user_id)
+    storage.transition(1, STATES['S4_SESSION_ACTIVE'])
+    storage.transition(2, STATES['S4_SESSION_ACTIVE'], pause=1)
+    expect(storage.recover_active_sessions(123.0), 1, "восстановлен один таймер")
+    expect([(job.key, job.due_at) for job in storage.load_jobs()], [('session_end:1', 123.0)],
+           "таймер восстановленного сеанса")
+    expect(storage.recover_active_sessions(456.0), 0, "повторное восстановление")
+
+
+@check
+def pages_idle_users_for_reminders(storage: Storage):
+    ready = STATES['S3_READY_FOR_SESSION']
+    for user_id in (1, 2, 3, 4):
+        storage.get_or_create_user(user_id)
+        storage.transition(user_id, ready, pause=1 if user_id == 2 else None)
+    cutoff = '9999-12-31 00:00:00'
+    expect(storage.campaign_cursor('idle', ready, cutoff), (cutoff, '', 0, False), "новая кампания")
+
+    seen = []
+    while True:
+        _, after_updated_at, after_user_id, _ = storage.campaign_cursor('idle', ready, '')
+        page = storage.idle_users_page(ready, cutoff, after_updated_at, after_user_id, 2)
+        if not page:
+            break
+        seen += [user_id for user_id, _ in page]
+        user_ids = [user_id for user_id, _ in page]
+        expect(storage.claim_reminders('idle', ready, user_ids, after_updated_at, after_user_id,
+                                       page[-1][1], page[-1][0]), True, "порция забрана")
+        expect(storage.claim_reminders('idle', ready, user_ids, after_updated_at, after_user_id,
+                                       page[-1][1], page[-1][0]), False, "повторно порция не забирается")
+    expect(sorted(seen), [1, 3, 4], "неактивные не на паузе, без повторов")
+    storage.finish_campaign('idle', ready)
+    expect(storage.campaign_cursor('idle', ready, '')[::3], (cutoff, True), "граница сохранена, кампания пройдена")
+    expect(storage.idle_users_page(ready, cutoff, '', 0, 10), [], "после напоминания пользователи исключены")
+    expect(storage.idle_users_page(ready, '0000-01-01 00:00:00', '', 0, 10), [], "граница простоя")
+
+
+@check
+def persists_conversations(storage: Storage):
+    storage.get_or_create_user(1)
+    expect(storage.load_conversation('fsm', '[1, 1]', 1), (None, STATES['S0_INIT']),
+           "без сохранённого диалога — current_state")
+    storage.save_persistence({1: b'data'}, {('fsm', '[1, 1]'): '"S3"'})
+    expect(storage.load_user_data(1), b'data', "user_data")
+    expect(storage.load_conversation('fsm', '[1, 1]', 1), ('"S3"', None), "сохранённый диалог")
+    storage.save_persistence({1: None}, {('fsm', '[1, 1]'): None})
+    expect(storage.load_user_data(1), None, "user_data удалены")
+    expect(storage.load_conversation('fsm', '[1, 1]', 2), (None, None), "неизвестный пользователь")
+
+
+@check
+def reports_commits(storage: Storage):
+    before = storage.commit_stats()['commits']
+    storage.get_or_create_user(1)
+    storage.transition(1, STATES['S1_CONFIRM_CONDITIONS'])
+    if storage.commit_stats()['commits'] <= before:
+        raise AssertionError("commit_stats не растёт при записи")
+
+
+# ==================== ЗАПУСК ====================
+
+def run_backend(backend: str, workdir: str, verbose: bool) -> List[str]:
+    """Прогнать все проверки на бэкенде; возвращает имена непрошедших"""
+    failed = []
+    for number, func in enumerate(CHECKS):
+        storage = create_storage(backend, os.path.join(workdir, f"{backend}-{number}.db"))
+        try:
+            func(storage)
+            status = 'ok'
+        except Exception as e:
+            failed.append(func.__name__)
+            status = f"ОШИБКА: {e}"
+            if verbose:
+                traceback.print_exc()
+        finally:
+            storage.close()
+        print(f"{backend:<10} {func.__name__:<36} {status}")
+    return failed
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Проверка бэкендов хранилища на соответствие Storage")
+    parser.add_argument('--backend', action='append', choices=sorted(STORAGE_BACKENDS),
+                        help="проверить только этот бэкенд (можно несколько раз)")
+    parser.add_argument('--verbose', action='store_true', help="печатать трассировку ошибок")
+    args = parser.parse_args(argv)
+
+    failed = []
+    with tempfile.TemporaryDirectory() as workdir:
+        for backend in args.backend or STORAGE_BACKENDS:
+            failed += [f"{backend}:{name}" for name in run_backend(backend, workdir, args.verbose)]
+
+    if failed:
+        print(f"Не прошли: {', '.join(failed)}")
+        return 1
+    print(f"Все проверки пройдены ({len(CHECKS)} на бэкенд)")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
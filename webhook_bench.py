@@ -0,0 +1,180 @@
+"""
+Нагрузочный стенд для webhook-режима бота
+
+Отправляет синтетические обновления POST-запросами на webhook и измеряет
+пропускную способность приёма и задержку подтверждения (ack).
+Telegram не нужен: с --self-hosted стенд сам поднимает WebhookServer
+и считает обновления, дошедшие до очереди приложения.
+
+Примеры:
+    python webhook_bench.py --self-hosted --updates 20000 --concurrency 64
+    python webhook_bench.py --url http://127.0.0.1:8443/telegram --secret s3cr3t
+"""
+
+import argparse
+import asyncio
+import itertools
+import json
+import time
+from typing import List, Optional
+from urllib.parse import urlsplit
+
+from telegram.ext import Application
+
+from bot import WEBHOOK_PATH, WebhookServer
+
+# Кнопки, которые пользователи нажимают в сценарии S0 → S8
+BUTTONS = ["/start", "Начать", "Подтверждаю", "Нет", "Начать сеанс", "Продолжить", "Комфортно"]
+
+
+def synthetic_update_data(update_id: int, user_id: int, text: str) -> dict:
+    """Обновление Telegram с текстовым сообщением пользователя"""
+    message = {
+        'message_id': update_id,
+        'date': int(time.time()),
+        'chat': {'id': user_id, 'type': 'private'},
+        'from': {'id': user_id, 'is_bot': False, 'first_name': f"user{user_id}"},
+        'text': text
+    }
+    if text.startswith('/'):
+        message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text)}]
+    return {'update_id': update_id, 'message': message}
+
+
+def synthetic_update(update_id: int, user_id: int, text: str) -> bytes:
+    """Тело POST-запроса с обновлением"""
+    return json.dumps(synthetic_update_data(update_id, user_id, text)).encode()
+
+
+def percentile(values: List[float], pct: float) -> float:
+    """Перцентиль по отсортированному списку"""
+    if not values:
+        return 0.0
+    return values[min(int(len(values) * pct / 100), len(values) - 1)]
+
+
+async def post_worker(host: str, port: int, path: str, secret: str,
+                      bodies: "asyncio.Queue[bytes]", latencies: List[float], errors: List[int]):
+    """Одно keep-alive соединение, отправляющее обновления последовательно"""
+    reader, writer = await asyncio.open_connection(host, port)
+    secret_header = f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n" if secret else ""
+    try:
+        while True:
+            try:
+                body = bodies.get_nowait()
+            except asyncio.QueueEmpty:
+                return
+
+            started = time.perf_counter()
+            writer.write((
+                f"POST {path} HTTP/1.1\r\n"
+                f"Host: {host}\r\n"
+                f"Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"{secret_header}\r\n"
+            ).encode() + body)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            length = 0
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b''):
+                    break
+                name, _, value = line.decode().partition(':')
+                if name.lower() == 'content-length':
+                    length = int(value)
+            if length:
+                await reader.readexactly(length)
+
+            latencies.append(time.perf_counter() - started)
+            status = int(status_line.split()[1])
+            if status != 200:
+                errors.append(status)
+    finally:
+        writer.close()
+
+
+async def run_bench(url: str, secret: str, updates: int, users: int, concurrency: int) -> dict:
+    """Отправить обновления и собрать статистику"""
+    parts = urlsplit(url)
+    bodies: asyncio.Queue = asyncio.Queue()
+    update_ids = itertools.count(1)
+    for i in range(updates):
+        user_id = 100000 + i % users
+        bodies.put_nowait(synthetic_update(next(update_ids), user_id, BUTTONS[i % len(BUTTONS)]))
+
+    latencies: List[float] = []
+    errors: List[int] = []
+    started = time.perf_counter()
+    await asyncio.gather(*(
+        post_worker(parts.hostname, parts.port or 80, parts.path or '/', secret,
+                    bodies, latencies, errors)
+        for _ in range(concurrency)
+    ))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'updates': updates,
+        'elapsed_s': round(elapsed, 3),
+        'updates_per_s': round(updates / elapsed, 1),
+        'ack_p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'ack_p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'errors': len(errors)
+    }
+
+
+async def self_hosted(secret: str, updates: int, users: int, concurrency: int) -> dict:
+    """Поднять WebhookServer в процессе стенда и измерить только приём"""
+    application = Application.builder().token("123456:BENCHMARK").build()
+    webhook = WebhookServer(application, secret_token=secret, host='127.0.0.1', port=0)
+    await webhook.start()
+
+    # Потребитель очереди вместо обработчиков бота: считаем доставленные обновления
+    delivered = 0
+    done = asyncio.Event()
+
+    async def consume():
+        nonlocal delivered
+        while delivered < updates:
+            await application.update_queue.get()
+            delivered += 1
+        done.set()
+
+    consumer = asyncio.create_task(consume())
+    url = f"http://127.0.0.1:{webhook.http.port}{WEBHOOK_PATH}"
+    result = await run_bench(url, secret, updates, users, concurrency)
+    try:
+        await asyncio.wait_for(done.wait(), timeout=10)
+    except asyncio.TimeoutError:
+        consumer.cancel()
+    await webhook.stop()
+
+    result['delivered_to_queue'] = delivered
+    return result
+
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Нагрузочный стенд webhook-режима")
+    parser.add_argument('--url', help="адрес webhook бота, например http://127.0.0.1:8443/telegram")
+    parser.add_argument('--self-hosted', action='store_true',
+                        help="поднять WebhookServer внутри стенда (без бота и Telegram)")
+    parser.add_argument('--secret', default='', help="секретный токен webhook")
+    parser.add_argument('--updates', type=int, default=10000, help="число обновлений")
+    parser.add_argument('--users', type=int, default=1000, help="число синтетических пользователей")
+    parser.add_argument('--concurrency', type=int, default=32, help="число параллельных соединений")
+    args = parser.parse_args(argv)
+
+    if args.self_hosted:
+        result = asyncio.run(self_hosted(args.secret, args.updates, args.users, args.concurrency))
+    elif args.url:
+        result = asyncio.run(run_bench(args.url, args.secret, args.updates, args.users, args.concurrency))
+    else:
+        parser.error("нужен --url или --self-hosted")
+
+    print(json.dumps(result, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()